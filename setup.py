@@ -11,7 +11,7 @@ setup(name='vtovosm',
       install_requires=['geopandas>=0.2.1',
                         'matplotlib>=2.0.2',
                         'networkx>=1.11,<2.0',
-                        'numpy>=1.12.1',
+                        'numpy>=1.17.0',
                         'osmnx>=0.5.1,<0.6',
                         'requests>=2.14.2',
                         'scipy>=0.19.0',
@@ -1,11 +1,15 @@
 """ Provides functions to generate connection graphs and matrices and
 derive further results from them"""
 
+import logging
 import multiprocessing as mp
 from collections import namedtuple
+from itertools import repeat
 
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp_sparse
+import scipy.sparse.csgraph as sp_csgraph
 import scipy.spatial.distance as sp_dist
 import networkx.algorithms.connectivity as nx_con
 import networkx.algorithms.approximation.connectivity as nx_con_approx
@@ -20,9 +24,12 @@ def gen_connection_matrix(vehs,
                           max_metric,
                           metric='distance',
                           graph_streets_wave=None,
-                          metric_config=None):
+                          metric_config=None,
+                          prop_cond_tracker=None):
     """Simulates links between every set of 2 vehicles and determines if they are connected using
-    either distance or pathloss as a metric. Returns a matrix"""
+    either distance or pathloss as a metric. Returns a matrix.
+    If a `prop_cond_tracker` is given and the vehicles have IDs the propagation conditions (NLOS and OLOS/LOS) are
+    updated incrementally from the previous snapshot"""
 
     # Initialize
     if metric not in ['distance', 'pathloss']:
@@ -46,13 +53,17 @@ def gen_connection_matrix(vehs,
         time_start = utils.debug(None, 'Determining propagation conditions')
 
         # Determine propagation condition matrix
-        prop_cond_matrix, _ = prop.gen_prop_cond_matrix(
-            vehs.get_points(),
-            gdf_buildings,
-            graph_streets_wave=None,
-            graphs_vehs=None,
-            fully_determine=False,
-            max_dist=max_dist)
+        if (prop_cond_tracker is not None) and (vehs.ids is not None):
+            prop_cond_matrix = prop_cond_tracker.update(
+                vehs.coordinates,
+                vehs.ids,
+                max_dist=max_dist)
+            logging.debug('Checked {:d} pairs of vehicles'.format(prop_cond_tracker.count_checked))
+        else:
+            prop_cond_matrix = prop.gen_prop_cond_matrix_batch(
+                vehs.coordinates,
+                gdf_buildings,
+                max_dist=max_dist)
 
         idxs_olos_los = np.nonzero(prop_cond_matrix == prop.Cond.OLOS_LOS)[0]
         idxs_nlos = np.nonzero(prop_cond_matrix == prop.Cond.NLOS)[0]
@@ -83,8 +94,8 @@ def gen_connection_matrix(vehs,
         if graph_streets_wave is None:
             raise RuntimeError('Streets wave propagation graph not given')
 
-        if metric_config is None:
-            metric_config = {}
+        # The defaults are filled into a copy so that the configuration of the caller is left unchanged
+        metric_config = {} if metric_config is None else dict(metric_config)
         if 'shadowfading_enabled' not in metric_config:
             metric_config['shadowfading_enabled'] = True
         if 'max_dist' not in metric_config:
@@ -93,6 +104,10 @@ def gen_connection_matrix(vehs,
             metric_config['car_radius'] = 1.5
         if 'max_angle' not in metric_config:
             metric_config['max_angle'] = np.pi
+        if 'route_weight' not in metric_config:
+            metric_config['route_weight'] = 'length'
+        if 'rng' not in metric_config:
+            metric_config['rng'] = None
 
         # Determine propagation condition matrix
         prop_cond_matrix, coords_max_angle_matrix = prop.gen_prop_cond_matrix(
@@ -103,7 +118,10 @@ def gen_connection_matrix(vehs,
             fully_determine=True,
             max_dist=metric_config['max_dist'],
             car_radius=metric_config['car_radius'],
-            max_angle=metric_config['max_angle'])
+            max_angle=metric_config['max_angle'],
+            route_weight=metric_config['route_weight'],
+            prop_cond_tracker=prop_cond_tracker,
+            ids_vehs=vehs.ids)
 
         idxs_los = np.nonzero(prop_cond_matrix == prop.Cond.LOS)[0]
         idxs_olos = np.nonzero(prop_cond_matrix == prop.Cond.OLOS)[0]
@@ -121,7 +139,7 @@ def gen_connection_matrix(vehs,
 
         distances = sp_dist.pdist(vehs.coordinates)
 
-        ploss = pathloss.Pathloss()
+        ploss = pathloss.Pathloss(rng=metric_config['rng'])
         if not metric_config['shadowfading_enabled']:
             ploss.disable_shadowfading()
 
@@ -130,22 +148,14 @@ def gen_connection_matrix(vehs,
         pathlosses[idxs_olos] = ploss.pathloss_olos(distances[idxs_olos])
         pathlosses[idxs_nlos_par] = np.inf
 
+        # NOTE: Maximum of the 2 pathlosses => Nodes connected if both are below threshold
         vehs_coords = vehs.get()
-        for idx_nlos_ort in idxs_nlos_ort:
-            coords_max_angle = coords_max_angle_matrix[idx_nlos_ort]
-            idx_veh1, idx_veh2 = utils.condensed_to_square(
-                idx_nlos_ort, count_veh)
-            coords_veh1 = vehs_coords[idx_veh1]
-            coords_veh2 = vehs_coords[idx_veh2]
-
-            dist_1 = np.linalg.norm(coords_veh1 - coords_max_angle)
-            dist_2 = np.linalg.norm(coords_veh2 - coords_max_angle)
-            pathloss_iter1 = ploss.pathloss_nlos(dist_1, dist_2)
-            pathloss_iter2 = ploss.pathloss_nlos(dist_2, dist_1)
-
-            # NOTE: Maximum of the 2 pathlosses => Nodes connected if both are below threshold
-            pathlosses[idx_nlos_ort] = np.max(
-                [pathloss_iter1, pathloss_iter2])
+        idxs_veh1, idxs_veh2 = utils.triu_indices(count_veh)
+        idxs_veh1, idxs_veh2 = idxs_veh1[idxs_nlos_ort], idxs_veh2[idxs_nlos_ort]
+        coords_max_angle = coords_max_angle_matrix[idxs_nlos_ort]
+        dist_1 = np.hypot(*(vehs_coords[idxs_veh1] - coords_max_angle).T)
+        dist_2 = np.hypot(*(vehs_coords[idxs_veh2] - coords_max_angle).T)
+        pathlosses[idxs_nlos_ort] = ploss.pathloss_nlos_pairs(dist_1, dist_2)
 
         idxs_in_range = np.nonzero(pathlosses < max_metric)
         idxs_out_range = np.setdiff1d(np.arange(count_cond), idxs_in_range)
@@ -183,13 +193,163 @@ def gen_connection_graph(vehs,
     return graph_cons
 
 
-def calc_net_connectivities(graphs_cons):
-    """Calculates the network connectivities (relative size of the biggest connected cluster)"""
+PackedConnections = namedtuple('PackedConnections', ['bits', 'count_veh'])
+
+
+def pack_connections(matrix_cons):
+    """Packs a connection matrix (square or condensed) into the bits of its condensed form"""
+
+    matrix_cons = np.asarray(matrix_cons, dtype=bool)
+    if matrix_cons.ndim == 2:
+        count_veh = matrix_cons.shape[0]
+        is_connected = matrix_cons[utils.triu_indices(count_veh)]
+    else:
+        count_veh = int(np.round((1 + np.sqrt(1 + 8 * matrix_cons.size)) / 2))
+        is_connected = matrix_cons
+
+    return PackedConnections(bits=np.packbits(is_connected), count_veh=count_veh)
+
+
+def unpack_connections(packed_cons, condensed=True):
+    """Unpacks packed connections to a condensed boolean vector or to a square boolean matrix"""
+
+    count_cond = packed_cons.count_veh * (packed_cons.count_veh - 1) // 2
+    is_connected = np.unpackbits(packed_cons.bits)[:count_cond].astype(bool)
+
+    if condensed:
+        return is_connected
+
+    return sp_dist.squareform(is_connected)
+
+
+def packed_to_graph(packed_cons):
+    """Builds the connection graph from packed connections. Equals `nx.from_numpy_matrix` of the unpacked
+    square matrix"""
+
+    is_connected = unpack_connections(packed_cons)
+    idxs_veh1, idxs_veh2 = utils.triu_indices(packed_cons.count_veh)
+    idxs_veh1, idxs_veh2 = idxs_veh1[is_connected], idxs_veh2[is_connected]
+
+    graph_cons = nx.Graph()
+    graph_cons.add_nodes_from(range(packed_cons.count_veh))
+    graph_cons.add_edges_from(zip(idxs_veh1.tolist(), idxs_veh2.tolist()), weight=True)
+
+    return graph_cons
+
+
+def count_connection_differences(packed_cons_1, packed_cons_2):
+    """Counts the pairs of vehicles whose connection status differs between 2 packed connections"""
+
+    if packed_cons_1.count_veh != packed_cons_2.count_veh:
+        raise ValueError('Number of vehicles differs')
+
+    # Padding bits are 0 in both and do not contribute
+    return int(np.sum(np.unpackbits(np.bitwise_xor(packed_cons_1.bits, packed_cons_2.bits))))
+
+
+def to_sparse_matrix(matrix_cons):
+    """Converts a connection matrix (square, packed, sparse or a graph) to a symmetric boolean sparse matrix in
+    compressed sparse row format. Self loops are dropped"""
+
+    if isinstance(matrix_cons, PackedConnections):
+        count_nodes = matrix_cons.count_veh
+        is_connected = unpack_connections(matrix_cons)
+        idxs_u, idxs_v = utils.triu_indices(count_nodes)
+        idxs_u, idxs_v = idxs_u[is_connected], idxs_v[is_connected]
+    elif sp_sparse.issparse(matrix_cons) or isinstance(matrix_cons, nx.Graph):
+        count_nodes = count_nodes_of(matrix_cons)
+        idxs_u, idxs_v = edges_of(matrix_cons).T
+    else:
+        matrix_cons = np.asarray(matrix_cons, dtype=bool)
+        count_nodes = matrix_cons.shape[0]
+        idxs_u, idxs_v = np.nonzero(np.triu(matrix_cons, k=1))
+
+    data = np.ones(2 * idxs_u.size, dtype=bool)
+    rows = np.concatenate((idxs_u, idxs_v))
+    cols = np.concatenate((idxs_v, idxs_u))
+
+    return sp_sparse.csr_matrix((data, (rows, cols)), shape=(count_nodes, count_nodes))
+
+
+def to_graph(graph_cons):
+    """Builds the NetworkX connection graph of a sparse connection matrix on demand (e.g. for minimum node cuts and
+    disjoint paths). Graphs are returned unchanged"""
+
+    if not sp_sparse.issparse(graph_cons):
+        return graph_cons
+
+    edges = edges_of(graph_cons)
+    graph = nx.Graph()
+    graph.add_nodes_from(range(graph_cons.shape[0]))
+    graph.add_edges_from(zip(edges[:, 0].tolist(), edges[:, 1].tolist()), weight=True)
+
+    return graph
+
+
+def count_nodes_of(graph_cons):
+    """Returns the number of nodes of a connection graph or sparse connection matrix"""
+
+    if sp_sparse.issparse(graph_cons):
+        return graph_cons.shape[0]
+
+    return graph_cons.number_of_nodes()
+
+
+def edges_of(graph_cons):
+    """Returns the edges of a connection graph or sparse connection matrix as an array with one row per edge.
+    Self loops are dropped and the edges of a sparse matrix are returned once with the smaller node first"""
+
+    if sp_sparse.issparse(graph_cons):
+        return np.column_stack(sp_sparse.triu(graph_cons, k=1).nonzero()).reshape(-1, 2)
+
+    edges = np.array(graph_cons.edges(), dtype=int).reshape(-1, 2)
+
+    return edges[edges[:, 0] != edges[:, 1]]
+
+
+def calc_degrees(graph_cons):
+    """Determines the degrees of all nodes of a connection graph or sparse connection matrix"""
+
+    return np.bincount(edges_of(graph_cons).ravel(), minlength=count_nodes_of(graph_cons))
+
+
+DegreeStats = namedtuple('DegreeStats', ['mean', 'std', 'min', 'max', 'count_isolated'])
+
+
+def calc_degree_stats(graph_cons):
+    """Calculates the statistics of the node degrees of a connection graph or sparse connection matrix"""
+
+    degrees = calc_degrees(graph_cons)
+    degree_stats = DegreeStats(mean=np.mean(degrees),
+                               std=np.std(degrees),
+                               min=int(np.min(degrees)),
+                               max=int(np.max(degrees)),
+                               count_isolated=int(np.sum(degrees == 0)))
+
+    return degree_stats
+
+
+def calc_net_connectivities(graphs_cons, min_node_cut='exact', min_node_cut_interval=1):
+    """Calculates the network connectivities (relative size of the biggest connected cluster). The minimum node cut
+    is only determined for every `min_node_cut_interval`-th graph, see also: calc_net_connectivity"""
 
     net_connectivities = np.zeros(len(graphs_cons), dtype=object)
 
     for idx, graph_cons in enumerate(graphs_cons):
-        net_connectivities[idx] = calc_net_connectivity(graph_cons)
+        method_cut = min_node_cut if idx % min_node_cut_interval == 0 else 'skip'
+        net_connectivities[idx] = calc_net_connectivity(graph_cons, min_node_cut=method_cut)
+
+    return net_connectivities
+
+
+def calc_net_connectivities_multiprocess(graphs_cons, processes=None, min_node_cut='exact', min_node_cut_interval=1):
+    """Calculates the network connectivities using multiple processes. See also: calc_net_connectivities"""
+
+    methods_cut = [min_node_cut if idx % min_node_cut_interval == 0 else 'skip' for idx in range(len(graphs_cons))]
+    with mp.Pool(processes=processes) as pool:
+        net_connectivities = pool.starmap(
+            calc_net_connectivity,
+            zip(graphs_cons, repeat(None), repeat(True), methods_cut))
 
     return net_connectivities
 
@@ -197,35 +357,55 @@ def calc_net_connectivities(graphs_cons):
 NetworkConnectivity = namedtuple('NetworkConnectivity', ['net_connectivity', 'min_node_cut', 'count_cluster'])
 
 
-def calc_net_connectivity(graph_cons, vehs=None, cut_only_fully_connected=True):
-    """Calculates the network connectivity (relative size of the biggest connected cluster)"""
+def calc_net_connectivity(graph_cons, vehs=None, cut_only_fully_connected=True, min_node_cut='exact'):
+    """Calculates the network connectivity (relative size of the biggest connected cluster). `graph_cons` can be a
+    graph or a sparse connection matrix. The clusters are found by labeling the connected components. The minimum node
+    cut of the biggest cluster is determined exactly (`min_node_cut` 'exact'), approximated by the neighbors of a node
+    with minimum degree ('approx', an upper bound of the exact cut) or skipped ('skip')"""
 
-    time_start = utils.debug(None, 'Finding biggest cluster')
+    logging.debug('Finding biggest cluster')
+    time_start = utils.debug()
 
     # Find biggest cluster
-    count_veh = graph_cons.order()
-    clusters = list(nx.connected_component_subgraphs(graph_cons))
-    cluster_max = max(clusters, key=len)
-    count_veh_max = cluster_max.order()
-    net_connectivity = count_veh_max / count_veh
+    count_veh = count_nodes_of(graph_cons)
+    labels = connected_component_labels(graph_cons, count_veh)
+    sizes_cluster = np.bincount(labels)
+    cluster_nodes = np.flatnonzero(labels == np.argmax(sizes_cluster))
+    count_cluster = sizes_cluster.size
+    net_connectivity = cluster_nodes.size / count_veh
     if vehs is not None:
-        cluster_nodes = cluster_max.nodes()
         vehs.add_key('cluster_max', cluster_nodes)
-        not_cluster_max_nodes = np.arange(count_veh)[~np.in1d(
-            np.arange(count_veh), cluster_nodes)]
+        not_cluster_max_nodes = np.flatnonzero(labels != labels[cluster_nodes[0]])
         vehs.add_key('not_cluster_max', not_cluster_max_nodes)
 
+    utils.debug(time_start)
+
     # Find the minimum node cut
-    count_cluster = len(clusters)
-    if count_cluster == 1 or not cut_only_fully_connected:
-        min_node_cut = nx.minimum_node_cut(cluster_max)
+    if (min_node_cut == 'skip') or (count_cluster > 1 and cut_only_fully_connected):
+        min_node_cut_cluster = None
+    elif min_node_cut == 'exact':
+        logging.debug('Finding minimum node cut')
+        time_start = utils.debug()
+        if sp_sparse.issparse(graph_cons):
+            # Only the graph of the biggest cluster is built, its nodes are mapped back to the vehicles afterwards
+            cluster_max = to_graph(sp_sparse.csr_matrix(graph_cons)[cluster_nodes][:, cluster_nodes])
+            min_node_cut_cluster = set(cluster_nodes[sorted(nx.minimum_node_cut(cluster_max))].tolist())
+        else:
+            min_node_cut_cluster = nx.minimum_node_cut(graph_cons.subgraph(cluster_nodes.tolist()))
+        utils.debug(time_start)
+    elif min_node_cut == 'approx':
+        # The neighbors of any node separate it from the rest of the cluster (if it is not complete)
+        adjacency = to_sparse_matrix(graph_cons)[cluster_nodes][:, cluster_nodes]
+        degrees = np.diff(adjacency.indptr)
+        idx_min = np.argmin(degrees)
+        min_node_cut_cluster = set(cluster_nodes[adjacency.indices[
+            adjacency.indptr[idx_min]:adjacency.indptr[idx_min + 1]]].tolist())
     else:
-        min_node_cut = None
+        raise NotImplementedError('Minimum node cut method not supported')
 
     result = NetworkConnectivity(net_connectivity=net_connectivity,
-                                 min_node_cut=min_node_cut,
+                                 min_node_cut=min_node_cut_cluster,
                                  count_cluster=count_cluster)
-    utils.debug(time_start)
 
     return result
 
@@ -234,7 +414,7 @@ def calc_center_path_redundancies(graphs_cons, vehs):
     """Determines the path redundancy of all the connection graphs for the center vehicle"""
 
     count_graphs = len(graphs_cons)
-    count_nodes = graphs_cons[0].number_of_nodes()
+    count_nodes = count_nodes_of(graphs_cons[0])
 
     path_redundancies = np.zeros(
         (count_nodes - 1, count_graphs),
@@ -280,16 +460,17 @@ def calc_path_redundancies(graph, vehs):
 
     time_start = utils.debug(None, 'Determining path redundancies')
 
+    graph = to_graph(graph)
     distances = sp_dist.pdist(vehs.coordinates)
     count_nodes = graph.number_of_nodes()
     node_cons = nx_con_approx.all_pairs_node_connectivity(graph)
     node_cons_dist = {}
 
     for u, vals in node_cons.items():
-        node_cons_dist[u] = {}
-        for v, val in vals.items():
-            idx_cond = utils.square_to_condensed(u, v, count_nodes)
-            node_cons_dist[u][v] = {'node_con': val, 'dist': distances[idx_cond]}
+        nodes_v = list(vals.keys())
+        idxs_cond = utils.square_to_condensed(u, np.array(nodes_v, dtype=int), count_nodes)
+        node_cons_dist[u] = {v: {'node_con': vals[v], 'dist': dist}
+                             for v, dist in zip(nodes_v, distances[idxs_cond])}
 
     utils.debug(time_start)
 
@@ -302,25 +483,22 @@ def calc_path_redundancy(graph, node, distances):
     # NOTE: we calculate the minimum number of node independent paths as an approximation (and not
     # the maximum)
 
+    graph = to_graph(graph)
     count_nodes = graph.number_of_nodes()
     path_redundancy = np.zeros(
         count_nodes - 1,
         dtype=[('distance', 'float'),
                ('count_node_disjoint_paths', 'uint'),
                ('count_edge_disjoint_paths', 'uint')])
-    iter_veh = 0
-    for node_iter_veh in graph.nodes():
-        if node_iter_veh == node:
-            continue
-        idx_cond = utils.square_to_condensed(
-            node, node_iter_veh, count_nodes)
-        path_redundancy[iter_veh]['distance'] = distances[idx_cond]
+    nodes_other = [node_iter_veh for node_iter_veh in graph.nodes() if node_iter_veh != node]
+    idxs_cond = utils.square_to_condensed(node, np.array(nodes_other, dtype=int), count_nodes)
+    path_redundancy['distance'] = distances[idxs_cond]
 
+    for iter_veh, node_iter_veh in enumerate(nodes_other):
         path_redundancy[iter_veh]['count_node_disjoint_paths'] = nx_con_approx.local_node_connectivity(
             graph, source=node, target=node_iter_veh)
         path_redundancy[iter_veh]['count_edge_disjoint_paths'] = nx_con.local_edge_connectivity(
             graph, node, node_iter_veh)
-        iter_veh += 1
 
     return path_redundancy
 
@@ -333,57 +511,155 @@ def calc_link_durations(graphs_cons):
     """Determines the link durations (continuous time period during which 2 nodes are directly connected)
     and link rehealing time (lengths of disconnected periods)"""
 
+    link_durations = LinkDurations(*runs_to_durations(calc_link_runs(graphs_cons)))
+
+    return link_durations
+
+
+def calc_link_durations_packed(packed_cons):
+    """Determines the link durations directly from a sequence of packed connections. See also: calc_link_durations"""
+
+    is_connected = np.vstack([unpack_connections(packed) for packed in packed_cons])
+
+    link_durations = LinkDurations(*calc_durations_matrix(is_connected))
+
+    return link_durations
+
+
+DurationRuns = namedtuple('DurationRuns', ['durations', 'idxs_pair', 'is_connected', 'states_first', 'states_last'])
+
+
+def calc_durations_matrix(is_connected):
+    """Determines the lengths of all connected and disconnected periods from a (time x pairs) boolean matrix of
+    connection states in one pass. Returns the flat lists of the durations and the per pair lists of the durations
+    in the order of `LinkDurations`"""
+
+    return runs_to_durations(calc_runs(is_connected))
+
+
+def calc_runs(is_connected):
+    """Determines the periods of constant connection status from a (time x pairs) boolean matrix of connection
+    states. Returns the durations, pair indices and connection status of the periods ordered by pair and then by time
+    together with the first and last connection states"""
+
+    is_connected = np.asarray(is_connected, dtype=bool)
+    count_time, size_cond = is_connected.shape
+
+    # Periods of constant connection status start at the first time step and wherever the status changes. The
+    # matrix is flattened pair by pair so that the periods are ordered by pair and then by time
+    states = is_connected.T
+    is_start = np.ones((size_cond, count_time), dtype=bool)
+    is_start[:, 1:] = states[:, 1:] != states[:, :-1]
+    idxs_start = np.flatnonzero(is_start)
+    durations = np.diff(np.append(idxs_start, size_cond * count_time))
+    idxs_pair = idxs_start // count_time
+    is_connected_period = states.ravel()[idxs_start]
+
+    runs = DurationRuns(durations=durations,
+                        idxs_pair=idxs_pair,
+                        is_connected=is_connected_period,
+                        states_first=is_connected[0].copy(),
+                        states_last=is_connected[-1].copy())
+
+    return runs
+
+
+def merge_runs(runs_chunks):
+    """Merges the periods of consecutive chunks of time steps. The last period of a pair in a chunk is continued by
+    the first period in the next chunk if the connection status at the boundary is the same"""
+
+    is_continued = []
+    for idx_chunk, runs in enumerate(runs_chunks):
+        is_first = np.ones(runs.idxs_pair.size, dtype=bool)
+        is_first[1:] = runs.idxs_pair[1:] != runs.idxs_pair[:-1]
+        is_continued_chunk = np.zeros(runs.idxs_pair.size, dtype=bool)
+        if idx_chunk > 0:
+            states_previous = runs_chunks[idx_chunk - 1].states_last
+            is_continued_chunk[is_first] = runs.states_first == states_previous
+        is_continued.append(is_continued_chunk)
+
+    # A stable sort by pair keeps the periods ordered by chunk and then by time
+    idxs_pair = np.concatenate([runs.idxs_pair for runs in runs_chunks])
+    order = np.argsort(idxs_pair, kind='mergesort')
+    idxs_pair = idxs_pair[order]
+    durations = np.concatenate([runs.durations for runs in runs_chunks])[order]
+    is_connected = np.concatenate([runs.is_connected for runs in runs_chunks])[order]
+    is_continued = np.concatenate(is_continued)[order]
+
+    idxs_start = np.flatnonzero(~is_continued)
+    runs_merged = DurationRuns(durations=np.add.reduceat(durations, idxs_start),
+                               idxs_pair=idxs_pair[idxs_start],
+                               is_connected=is_connected[idxs_start],
+                               states_first=runs_chunks[0].states_first,
+                               states_last=runs_chunks[-1].states_last)
+
+    return runs_merged
+
+
+def runs_to_durations(runs):
+    """Converts the periods of constant connection status to the flat lists of the durations and the per pair lists
+    of the durations in the order of `LinkDurations`"""
+
+    size_cond = runs.states_first.size
+    is_con = runs.is_connected
+
+    durations_matrix_con = split_by_pair(runs.durations[is_con], runs.idxs_pair[is_con], size_cond)
+    durations_matrix_discon = split_by_pair(runs.durations[~is_con], runs.idxs_pair[~is_con], size_cond)
+
+    durations_con = runs.durations[is_con].tolist()
+    durations_discon = runs.durations[~is_con].tolist()
+
+    return durations_con, durations_discon, durations_matrix_con, durations_matrix_discon
+
+
+def calc_link_runs(graphs_cons):
+    """Determines the periods of constant link status of a chunk of graphs. See also: calc_runs"""
+
     # Assumes that all graphs have the same number of nodes
-    count_nodes = graphs_cons[0].number_of_nodes()
-    size_cond = count_nodes * (count_nodes - 1) // 2
+    count_nodes = count_nodes_of(graphs_cons[0])
+    is_connected = np.vstack([to_adjacency_matrix(graph_cons, count_nodes) for graph_cons in graphs_cons])
 
-    durations_matrix_con = np.zeros(size_cond, dtype=object)
-    for idx in range(durations_matrix_con.size):
-        durations_matrix_con[idx] = []
+    return calc_runs(is_connected)
 
-    durations_matrix_discon = np.zeros(size_cond, dtype=object)
-    for idx in range(durations_matrix_discon.size):
-        durations_matrix_discon[idx] = []
 
-    active_matrix = np.zeros(size_cond, bool)
+def calc_connection_runs(graphs_cons):
+    """Determines the periods of constant connection (has-path) status of a chunk of graphs. See also: calc_runs"""
 
-    for graph_cons in graphs_cons:
+    has_path = np.vstack([to_has_path_matrix(graph_cons) for graph_cons in graphs_cons])
 
-        # Search for all active connections
-        edges = [set(edge) for edge in graph_cons.edges_iter()]
+    return calc_runs(has_path)
 
-        for idx_u, node_u in enumerate(graph_cons.nodes()):
-            for node_v in graph_cons.nodes()[idx_u + 1:]:
-                idx_cond = utils.square_to_condensed(node_u, node_v, count_nodes)
-                is_connected = {node_u, node_v} in edges
-                if is_connected:
-                    if not active_matrix[idx_cond]:
-                        durations_matrix_con[idx_cond].append(0)
-                        active_matrix[idx_cond] = True
-                    durations_matrix_con[idx_cond][-1] += 1
-                else:
-                    if active_matrix[idx_cond] or durations_matrix_discon[idx_cond] == []:
-                        durations_matrix_discon[idx_cond].append(0)
-                        active_matrix[idx_cond] = False
-                    durations_matrix_discon[idx_cond][-1] += 1
 
-    durations_con = [item for sublist in durations_matrix_con.tolist() for item in sublist]
-    durations_discon = [item for sublist in durations_matrix_discon.tolist() for item in sublist]
+def split_by_pair(durations, idxs_pair, size_cond):
+    """Splits durations that are sorted by pair into an object array with a list of durations per pair"""
 
-    link_durations = LinkDurations(durations_con=durations_con,
-                                   durations_discon=durations_discon,
-                                   durations_matrix_con=durations_matrix_con,
-                                   durations_matrix_discon=durations_matrix_discon)
+    durations_matrix = np.zeros(size_cond, dtype=object)
+    bounds = np.append(0, np.cumsum(np.bincount(idxs_pair, minlength=size_cond))).tolist()
+    durations = durations.tolist()
+    for idx_cond in range(size_cond):
+        durations_matrix[idx_cond] = durations[bounds[idx_cond]:bounds[idx_cond + 1]]
 
-    return link_durations
+    return durations_matrix
+
+
+def to_adjacency_matrix(graph, count_nodes=None):
+    """Determines the condensed boolean adjacency matrix of the graph (or sparse connection matrix)"""
+
+    if count_nodes is None:
+        count_nodes = count_nodes_of(graph)
+    size_cond = count_nodes * (count_nodes - 1) // 2
+    adjacency_matrix = np.zeros(size_cond, dtype=bool)
+
+    edges = edges_of(graph)
+    idxs_cond = utils.square_to_condensed(edges[:, 0], edges[:, 1], count_nodes)
+    adjacency_matrix[idxs_cond] = True
+
+    return adjacency_matrix
 
 
 def calc_link_durations_multiprocess(graphs_cons, processes=None, chunk_length=None):
     """Determines the link durations using multiple processes. See also: calc_link_durations"""
 
-    # TODO: optionally return 1st and last con/discon matrix to speed up merge in multiprocessing case? also applies to
-    # calc_connection_durations_multiprocess
-
     # Process chunks in parallel
     with mp.Pool(processes=processes) as pool:
         # Determine optimal chunk size
@@ -397,10 +673,10 @@ def calc_link_durations_multiprocess(graphs_cons, processes=None, chunk_length=N
         graphs_chunks = [graphs_cons[i:i + chunk_length] for i in range(0, len(graphs_cons), chunk_length)]
 
         # Run parallel calculation
-        link_chunks = pool.map(calc_link_durations, graphs_chunks)
+        link_chunks = pool.map(calc_link_runs, graphs_chunks)
 
     # Merge link durations
-    durations_merged = merge_link_durations(link_chunks, graphs_cons, chunk_length)
+    durations_merged = merge_link_durations(link_chunks)
 
     return durations_merged
 
@@ -414,50 +690,7 @@ def calc_connection_durations(graphs_cons):
     """Determines the connection durations (continuous time period during which 2 nodes have a path between them)
     and rehealing times (lengths of disconnected periods)"""
 
-    # Assumes that all graphs have the same number of nodes
-    count_nodes = graphs_cons[0].number_of_nodes()
-    size_cond = count_nodes * (count_nodes - 1) // 2
-
-    durations_matrix_con = np.zeros(size_cond, dtype=object)
-    for idx in range(durations_matrix_con.size):
-        durations_matrix_con[idx] = []
-
-    durations_matrix_discon = np.zeros(size_cond, dtype=object)
-    for idx in range(durations_matrix_discon.size):
-        durations_matrix_discon[idx] = []
-
-    active_matrix = np.zeros(size_cond, bool)
-
-    for graph_cons in graphs_cons:
-
-        # Determine all nodes that have a path between them
-        has_path_matrix = to_has_path_matrix(graph_cons)
-
-        # Search for all active connections
-        connections = []
-        for idx_u, node_u in enumerate(graph_cons.nodes()):
-            for node_v in graph_cons.nodes()[idx_u + 1:]:
-                idx_cond = utils.square_to_condensed(node_u, node_v, count_nodes)
-                is_connected = has_path_matrix[idx_cond]
-                if is_connected:
-                    if not active_matrix[idx_cond]:
-                        durations_matrix_con[idx_cond].append(0)
-                        active_matrix[idx_cond] = True
-                    durations_matrix_con[idx_cond][-1] += 1
-                    connections.append((node_u, node_v))
-                else:
-                    if active_matrix[idx_cond] or durations_matrix_discon[idx_cond] == []:
-                        durations_matrix_discon[idx_cond].append(0)
-                        active_matrix[idx_cond] = False
-                    durations_matrix_discon[idx_cond][-1] += 1
-
-    durations_con = [item for sublist in durations_matrix_con.tolist() for item in sublist]
-    durations_discon = [item for sublist in durations_matrix_discon.tolist() for item in sublist]
-
-    connection_durations = ConnectionDurations(durations_con=durations_con,
-                                               durations_discon=durations_discon,
-                                               durations_matrix_con=durations_matrix_con,
-                                               durations_matrix_discon=durations_matrix_discon)
+    connection_durations = ConnectionDurations(*runs_to_durations(calc_connection_runs(graphs_cons)))
 
     return connection_durations
 
@@ -465,25 +698,37 @@ def calc_connection_durations(graphs_cons):
 def to_has_path_matrix(graph):
     """Determine all nodes that have a path between them"""
 
-    count_nodes = graph.number_of_nodes()
-    size_cond = count_nodes * (count_nodes - 1) // 2
-    has_path_matrix = np.zeros(size_cond, dtype=bool)
-
-    # This is much faster than calling nx.has_path() for every source and destination node
-    path_lengths = nx.all_pairs_shortest_path_length(graph)
+    count_nodes = count_nodes_of(graph)
 
-    for node_u, nodes_v in path_lengths.items():
-        for node_v in nodes_v.keys():
-            if node_u <= node_v:
-                continue
-            idx_cond = utils.square_to_condensed(node_v, node_u, count_nodes)
-            has_path_matrix[idx_cond] = True
+    # Nodes have a path between them if they belong to the same connected component
+    labels = connected_component_labels(graph, count_nodes)
+    idxs_u, idxs_v = utils.triu_indices(count_nodes)
+    has_path_matrix = labels[idxs_u] == labels[idxs_v]
 
     return has_path_matrix
 
 
+def connected_component_labels(graph, count_nodes=None):
+    """Labels the nodes of the graph (or sparse connection matrix) with the index of their connected component"""
+
+    if count_nodes is None:
+        count_nodes = count_nodes_of(graph)
+
+    if sp_sparse.issparse(graph):
+        adjacency = graph
+    else:
+        edges = np.array(graph.edges(), dtype=int).reshape(-1, 2)
+        adjacency = sp_sparse.csr_matrix((np.ones(edges.shape[0], dtype=bool), (edges[:, 0], edges[:, 1])),
+                                         shape=(count_nodes, count_nodes))
+    _, labels = sp_csgraph.connected_components(adjacency, directed=False)
+
+    return labels
+
+
 def calc_connection_durations_multiprocess(graphs_cons, processes=None, chunk_length=None):
-    """Determines the connection durations using multiple processes. See also: calc_connection_durations"""
+    """Determines the connection durations using multiple processes. See also: calc_connection_durations.
+    Since reachability is determined by labeling the connected components, a single process is fast enough for most
+    network sizes"""
 
     # Process chunks in parallel
     with mp.Pool(processes=processes) as pool:
@@ -496,104 +741,28 @@ def calc_connection_durations_multiprocess(graphs_cons, processes=None, chunk_le
         graphs_chunks = [graphs_cons[i:i + chunk_length] for i in range(0, len(graphs_cons), chunk_length)]
 
         # Run parallel calculation
-        connection_chunks = pool.map(calc_connection_durations, graphs_chunks)
+        connection_chunks = pool.map(calc_connection_runs, graphs_chunks)
 
     # Merge link durations
-    durations_merged = merge_connection_durations(connection_chunks, graphs_cons, chunk_length)
+    durations_merged = merge_connection_durations(connection_chunks)
 
     return durations_merged
 
 
-def merge_link_durations(link_chunks, graphs_cons, chunk_length):
-    """Merges the link duration chunks from multiprocessing"""
+def merge_link_durations(link_chunks):
+    """Merges the link duration chunks from multiprocessing. Only the periods and the connection states at the chunk
+    boundaries are needed, the graphs are not accessed"""
 
-    size_cond = link_chunks[0].durations_matrix_con.size
-    durations_matrix_con = np.zeros(size_cond, dtype=object)
-    durations_matrix_discon = np.zeros(size_cond, dtype=object)
-
-    for idx_link in range(size_cond):
-        link_pair_durations_con = link_chunks[0].durations_matrix_con[idx_link]
-        link_pair_durations_discon = link_chunks[0].durations_matrix_discon[idx_link]
-        idx_square1, idx_square2 = utils.condensed_to_square(idx_link, graphs_cons[0].number_of_nodes())
-        for idx_chunk in range(1, len(link_chunks)):
-            link_pair_durations_con_iter = link_chunks[idx_chunk].durations_matrix_con[idx_link]
-            link_pair_durations_discon_iter = link_chunks[idx_chunk].durations_matrix_discon[idx_link]
-            idx_graph = chunk_length * idx_chunk
-
-            has_edge_1 = graphs_cons[idx_graph].has_edge(idx_square1, idx_square2)
-            has_edge_2 = graphs_cons[idx_graph - 1].has_edge(idx_square1, idx_square2)
-            to_merge_con = has_edge_1 and has_edge_2
-            to_merge_discon = not (has_edge_1 or has_edge_2)
-
-            if to_merge_con:
-                link_pair_durations_con[-1] += link_pair_durations_con_iter[0]
-                link_pair_durations_con_iter.pop(0)
-
-            if to_merge_discon:
-                link_pair_durations_discon[-1] += link_pair_durations_discon_iter[0]
-                link_pair_durations_discon_iter.pop(0)
-
-            link_pair_durations_con += link_pair_durations_con_iter
-            link_pair_durations_discon += link_pair_durations_discon_iter
-
-        durations_matrix_con[idx_link] = link_pair_durations_con
-        durations_matrix_discon[idx_link] = link_pair_durations_discon
-
-    durations_con = [item for sublist in durations_matrix_con.tolist() for item in sublist]
-    durations_discon = [item for sublist in durations_matrix_discon.tolist() for item in sublist]
-
-    link_durations = LinkDurations(durations_con=durations_con,
-                                   durations_discon=durations_discon,
-                                   durations_matrix_con=durations_matrix_con,
-                                   durations_matrix_discon=durations_matrix_discon)
+    link_durations = LinkDurations(*runs_to_durations(merge_runs(link_chunks)))
 
     return link_durations
 
 
-def merge_connection_durations(connection_chunks, graphs_cons, chunk_length):
-    """Merges the connection duration chunks from multiprocessing"""
-
-    size_cond = connection_chunks[0].durations_matrix_con.size
-    durations_matrix_con = np.zeros(size_cond, dtype=object)
-    durations_matrix_discon = np.zeros(size_cond, dtype=object)
-
-    for idx_link in range(size_cond):
-        connection_pair_durations_con = connection_chunks[0].durations_matrix_con[idx_link]
-        connection_pair_durations_discon = connection_chunks[0].durations_matrix_discon[idx_link]
-        idx_square1, idx_square2 = utils.condensed_to_square(idx_link, graphs_cons[0].number_of_nodes())
-        for idx_chunk in range(1, len(connection_chunks)):
-            connection_pair_durations_con_iter = connection_chunks[idx_chunk].durations_matrix_con[idx_link]
-            connection_pair_durations_discon_iter = connection_chunks[idx_chunk].durations_matrix_discon[idx_link]
-            idx_graph = chunk_length * idx_chunk
-
-            # TODO: change following 2 lines to use to_has_path_matrix
-            has_path_1 = nx.has_path(graphs_cons[idx_graph], idx_square1, idx_square2)
-            has_path_2 = nx.has_path(graphs_cons[idx_graph - 1], idx_square1, idx_square2)
-
-            to_merge_con = has_path_1 and has_path_2
-            to_merge_discon = not (has_path_1 or has_path_2)
-
-            if to_merge_con:
-                connection_pair_durations_con[-1] += connection_pair_durations_con_iter[0]
-                connection_pair_durations_con_iter.pop(0)
-
-            if to_merge_discon:
-                connection_pair_durations_discon[-1] += connection_pair_durations_discon_iter[0]
-                connection_pair_durations_discon_iter.pop(0)
-
-            connection_pair_durations_con += connection_pair_durations_con_iter
-            connection_pair_durations_discon += connection_pair_durations_discon_iter
-
-        durations_matrix_con[idx_link] = connection_pair_durations_con
-        durations_matrix_discon[idx_link] = connection_pair_durations_discon
-
-    durations_con = [item for sublist in durations_matrix_con.tolist() for item in sublist]
-    durations_discon = [item for sublist in durations_matrix_discon.tolist() for item in sublist]
+def merge_connection_durations(connection_chunks):
+    """Merges the connection duration chunks from multiprocessing. Only the periods and the connection states at the
+    chunk boundaries are needed, the graphs are not accessed"""
 
-    connection_durations = LinkDurations(durations_con=durations_con,
-                                         durations_discon=durations_discon,
-                                         durations_matrix_con=durations_matrix_con,
-                                         durations_matrix_discon=durations_matrix_discon)
+    connection_durations = ConnectionDurations(*runs_to_durations(merge_runs(connection_chunks)))
 
     return connection_durations
 
@@ -23,8 +23,14 @@ def simulate(network, max_pl=150):
 
     # Initialize
     vehs = network['vehs']
-    graph_streets_wave = network['graph_streets_wave']
-    gdf_buildings = network['gdf_buildings']
+    if network.get('routes_wave') is not None:
+        routes_wave = network['routes_wave']
+    else:
+        routes_wave = prop.RouteTable(network['graph_streets_wave'])
+    if 'index_buildings' in network:
+        index_buildings = network['index_buildings']
+    else:
+        index_buildings = geom_o.BuildingIndex(network['gdf_buildings'])
     count_veh = vehs.count
     vehs.allocate(count_veh)
 
@@ -39,7 +45,7 @@ def simulate(network, max_pl=150):
     # Determine propagation conditions
     time_start = utils.debug(None, 'Determining propagation conditions')
     is_nlos = prop.veh_cons_are_nlos(vehs.get_points('center'),
-                                     vehs.get_points('other'), gdf_buildings)
+                                     vehs.get_points('other'), index_buildings)
     vehs.add_key('nlos', idxs_other_vehs[is_nlos])
     is_olos_los = np.invert(is_nlos)
     vehs.add_key('olos_los', idxs_other_vehs[is_olos_los])
@@ -59,7 +65,7 @@ def simulate(network, max_pl=150):
     time_start = utils.debug(None, 'Determining orthogonal and parallel')
 
     is_orthogonal, coords_intersections = \
-        prop.check_if_cons_are_orthogonal(graph_streets_wave,
+        prop.check_if_cons_are_orthogonal(routes_wave,
                                           vehs.get_graph('center'),
                                           vehs.get_graph('nlos'),
                                           max_angle=np.pi)
@@ -1,7 +1,687 @@
 """Geometrical functionality"""
 
 import numpy as np
+import shapely.geometry as geom
 import shapely.ops as ops
+from scipy.spatial import cKDTree
+from shapely.strtree import STRtree
+
+
+class BuildingIndex:
+    """Spatial index of building geometries.
+    Candidate buildings are found by querying their bounding boxes in an STR tree and only the candidates are
+    checked for an exact intersection.
+    Additionally the outlines of all buildings are stored as a table of edges that are assigned to the cells of a
+    uniform grid. This allows to check many lines at once with array operations, see `lines_intersect_buildings`.
+
+    Parameters
+    ----------
+    buildings : geopandas.GeoDataFrame
+        Buildings inside a geodata frame
+    cell_size : float, optional
+        Edge length of the grid cells
+    """
+
+    def __init__(self, buildings, cell_size=25):
+        self.geometries = [geometry for geometry in buildings.geometry
+                           if geometry is not None and not geometry.is_empty]
+        self.tree = STRtree(self.geometries)
+        self.cell_size = cell_size
+        self.build_grid()
+
+    def __getstate__(self):
+        # The STR tree holds GEOS pointers and can not be pickled, it is rebuilt after unpickling
+        state = self.__dict__.copy()
+        del state['tree']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tree = STRtree(self.geometries)
+        # Indices saved before the edge table was introduced
+        if 'edges' not in state:
+            self.cell_size = 25
+            self.build_grid()
+
+    def build_grid(self):
+        """Builds the table of building edges and assigns the edges to the cells of the grid"""
+
+        edges = [np.zeros((0, 4))]
+        for geometry in self.geometries:
+            for coords in outline_coords(geometry):
+                edges.append(np.hstack((coords[:-1], coords[1:])))
+        self.edges = np.concatenate(edges)
+
+        if self.edges.shape[0] == 0:
+            self.grid_origin = np.zeros(2)
+            self.grid_shape = (0, 0)
+            self.cell_starts = np.zeros(1, dtype=int)
+            self.cell_edges = np.zeros(0, dtype=int)
+            return
+
+        self.grid_origin, self.grid_shape, self.cell_edges, self.cell_starts = \
+            grid_lines(self.edges[:, 0:2], self.edges[:, 2:4], self.cell_size)
+
+    def cells_along_lines(self, coords_start, coords_end):
+        """Determines the grid cells touched by the straight lines from `coords_start` to `coords_end`. Cells outside
+        of the grid are omitted.
+
+        Parameters
+        ----------
+        coords_start : numpy.ndarray
+            Start coordinates of the lines
+        coords_end : numpy.ndarray
+            End coordinates of the lines
+
+        Returns
+        -------
+        idxs_line : numpy.ndarray
+            Line index of every line/cell combination
+        idxs_cell : numpy.ndarray
+            Linear cell index of every line/cell combination
+        """
+
+        idxs_line, cols, rows = cells_along_lines(coords_start, coords_end, self.grid_origin, self.cell_size)
+        in_grid = (cols >= 0) & (cols < self.grid_shape[0]) & (rows >= 0) & (rows < self.grid_shape[1])
+        idxs_cell = cols[in_grid] * self.grid_shape[1] + rows[in_grid]
+
+        return idxs_line[in_grid], idxs_cell
+
+    def candidate_edges(self, coords_start, coords_end):
+        """Determines the building edges that lie in the same grid cells as the straight lines from `coords_start` to
+        `coords_end`.
+
+        Parameters
+        ----------
+        coords_start : numpy.ndarray
+            Start coordinates of the lines
+        coords_end : numpy.ndarray
+            End coordinates of the lines
+
+        Returns
+        -------
+        idxs_line : numpy.ndarray
+            Line index of every line/edge combination
+        idxs_edge : numpy.ndarray
+            Edge index of every line/edge combination
+        """
+
+        idxs_line, idxs_cell = self.cells_along_lines(coords_start, coords_end)
+        counts = self.cell_starts[idxs_cell + 1] - self.cell_starts[idxs_cell]
+        idxs_line = np.repeat(idxs_line, counts)
+        idxs_edge = self.cell_edges[np.repeat(self.cell_starts[idxs_cell], counts) + ragged_arange(counts)]
+
+        return idxs_line, idxs_edge
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def query(self, geometry):
+        """Returns the buildings whose bounding boxes intersect the bounding box of `geometry`.
+
+        Parameters
+        ----------
+        geometry : shapely.geometry.base.BaseGeometry
+
+        Returns
+        -------
+        candidates : list of shapely.geometry.base.BaseGeometry
+            Candidate buildings
+        """
+
+        candidates = self.tree.query(geometry)
+        # Shapely >= 2.0 returns the indices of the candidates instead of the geometries
+        if isinstance(candidates, np.ndarray) and np.issubdtype(candidates.dtype, np.integer):
+            candidates = [self.geometries[idx] for idx in candidates]
+
+        return candidates
+
+    def intersects(self, geometry):
+        """Returns `True` if `geometry` intersects with any of the buildings.
+
+        Parameters
+        ----------
+        geometry : shapely.geometry.base.BaseGeometry
+
+        Returns
+        -------
+        intersects : bool
+            True if `geometry` intersects buildings, otherwise false
+        """
+
+        for candidate in self.query(geometry):
+            if geometry.intersects(candidate):
+                return True
+
+        return False
+
+
+class StreetIndex:
+    """Spatial index of the street geometries of a streets graph.
+    The geometries of all streets are flattened into a table of segments that are assigned to the cells of a uniform
+    grid. This allows to snap many points to their closest streets at once, see `snap`.
+    Only these arrays and the end nodes of the streets are kept, not the streets graph, so the index stays small when
+    it is pickled. Indexing the index returns a street in the format of `graph_streets.edges(data=True)`.
+
+    Parameters
+    ----------
+    graph_streets : networkx.MultiDiGraph
+        Street network graph generated by osmnx
+    cell_size : float, optional
+        Edge length of the grid cells
+    """
+
+    def __init__(self, graph_streets, cell_size=25):
+        self.cell_size = cell_size
+
+        streets = graph_streets.edges(data=True)
+        if len(streets) == 0:
+            raise ValueError('Streets graph without streets')
+
+        segments = []
+        segment_offsets = []
+        self.street_nodes = [street[0:2] for street in streets]
+        counts = np.zeros(len(streets), dtype=int)
+        self.lengths = np.zeros(len(streets))
+        self.geometry_lengths = np.zeros(len(streets))
+        for idx, street in enumerate(streets):
+            coords = np.array(street[2]['geometry'].coords)[:, 0:2]
+            lengths = np.linalg.norm(np.diff(coords, axis=0), ord=2, axis=1)
+            segments.append(np.hstack((coords[:-1], coords[1:])))
+            segment_offsets.append(np.cumsum(lengths) - lengths)
+            counts[idx] = lengths.size
+            self.lengths[idx] = street[2]['length']
+            self.geometry_lengths[idx] = np.sum(lengths)
+
+        self.count_streets = len(streets)
+        self.segments = np.concatenate(segments)
+        self.segment_offsets = np.concatenate(segment_offsets)
+        self.segment_streets = np.repeat(np.arange(len(streets)), counts)
+        self.street_starts = np.append(0, np.cumsum(counts))
+
+        self.grid_origin, self.grid_shape, self.cell_segments, self.cell_starts = \
+            grid_lines(self.segments[:, 0:2], self.segments[:, 2:4], self.cell_size)
+
+    def __len__(self):
+        return self.count_streets
+
+    def __getitem__(self, street_idx):
+        """Returns the street with the index `street_idx` as a tuple of its end nodes and its data (geometry and
+        length)"""
+
+        idxs_segment = slice(self.street_starts[street_idx], self.street_starts[street_idx + 1])
+        coords = np.vstack((self.segments[idxs_segment, 0:2], self.segments[self.street_starts[street_idx + 1] - 1,
+                                                                            2:4]))
+        data = {'geometry': geom.LineString(coords), 'length': self.lengths[street_idx]}
+
+        return self.street_nodes[street_idx] + (data,)
+
+    def interpolate(self, street_idxs, offsets):
+        """Determines the coordinates of the positions at the offsets along the streets.
+
+        Parameters
+        ----------
+        street_idxs : numpy.ndarray
+            Indices of the streets
+        offsets : numpy.ndarray
+            Distances of the positions from the start of the streets
+
+        Returns
+        -------
+        coords : numpy.ndarray
+            Coordinates of the positions
+        """
+
+        street_idxs = np.asarray(street_idxs, dtype=int).reshape(-1)
+        if street_idxs.size == 0:
+            return np.zeros((0, 2))
+        offsets = np.clip(np.asarray(offsets, dtype=float).reshape(-1), 0, self.geometry_lengths[street_idxs])
+
+        # Last segment of the street that starts before the offset
+        idxs_first = self.street_starts[street_idxs]
+        idxs_last = self.street_starts[street_idxs + 1] - 1
+        counts = idxs_last - idxs_first + 1
+        idxs_segment = np.repeat(idxs_first, counts) + ragged_arange(counts)
+        starts_before = self.segment_offsets[idxs_segment] <= np.repeat(offsets, counts)
+        idxs_segment = idxs_first + np.add.reduceat(starts_before, np.cumsum(counts) - counts) - 1
+        idxs_segment = np.clip(idxs_segment, idxs_first, idxs_last)
+
+        coords_start = self.segments[idxs_segment, 0:2]
+        delta = self.segments[idxs_segment, 2:4] - coords_start
+        length = np.linalg.norm(delta, ord=2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(length > 0, (offsets - self.segment_offsets[idxs_segment]) / length, 0)
+        ratio = np.clip(ratio, 0, 1)
+
+        return coords_start + ratio[:, np.newaxis] * delta
+
+    def snap(self, coords, max_rings=8, max_combinations=2 ** 20, eps=1e-9):
+        """Determines the closest street of every point and the closest position on it.
+
+        Parameters
+        ----------
+        coords : numpy.ndarray
+            Coordinates of the points
+        max_rings : int, optional
+            Number of rings of grid cells around the points that are searched. The closest streets of points that are
+            further away from all streets are searched without the grid.
+        max_combinations : int, optional
+            Maximum number of point/segment combinations that are checked at once when searching without the grid.
+            Limits the memory usage.
+        eps : float, optional
+            Streets that are closer than the closest street plus `eps` are considered equally close. The street with
+            the smallest index is chosen.
+
+        Returns
+        -------
+        street_idxs : numpy.ndarray
+            Index of the closest street
+        offsets : numpy.ndarray
+            Distance of the closest position from the start of the street
+        coords_snapped : numpy.ndarray
+            Coordinates of the closest position on the street
+        """
+
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        count_points = coords.shape[0]
+        distances_min = np.full(count_points, np.inf)
+        idxs_segment = np.zeros(count_points, dtype=int)
+        cells = np.floor((coords - self.grid_origin) / self.cell_size).astype(int)
+
+        # Search the rings of cells around the points until no closer street can exist
+        idxs_todo = np.arange(count_points)
+        for ring in range(max_rings + 1):
+            if idxs_todo.size == 0:
+                break
+
+            offsets_ring = np.array([(col, row) for col in range(-ring, ring + 1) for row in range(-ring, ring + 1)
+                                     if max(abs(col), abs(row)) == ring], dtype=int).reshape(-1, 2)
+            idxs_point = np.repeat(idxs_todo, offsets_ring.shape[0])
+            cols = cells[idxs_point, 0] + np.tile(offsets_ring[:, 0], idxs_todo.size)
+            rows = cells[idxs_point, 1] + np.tile(offsets_ring[:, 1], idxs_todo.size)
+            in_grid = (cols >= 0) & (cols < self.grid_shape[0]) & (rows >= 0) & (rows < self.grid_shape[1])
+            idxs_point = idxs_point[in_grid]
+            idxs_cell = cols[in_grid] * self.grid_shape[1] + rows[in_grid]
+
+            counts = self.cell_starts[idxs_cell + 1] - self.cell_starts[idxs_cell]
+            idxs_point = np.repeat(idxs_point, counts)
+            idxs_candidate = self.cell_segments[np.repeat(self.cell_starts[idxs_cell], counts) + ragged_arange(counts)]
+            self.update_closest(coords, idxs_point, idxs_candidate, distances_min, idxs_segment, eps)
+
+            is_done = distances_min[idxs_todo] + eps < ring * self.cell_size
+            idxs_todo = idxs_todo[~is_done]
+
+        # Points far away from all streets
+        count_segments = self.segments.shape[0]
+        chunk_size_points = max(1, max_combinations // count_segments)
+        chunk_size_segments = min(count_segments, max_combinations)
+        for idx_chunk in range(0, idxs_todo.size, chunk_size_points):
+            idxs_chunk = idxs_todo[idx_chunk:idx_chunk + chunk_size_points]
+            for idx_first in range(0, count_segments, chunk_size_segments):
+                idxs_chunk_segments = np.arange(idx_first, min(idx_first + chunk_size_segments, count_segments))
+                idxs_point = np.repeat(idxs_chunk, idxs_chunk_segments.size)
+                idxs_candidate = np.tile(idxs_chunk_segments, idxs_chunk.size)
+                self.update_closest(coords, idxs_point, idxs_candidate, distances_min, idxs_segment, eps)
+
+        # Project the points onto their closest segments
+        coords_start = self.segments[idxs_segment, 0:2]
+        delta = self.segments[idxs_segment, 2:4] - coords_start
+        length_sq = np.sum(delta ** 2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.sum((coords - coords_start) * delta, axis=1) / length_sq
+        ratio = np.where(length_sq > 0, np.clip(ratio, 0, 1), 0)
+        coords_snapped = coords_start + ratio[:, np.newaxis] * delta
+        offsets = self.segment_offsets[idxs_segment] + ratio * np.sqrt(length_sq)
+
+        return self.segment_streets[idxs_segment], offsets, coords_snapped
+
+    def update_closest(self, coords, idxs_point, idxs_candidate, distances_min, idxs_segment, eps):
+        """Updates the closest segments of the points with the candidate segments in place"""
+
+        if idxs_point.size == 0:
+            return
+
+        distances = points_to_segments_distance(coords[idxs_point],
+                                                self.segments[idxs_candidate, 0:2],
+                                                self.segments[idxs_candidate, 2:4])
+
+        # Include the closest segments found so far
+        idxs_found = np.unique(idxs_point)
+        idxs_found = idxs_found[np.isfinite(distances_min[idxs_found])]
+        idxs_point = np.append(idxs_point, idxs_found)
+        idxs_candidate = np.append(idxs_candidate, idxs_segment[idxs_found])
+        distances = np.append(distances, distances_min[idxs_found])
+
+        distances_new = np.full(distances_min.size, np.inf)
+        np.minimum.at(distances_new, idxs_point, distances)
+
+        # Segments are ordered by street, the smallest segment index belongs to the smallest street index
+        is_closest = distances <= distances_new[idxs_point] + eps
+        idxs_segment_new = np.full(distances_min.size, self.segments.shape[0])
+        np.minimum.at(idxs_segment_new, idxs_point[is_closest], idxs_candidate[is_closest])
+
+        is_updated = np.isfinite(distances_new)
+        distances_min[is_updated] = distances_new[is_updated]
+        idxs_segment[is_updated] = idxs_segment_new[is_updated]
+
+
+def lines_intersect_buildings(coords_start, coords_end, buildings, chunk_size=4096):
+    """Returns for every straight line from `coords_start` to `coords_end` if it intersects with any of the
+    `buildings`. This is the vectorized equivalent of `line_intersects_buildings`.
+
+    Parameters
+    ----------
+    coords_start : numpy.ndarray
+        Start coordinates of the lines
+    coords_end : numpy.ndarray
+        End coordinates of the lines
+    buildings : geopandas.GeoDataFrame or BuildingIndex
+        Buildings inside a geodata frame or their spatial index
+    chunk_size : int, optional
+        Number of lines that are processed at once. Limits the memory usage.
+
+    Returns
+    -------
+    intersects : numpy.ndarray
+        True for every line that intersects buildings, otherwise false
+
+    Notes
+    -----
+    A line intersects a building if it crosses or touches the outline of the building or if it starts inside of it.
+    """
+
+    index_buildings = get_building_index(buildings)
+    coords_start = np.asarray(coords_start, dtype=float).reshape(-1, 2)
+    coords_end = np.asarray(coords_end, dtype=float).reshape(-1, 2)
+    count_lines = coords_start.shape[0]
+
+    # Lines starting inside of a building do not necessarily cross its outline
+    coords_start_unique, idxs_start_unique = np.unique(coords_start, axis=0, return_inverse=True)
+    start_inside = np.zeros(coords_start_unique.shape[0], dtype=bool)
+    for idx, coords in enumerate(coords_start_unique):
+        start_inside[idx] = index_buildings.intersects(geom.Point(coords))
+    intersects = start_inside[idxs_start_unique.reshape(-1)]
+
+    edges = index_buildings.edges
+    for idx_chunk in range(0, count_lines, chunk_size):
+        chunk = slice(idx_chunk, idx_chunk + chunk_size)
+        idxs_line, idxs_edge = index_buildings.candidate_edges(coords_start[chunk], coords_end[chunk])
+        idxs_line += idx_chunk
+        hits = segments_intersect(coords_start[idxs_line],
+                                  coords_end[idxs_line],
+                                  edges[idxs_edge, 0:2],
+                                  edges[idxs_edge, 2:4])
+        intersects[idxs_line[hits]] = True
+
+    return intersects
+
+
+def pairs_in_range(coords, max_dist):
+    """Determines all pairs of coordinates that are less than `max_dist` apart using a k-d tree. Pairs further apart
+    are never enumerated.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        Coordinates
+    max_dist : float
+        Maximum distance between the coordinates of a pair (exclusive)
+
+    Returns
+    -------
+    idxs_1 : numpy.ndarray
+        Index of the first coordinates of every pair
+    idxs_2 : numpy.ndarray
+        Index of the second coordinates of every pair, always greater than `idxs_1`
+    """
+
+    tree = cKDTree(coords)
+    pairs = np.array(list(tree.query_pairs(max_dist)), dtype=int).reshape(-1, 2)
+    pairs.sort(axis=1)
+
+    # The k-d tree also returns pairs exactly at the maximum distance
+    distances = np.linalg.norm(coords[pairs[:, 0]] - coords[pairs[:, 1]], ord=2, axis=1)
+    pairs = pairs[distances < max_dist]
+
+    return pairs[:, 0], pairs[:, 1]
+
+
+def segments_intersect(coords_start_1, coords_end_1, coords_start_2, coords_end_2):
+    """Determines elementwise if the segments 1 and the segments 2 intersect, including touching segments.
+
+    Parameters
+    ----------
+    coords_start_1 : numpy.ndarray
+        Start coordinates of the segments 1
+    coords_end_1 : numpy.ndarray
+        End coordinates of the segments 1
+    coords_start_2 : numpy.ndarray
+        Start coordinates of the segments 2
+    coords_end_2 : numpy.ndarray
+        End coordinates of the segments 2
+
+    Returns
+    -------
+    intersects : numpy.ndarray
+        True where the segments intersect, otherwise false
+    """
+
+    def orientation(coords_a, coords_b, coords_c):
+        """Determines the cross product of b - a and c - a"""
+        return (coords_b[:, 0] - coords_a[:, 0]) * (coords_c[:, 1] - coords_a[:, 1]) - \
+               (coords_b[:, 1] - coords_a[:, 1]) * (coords_c[:, 0] - coords_a[:, 0])
+
+    orient_1_start = orientation(coords_start_2, coords_end_2, coords_start_1)
+    orient_1_end = orientation(coords_start_2, coords_end_2, coords_end_1)
+    orient_2_start = orientation(coords_start_1, coords_end_1, coords_start_2)
+    orient_2_end = orientation(coords_start_1, coords_end_1, coords_end_2)
+
+    intersects = np.logical_and(orient_1_start * orient_1_end <= 0,
+                                orient_2_start * orient_2_end <= 0)
+
+    # Collinear segments only intersect if their extents overlap
+    is_collinear = (orient_1_start == 0) & (orient_1_end == 0) & (orient_2_start == 0) & (orient_2_end == 0)
+    overlaps = np.ones(is_collinear.shape, dtype=bool)
+    for dim in range(2):
+        overlaps &= np.maximum(coords_start_1[:, dim], coords_end_1[:, dim]) >= \
+                    np.minimum(coords_start_2[:, dim], coords_end_2[:, dim])
+        overlaps &= np.maximum(coords_start_2[:, dim], coords_end_2[:, dim]) >= \
+                    np.minimum(coords_start_1[:, dim], coords_end_1[:, dim])
+    intersects[is_collinear] = overlaps[is_collinear]
+
+    return intersects
+
+
+def grid_lines(coords_start, coords_end, cell_size):
+    """Assigns the straight lines from `coords_start` to `coords_end` to the cells of a uniform grid that covers all
+    lines.
+
+    Parameters
+    ----------
+    coords_start : numpy.ndarray
+        Start coordinates of the lines
+    coords_end : numpy.ndarray
+        End coordinates of the lines
+    cell_size : float
+        Edge length of the grid cells
+
+    Returns
+    -------
+    origin : numpy.ndarray
+        Coordinates of the lower left corner of the cell (0, 0)
+    shape : tuple
+        Number of columns and rows of the grid
+    cell_lines : numpy.ndarray
+        Indices of the lines sorted by the linear index (column * rows + row) of their cells
+    cell_starts : numpy.ndarray
+        Position of the first line of every cell in `cell_lines`, the lines of cell i are
+        `cell_lines[cell_starts[i]:cell_starts[i + 1]]`
+    """
+
+    coords_min = np.minimum(coords_start.min(axis=0), coords_end.min(axis=0))
+    coords_max = np.maximum(coords_start.max(axis=0), coords_end.max(axis=0))
+    origin = coords_min
+    shape = tuple((np.floor((coords_max - coords_min) / cell_size) + 1).astype(int))
+
+    idxs_line, cols, rows = cells_along_lines(coords_start, coords_end, origin, cell_size)
+    in_grid = (cols >= 0) & (cols < shape[0]) & (rows >= 0) & (rows < shape[1])
+    idxs_line = idxs_line[in_grid]
+    idxs_cell = cols[in_grid] * shape[1] + rows[in_grid]
+
+    order = np.argsort(idxs_cell, kind='mergesort')
+    cell_lines = idxs_line[order]
+    cell_starts = np.append(0, np.cumsum(np.bincount(idxs_cell, minlength=shape[0] * shape[1])))
+
+    return origin, shape, cell_lines, cell_starts
+
+
+def cells_along_lines(coords_start, coords_end, origin, cell_size, eps=1e-9):
+    """Determines all cells of a uniform grid that are touched by the straight lines from `coords_start` to
+    `coords_end`. Cells on the border of a line are included.
+
+    Parameters
+    ----------
+    coords_start : numpy.ndarray
+        Start coordinates of the lines
+    coords_end : numpy.ndarray
+        End coordinates of the lines
+    origin : numpy.ndarray
+        Coordinates of the lower left corner of the cell (0, 0)
+    cell_size : float
+        Edge length of the grid cells
+    eps : float, optional
+        Margin in cell units that is added to the lines to be robust against floating point errors
+
+    Returns
+    -------
+    idxs_line : numpy.ndarray
+        Line index of every line/cell combination
+    cols : numpy.ndarray
+        Column (x) index of every line/cell combination
+    rows : numpy.ndarray
+        Row (y) index of every line/cell combination
+    """
+
+    start = (np.asarray(coords_start, dtype=float).reshape(-1, 2) - origin) / cell_size
+    end = (np.asarray(coords_end, dtype=float).reshape(-1, 2) - origin) / cell_size
+    x_min = np.minimum(start[:, 0], end[:, 0])
+    x_max = np.maximum(start[:, 0], end[:, 0])
+
+    # Determine all columns of every line
+    col_first = np.floor(x_min - eps).astype(int)
+    counts_col = np.floor(x_max + eps).astype(int) - col_first + 1
+    idxs_line = np.repeat(np.arange(start.shape[0]), counts_col)
+    cols = col_first[idxs_line] + ragged_arange(counts_col)
+
+    # Determine the y extent of every line inside every column
+    start_col = start[idxs_line]
+    end_col = end[idxs_line]
+    delta = end_col - start_col
+    is_vertical = delta[:, 0] == 0
+    x_lo = np.maximum(cols, x_min[idxs_line])
+    x_hi = np.minimum(cols + 1, x_max[idxs_line])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = delta[:, 1] / delta[:, 0]
+        y_lo = np.where(is_vertical, start_col[:, 1], start_col[:, 1] + (x_lo - start_col[:, 0]) * slope)
+        y_hi = np.where(is_vertical, end_col[:, 1], start_col[:, 1] + (x_hi - start_col[:, 0]) * slope)
+    y_min = np.minimum(y_lo, y_hi)
+    y_max = np.maximum(y_lo, y_hi)
+
+    # Determine all rows of every column
+    row_first = np.floor(y_min - eps).astype(int)
+    counts_row = np.floor(y_max + eps).astype(int) - row_first + 1
+    idxs_col = np.repeat(np.arange(cols.size), counts_row)
+    rows = row_first[idxs_col] + ragged_arange(counts_row)
+
+    return idxs_line[idxs_col], cols[idxs_col], rows
+
+
+def ragged_arange(counts):
+    """Concatenates ranges with the lengths `counts`, e.g. [2, 3] results in [0, 1, 0, 1, 2].
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        Lengths of the ranges
+
+    Returns
+    -------
+    ranges : numpy.ndarray
+        Concatenated ranges
+    """
+
+    counts = np.asarray(counts, dtype=int)
+    offsets = np.cumsum(counts) - counts
+    return np.arange(np.sum(counts)) - np.repeat(offsets, counts)
+
+
+def outline_coords(geometry):
+    """Returns the coordinates of all the lines that make up the outline of the `geometry`.
+
+    Parameters
+    ----------
+    geometry : shapely.geometry.base.BaseGeometry
+
+    Returns
+    -------
+    coords_list : list of numpy.ndarray
+        Coordinates of the lines
+    """
+
+    if isinstance(geometry, geom.Polygon):
+        rings = [geometry.exterior] + list(geometry.interiors)
+        return [np.array(ring.coords)[:, 0:2] for ring in rings]
+    elif isinstance(geometry, (geom.LineString, geom.LinearRing)):
+        return [np.array(geometry.coords)[:, 0:2]]
+    elif isinstance(geometry, geom.Point):
+        return [np.array(geometry.coords)[[0, 0], 0:2]]
+    elif hasattr(geometry, 'geoms'):
+        coords_list = []
+        for geometry_part in geometry.geoms:
+            coords_list += outline_coords(geometry_part)
+        return coords_list
+    else:
+        raise NotImplementedError('Geometry type not supported')
+
+
+def get_building_index(buildings):
+    """Returns a spatial index of the `buildings`. If `buildings` already is an index it is returned unchanged.
+
+    Parameters
+    ----------
+    buildings : geopandas.GeoDataFrame or BuildingIndex
+        Buildings inside a geodata frame or their spatial index
+
+    Returns
+    -------
+    index_buildings : BuildingIndex
+        Spatial index of the buildings
+    """
+
+    if isinstance(buildings, BuildingIndex):
+        return buildings
+
+    return BuildingIndex(buildings)
+
+
+def get_street_index(graph_streets):
+    """Returns a spatial index of the streets. If `graph_streets` already is an index it is returned unchanged.
+
+    Parameters
+    ----------
+    graph_streets : networkx.MultiDiGraph or StreetIndex
+        Street network graph generated by osmnx or its spatial index
+
+    Returns
+    -------
+    index_streets : StreetIndex
+        Spatial index of the streets
+    """
+
+    if isinstance(graph_streets, StreetIndex):
+        return graph_streets
+
+    return StreetIndex(graph_streets)
 
 
 def line_intersects_buildings(line, buildings):
@@ -11,15 +691,17 @@ def line_intersects_buildings(line, buildings):
     ----------
     line : shapely.geometry.LineString
         Geometrical line
-    buildings : geopandas.GeoDataFrame
-        Buildings inside a geodata frame
+    buildings : geopandas.GeoDataFrame or BuildingIndex
+        Buildings inside a geodata frame or their spatial index. Passing an index avoids testing every building.
 
     Returns
     -------
     intersects : bool
         True if `line` intersects buildings, otherwise false
     """
-    """ """
+
+    if isinstance(buildings, BuildingIndex):
+        return buildings.intersects(line)
 
     intersects = False
     for geometry in buildings.geometry:
@@ -60,6 +742,122 @@ def line_intersects_points(line, points, margin=1):
     return intersects
 
 
+def lines_intersect_points(coords_start, coords_end, coords_points, margin=1, idxs_exclude=None, cell_size=25,
+                           chunk_size=4096):
+    """Returns for every straight line from `coords_start` to `coords_end` if it intersects with any of the points
+    within a `margin`. This is the vectorized equivalent of `line_intersects_points`.
+
+    Parameters
+    ----------
+    coords_start : numpy.ndarray
+        Start coordinates of the lines
+    coords_end : numpy.ndarray
+        End coordinates of the lines
+    coords_points : numpy.ndarray
+        Coordinates of the points
+    margin : float, optional
+        The maximum margin between the lines and the points
+    idxs_exclude : numpy.ndarray, optional
+        Indices of the points that are ignored for each line, e.g. the points the line connects. One row per line.
+    cell_size : float, optional
+        Edge length of the grid cells that are used to find candidate points for each line
+    chunk_size : int, optional
+        Number of lines that are processed at once. Limits the memory usage.
+
+    Returns
+    -------
+    intersects : numpy.ndarray
+        True for every line that intersects points, otherwise false
+
+    Notes
+    -----
+    Only points whose margin overlaps with a grid cell touched by a line are candidates for this line. For the
+    candidates the exact distance between the point and the line is compared to the `margin`.
+    """
+
+    coords_start = np.asarray(coords_start, dtype=float).reshape(-1, 2)
+    coords_end = np.asarray(coords_end, dtype=float).reshape(-1, 2)
+    coords_points = np.asarray(coords_points, dtype=float).reshape(-1, 2)
+    count_lines = coords_start.shape[0]
+    intersects = np.zeros(count_lines, dtype=bool)
+
+    if count_lines == 0 or coords_points.shape[0] == 0:
+        return intersects
+
+    if idxs_exclude is not None:
+        idxs_exclude = np.asarray(idxs_exclude, dtype=int).reshape(count_lines, -1)
+
+    # Assign every point to all cells its margin overlaps
+    grid_origin = coords_points.min(axis=0) - margin
+    grid_shape = np.floor((coords_points.max(axis=0) + margin - grid_origin) / cell_size).astype(int) + 1
+    cell_first = np.floor((coords_points - margin - grid_origin) / cell_size).astype(int)
+    cell_last = np.floor((coords_points + margin - grid_origin) / cell_size).astype(int)
+    counts_col = cell_last[:, 0] - cell_first[:, 0] + 1
+    idxs_point = np.repeat(np.arange(coords_points.shape[0]), counts_col)
+    cols = cell_first[idxs_point, 0] + ragged_arange(counts_col)
+    counts_row = cell_last[idxs_point, 1] - cell_first[idxs_point, 1] + 1
+    idxs_col = np.repeat(np.arange(cols.size), counts_row)
+    idxs_point = idxs_point[idxs_col]
+    idxs_cell = cols[idxs_col] * grid_shape[1] + cell_first[idxs_point, 1] + ragged_arange(counts_row)
+
+    order = np.argsort(idxs_cell, kind='mergesort')
+    cell_points = idxs_point[order]
+    cell_starts = np.append(0, np.cumsum(np.bincount(idxs_cell, minlength=grid_shape[0] * grid_shape[1])))
+
+    for idx_chunk in range(0, count_lines, chunk_size):
+        chunk = slice(idx_chunk, idx_chunk + chunk_size)
+        idxs_line, cols, rows = cells_along_lines(coords_start[chunk], coords_end[chunk], grid_origin, cell_size)
+        in_grid = (cols >= 0) & (cols < grid_shape[0]) & (rows >= 0) & (rows < grid_shape[1])
+        idxs_line = idxs_line[in_grid] + idx_chunk
+        idxs_cell = cols[in_grid] * grid_shape[1] + rows[in_grid]
+
+        # Candidate points of every line
+        counts = cell_starts[idxs_cell + 1] - cell_starts[idxs_cell]
+        idxs_line = np.repeat(idxs_line, counts)
+        idxs_point = cell_points[np.repeat(cell_starts[idxs_cell], counts) + ragged_arange(counts)]
+
+        if idxs_exclude is not None:
+            is_excluded = np.any(idxs_exclude[idxs_line] == idxs_point[:, np.newaxis], axis=1)
+            idxs_line = idxs_line[~is_excluded]
+            idxs_point = idxs_point[~is_excluded]
+
+        distances = points_to_segments_distance(coords_points[idxs_point],
+                                                coords_start[idxs_line],
+                                                coords_end[idxs_line])
+        intersects[idxs_line[distances <= margin]] = True
+
+    return intersects
+
+
+def points_to_segments_distance(coords_points, coords_start, coords_end):
+    """Determines elementwise the distance between the points and the segments.
+
+    Parameters
+    ----------
+    coords_points : numpy.ndarray
+        Coordinates of the points
+    coords_start : numpy.ndarray
+        Start coordinates of the segments
+    coords_end : numpy.ndarray
+        End coordinates of the segments
+
+    Returns
+    -------
+    distances : numpy.ndarray
+        Distances between the points and the segments
+    """
+
+    delta = coords_end - coords_start
+    length_sq = np.sum(delta ** 2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.sum((coords_points - coords_start) * delta, axis=1) / length_sq
+    # Degenerate segments are points
+    ratio = np.where(length_sq > 0, np.clip(ratio, 0, 1), 0)
+    coords_closest = coords_start + ratio[:, np.newaxis] * delta
+
+    return np.linalg.norm(coords_points - coords_closest, ord=2, axis=1)
+
+
 def get_street_lengths(graph_streets):
     """Returns the lengths of the streets in `graph_streets`.
 
@@ -163,6 +961,40 @@ def split_line_at_point(line, point):
     return line_before, line_after
 
 
+def split_line_at_distance(line, distance):
+    """Splits the `line` at the `distance` along the line and returns it's two parts.
+
+    Parameters
+    ----------
+    line : shapely.geometry.LineString
+    distance : float
+        Distance from the start of the line
+
+    Returns
+    -------
+    line_before: shapely.geometry.LineString
+        Part of `line` before `distance`
+    line_after: shapely.geometry.LineString
+        Part of `line` after `distance`
+
+    """
+
+    coords = np.array(line.coords)[:, 0:2]
+    distances = np.append(0, np.cumsum(np.linalg.norm(np.diff(coords, axis=0), ord=2, axis=1)))
+    distance = min(max(distance, 0), distances[-1])
+    coords_split = np.array(line.interpolate(distance).coords)[0, 0:2]
+
+    # Coordinates strictly before and after the split
+    is_before = distances < distance
+    is_after = distances > distance
+    is_before[0] = False
+    is_after[-1] = False
+    line_before = geom.LineString(np.vstack((coords[0], coords[is_before], coords_split)))
+    line_after = geom.LineString(np.vstack((coords_split, coords[is_after], coords[-1])))
+
+    return line_before, line_after
+
+
 def angles_along_line(line):
     """Determines the the `angles` along the `line` string.
     For a line consisting of n segments the function returns n-1 angles where the i-th element is the angle between
@@ -1,6 +1,7 @@
 """Provides configuration based network generation"""
 
 import json
+import logging
 import os
 
 import numpy as np
@@ -112,20 +113,46 @@ def check_fill_config(config):
     if 'building_tolerance' not in config:
         config['building_tolerance'] = 0
 
+    # Routes between NLOS vehicles are weighted by the length of the streets or by the turning angle
+    if 'route_weight' not in config:
+        config['route_weight'] = 'length'
+    elif config['route_weight'] not in ['length', 'angle']:
+        raise KeyError('Route weight not supported')
+
     if 'results_file_prefix' not in config:
         config['results_file_prefix'] = None
 
     if 'results_file_dir' not in config:
         config['results_file_dir'] = None
 
+    if 'results_chunk_size' not in config:
+        config['results_chunk_size'] = 100
+
     if 'analyze_results' not in config:
         config['analyze_results'] = None
     elif not isinstance(config['analyze_results'], (list, tuple, type(None))):
         config['analyze_results'] = [config['analyze_results']]
 
+    if 'analysis_backend' not in config:
+        config['analysis_backend'] = 'sparse'
+
+    if 'min_node_cut' not in config:
+        config['min_node_cut'] = 'exact'
+
+    if 'min_node_cut_interval' not in config:
+        config['min_node_cut_interval'] = 1
+
     if (config['simulation_mode'] == 'parallel') and ('processes' not in config):
         config['processes'] = None
 
+    if config['simulation_mode'] == 'parallel':
+        if 'tasks_chunk_size' not in config:
+            config['tasks_chunk_size'] = None
+        if 'max_tasks_in_flight' not in config:
+            config['max_tasks_in_flight'] = None
+        if 'progress_interval' not in config:
+            config['progress_interval'] = 60
+
     # Optional SUMO settings
     if config['distribution_veh'] == 'SUMO':
         if 'sumo' not in config:
@@ -138,6 +165,16 @@ def check_fill_config(config):
             config['sumo']['max_speed'] = None
         if 'intermediate_points' not in config['sumo']:
             config['sumo']['intermediate_points'] = None
+        # Propagation conditions are carried over between snapshots in the sequential mode only. With the default
+        # tolerance of 0 only the pairs of vehicles that did not move are reused and results are exact
+        if 'prop_cond_tolerance' not in config['sumo']:
+            if config['simulation_mode'] == 'sequential':
+                config['sumo']['prop_cond_tolerance'] = 0
+            else:
+                config['sumo']['prop_cond_tolerance'] = None
+        elif (config['sumo']['prop_cond_tolerance'] is not None) and (config['simulation_mode'] != 'sequential'):
+            logging.warning('Propagation condition tolerance is only supported in the sequential mode. Ignoring')
+            config['sumo']['prop_cond_tolerance'] = None
         if 'warmup_duration' not in config['sumo']:
             config['sumo']['warmup_duration'] = None
         if 'abort_after_sumo' not in config['sumo']:
@@ -150,6 +187,10 @@ def check_fill_config(config):
             config['sumo']['veh_rate_factor'] = None
         if 'coordinate_tls' not in config['sumo']:
             config['sumo']['coordinate_tls'] = True
+        if 'stream_traces' not in config['sumo']:
+            config['sumo']['stream_traces'] = False
+        elif config['sumo']['stream_traces'] and config['save_plot']:
+            raise KeyError('Plotting not supported when streaming vehicle traces')
 
     # Convert densities
     config['densities_veh'] = convert_densities(config['densities_veh'])
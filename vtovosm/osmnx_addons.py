@@ -9,6 +9,7 @@ import osmnx as ox
 import shapely.geometry as geom
 import shapely.ops as ops
 
+from . import geometry as geom_o
 from . import propagation as prop
 from . import utils
 
@@ -20,8 +21,9 @@ def setup():
     ox.config(log_console=False, log_file=os.devnull, log_name=logger.name, use_cache=True)
 
 
-def load_network(place, which_result=1, overwrite=False, tolerance=0):
-    """Generates streets and buildings"""
+def load_network(place, which_result=1, overwrite=False, tolerance=0, processes=1):
+    """Generates streets and buildings. The check for buildings between the nodes of the wave propagation graph can
+    be split among multiple `processes`"""
 
     # Generate filenames
     file_prefix = 'data/{}'.format(utils.string_to_filename(place))
@@ -33,6 +35,12 @@ def load_network(place, which_result=1, overwrite=False, tolerance=0):
         utils.string_to_filename(place))
     filename_data_buildings = 'data/{}_buildings.pickle.xz'.format(
         utils.string_to_filename(place))
+    if tolerance == 0:
+        filename_data_index_buildings = 'data/{}_buildings_index.pickle.xz'.format(
+            utils.string_to_filename(place))
+    else:
+        filename_data_index_buildings = 'data/{}_buildings_{:.2f}_index.pickle.xz'.format(
+            utils.string_to_filename(place), tolerance)
 
     # Create the output directory if it does not exist
     if not os.path.isdir('data/'):
@@ -57,6 +65,24 @@ def load_network(place, which_result=1, overwrite=False, tolerance=0):
 
     utils.debug(time_start)
 
+    # Generate spatial index of the streets
+    time_start = utils.debug(None, 'Generating spatial index of streets')
+    index_streets = geom_o.StreetIndex(graph_streets)
+    utils.debug(time_start)
+
+    # Generate spatial index of the buildings
+    if not overwrite and os.path.isfile(filename_data_index_buildings):
+        # Load from file
+        time_start = utils.debug(None, 'Loading spatial index of buildings')
+        index_buildings = utils.load(filename_data_index_buildings)
+    else:
+        # Generate
+        time_start = utils.debug(None, 'Generating spatial index of buildings')
+        index_buildings = geom_o.BuildingIndex(gdf_buildings)
+        utils.save(index_buildings, filename_data_index_buildings)
+
+    utils.debug(time_start)
+
     # Generate wave propagation graph:
     # Vehicles are placed in a undirected version of the graph because electromagnetic
     # waves do not respect driving directions
@@ -68,14 +94,19 @@ def load_network(place, which_result=1, overwrite=False, tolerance=0):
         # Generate
         time_start = utils.debug(None, 'Generating graph for wave propagation')
         graph_streets_wave = graph_streets.to_undirected()
-        prop.add_edges_if_los(graph_streets_wave, gdf_buildings)
+        prop.add_edges_if_los(graph_streets_wave, index_buildings, processes=processes)
         utils.save(graph_streets_wave, filename_data_wave)
 
     utils.debug(time_start)
 
+    # NOTE: The route table (prop.RouteTable) or, if the routes are weighted by angle, the turn graph (prop.TurnGraph)
+    # of the wave propagation graph is only needed for the pathloss metric and is generated once by the simulation
+
     network = {'graph_streets': graph_streets,
+               'index_streets': index_streets,
                'graph_streets_wave': graph_streets_wave,
                'gdf_buildings': gdf_buildings,
+               'index_buildings': index_buildings,
                'gdf_boundary': gdf_boundary}
 
     return network
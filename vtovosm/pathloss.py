@@ -10,9 +10,13 @@ import numpy as np
 
 
 class Pathloss:
-    """ Class providing the pathloss functions for NLOS, OLOS and LOS propagation"""
+    """ Class providing the pathloss functions for NLOS, OLOS and LOS propagation.
+    The coefficients of the pathloss equations are derived from the configurations once, `update_constants` has to
+    be called after modifying a configuration. Shadow fading is drawn from the random number generator `rng`, which
+    can also be a seed. If it is not given, a generator with a random seed is used. The global numpy random state is
+    never used"""
 
-    def __init__(self, nlos_config=None, los_config=None, olos_config=None):
+    def __init__(self, nlos_config=None, los_config=None, olos_config=None, rng=None):
         if nlos_config is None:
             # NOTE: dist_break assumes a vehicle height of 1.5 m, and a
             # frequency of 5.9 GHz (d_b = 4*h_t*h_r/lambda)
@@ -49,83 +53,110 @@ class Pathloss:
         else:
             self.olos_config = olos_config
 
+        if isinstance(rng, np.random.Generator):
+            self.rng = rng
+        else:
+            self.rng = np.random.default_rng(rng)
+
+        self.update_constants()
+
+    def update_constants(self):
+        """Derives the coefficients of the pathloss equations from the configurations"""
+
+        # NLOS: pathloss = offset + factor * (0.957 * log10(dist_tx) + exp_rx * log10(dist_rx)) with exp_rx = 1 below
+        # and exp_rx = 2 above the break distance
+        config = self.nlos_config
+        self.nlos_factor = 10 * config['pathloss_exp']
+        self.nlos_offset_1 = 3.75 + config['is_sub_urban'] * 2.94 + self.nlos_factor * (
+            np.log10(4 * np.pi) - 0.81 * np.log10(config['dist_tx_wall'] * config['width_rx_street'])
+            - np.log10(config['wavelength']))
+        self.nlos_offset_2 = self.nlos_offset_1 - self.nlos_factor * np.log10(config['dist_break'])
+
+        self.los_constants = self.dual_slope_constants(self.los_config)
+        self.olos_constants = self.dual_slope_constants(self.olos_config)
+
+    @staticmethod
+    def dual_slope_constants(config):
+        """Derives offsets and slopes of the dual slope model in equation (5) so that
+        pathloss = offset + slope * log10(dist) below and above the break distance"""
+
+        slope_1 = 10 * config['pathloss_exp_1']
+        slope_2 = 10 * config['pathloss_exp_2']
+        offset_1 = config['pathloss_ref'] - slope_1 * np.log10(config['dist_ref'])
+        offset_2 = config['pathloss_ref'] + slope_1 * np.log10(config['dist_break'] / config['dist_ref']) \
+            - slope_2 * np.log10(config['dist_break'])
+
+        return offset_1, slope_1, offset_2, slope_2
+
     def disable_shadowfading(self):
         """Deactivates shadow fading (random component) by setting the standard deviation to zero"""
 
         self.olos_config['standard_dev'] = 0
         self.los_config['standard_dev'] = 0
         self.nlos_config['standard_dev'] = 0
+        self.update_constants()
+
+    def shadow_fading(self, standard_dev, size):
+        """Draws the shadow fading losses"""
+
+        if standard_dev == 0:
+            return np.zeros(size)
+
+        return self.rng.normal(0, standard_dev, size)
 
     def pathloss_nlos(self, dist_rx, dist_tx):
         """Calculates the pathloss for the non line of sight case in equation (6)"""
 
+        dist_rx = np.asarray(dist_rx, dtype=float)
+        dist_tx = np.asarray(dist_tx, dtype=float)
+
+        is_slope_1 = dist_rx < self.nlos_config['dist_break']
+        pathloss = np.where(is_slope_1, 1.0, 2.0)
+        pathloss *= np.log10(dist_rx)
+        pathloss += 0.957 * np.log10(dist_tx)
+        pathloss *= self.nlos_factor
+        pathloss += np.where(is_slope_1, self.nlos_offset_1, self.nlos_offset_2)
+
         # NOTE: Missing in the equation in the paper
-        sf_loss = np.random.normal(
-            0, self.nlos_config['standard_dev'], np.size(dist_rx))
-
-        slope_selector = dist_rx < self.nlos_config['dist_break']
-        pathloss_slope_1 = slope_selector \
-                           * (3.75 + self.nlos_config['is_sub_urban'] * 2.94 + 10
-                              * np.log10((dist_tx ** 0.957 * 4 * np.pi * dist_rx /
-                                          (self.nlos_config['dist_tx_wall']
-                                           * self.nlos_config['width_rx_street']) **
-                                          0.81 / self.nlos_config['wavelength'])
-                                         ** self.nlos_config['pathloss_exp']))
-        pathloss_slope_2 = np.invert(slope_selector) \
-                           * (3.75 + self.nlos_config['is_sub_urban'] * 2.94 + 10
-                              * np.log10((dist_tx ** 0.957 * 4 * np.pi * dist_rx ** 2
-                                          / (self.nlos_config['dist_tx_wall'] *
-                                             self.nlos_config['width_rx_street']) ** 0.81
-                                          / (self.nlos_config['wavelength'] * self.nlos_config['dist_break']))
-                                         ** self.nlos_config['pathloss_exp']))
-
-        pathloss = pathloss_slope_1 + pathloss_slope_2 + sf_loss
+        pathloss = pathloss + self.shadow_fading(self.nlos_config['standard_dev'], np.size(dist_rx))
+
         return pathloss
 
-    def pathloss_los(self, dist):
-        """Calculates the pathloss for the line of sight case defined in equation (5)"""
+    def pathloss_nlos_pairs(self, dist_1, dist_2):
+        """Calculates the NLOS pathloss for pairs of vehicles with the distances `dist_1` and `dist_2` to the
+        intersection. The maximum of the pathlosses in both directions is returned, i.e. vehicles are connected if
+        both pathlosses are below the threshold"""
+
+        pathloss_1 = self.pathloss_nlos(dist_1, dist_2)
+        pathloss_2 = self.pathloss_nlos(dist_2, dist_1)
+
+        return np.maximum(pathloss_1, pathloss_2)
 
-        sf_loss = np.random.normal(
-            0, self.los_config['standard_dev'], np.size(dist))
+    def pathloss_dual_slope(self, dist, config, constants):
+        """Calculates the pathloss of the dual slope model in equation (5) for LOS and OLOS"""
 
-        if (np.isscalar(dist) and dist < self.los_config['dist_ref']) or \
-                (not np.isscalar(dist) and any(dist < self.los_config['dist_ref'])):
+        dist = np.asarray(dist, dtype=float)
+        offset_1, slope_1, offset_2, slope_2 = constants
+
+        if np.any(dist < config['dist_ref']):
             logging.warning('Distance smaller than reference distance')
 
-        slope_selector = dist < self.los_config['dist_break']
-        pathloss_slope_1 = slope_selector \
-                           * (self.los_config['pathloss_ref'] + 10 * self.los_config['pathloss_exp_1']
-                              * np.log10(dist / self.los_config['dist_ref']))
-        pathloss_slope_2 = np.invert(slope_selector) \
-                           * (self.los_config['pathloss_ref'] + 10 * self.los_config['pathloss_exp_1']
-                              * np.log10(self.los_config['dist_break'] / self.los_config['dist_ref'])
-                              + 10 * self.los_config['pathloss_exp_2']
-                              * np.log10(dist / self.los_config['dist_break']))
+        is_slope_1 = dist < config['dist_break']
+        pathloss = np.log10(dist)
+        pathloss *= np.where(is_slope_1, slope_1, slope_2)
+        pathloss += np.where(is_slope_1, offset_1, offset_2)
+        pathloss = pathloss + self.shadow_fading(config['standard_dev'], np.size(dist))
 
         # NOTE: Invert sign to keep consistency with NLOS
-        pathloss = - (pathloss_slope_1 + pathloss_slope_2 + sf_loss)
+        np.negative(pathloss, out=pathloss)
         return pathloss
 
-    def pathloss_olos(self, dist):
-        """Calculates the pathloss for the obstructed line of sight case defined in equation (5)"""
-
-        sf_loss = np.random.normal(
-            0, self.olos_config['standard_dev'], np.size(dist))
+    def pathloss_los(self, dist):
+        """Calculates the pathloss for the line of sight case defined in equation (5)"""
 
-        if (np.isscalar(dist) and dist < self.olos_config['dist_ref']) or \
-                (not np.isscalar(dist) and any(dist < self.olos_config['dist_ref'])):
-            logging.warning('Distance smaller than reference distance')
+        return self.pathloss_dual_slope(dist, self.los_config, self.los_constants)
 
-        slope_selector = dist < self.olos_config['dist_break']
-        pathloss_slope_1 = slope_selector \
-                           * (self.olos_config['pathloss_ref'] + 10 * self.olos_config['pathloss_exp_1']
-                              * np.log10(dist / self.olos_config['dist_ref']))
-        pathloss_slope_2 = np.invert(slope_selector) \
-                           * (self.olos_config['pathloss_ref'] + 10 * self.olos_config['pathloss_exp_1']
-                              * np.log10(self.olos_config['dist_break'] / self.olos_config['dist_ref'])
-                              + 10 * self.olos_config['pathloss_exp_2'] *
-                              np.log10(dist / self.olos_config['dist_break']))
+    def pathloss_olos(self, dist):
+        """Calculates the pathloss for the obstructed line of sight case defined in equation (5)"""
 
-        # NOTE: Invert sign to keep consistency with NLOS
-        pathloss = - (pathloss_slope_1 + pathloss_slope_2 + sf_loss)
-        return pathloss
+        return self.pathloss_dual_slope(dist, self.olos_config, self.olos_constants)
@@ -1,13 +1,22 @@
 """ Determines the propagation conditions (LOS/OLOS/NLOS orthogonal/NLOS paralell) of connections"""
 
+import multiprocessing as mp
+from collections import OrderedDict
 from enum import IntEnum
 
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp_sparse
+import scipy.sparse.csgraph as sp_csgraph
 import shapely.geometry as geom
 import shapely.ops as ops
+from scipy.spatial import cKDTree
 
 from . import geometry as geom_o
+from . import utils
+
+# Spatial index of the buildings of a worker process of add_edges_if_los, see init_los_worker
+worker_index_buildings = None
 
 
 class Cond(IntEnum):
@@ -27,6 +36,315 @@ class Cond(IntEnum):
     NLOS = 6
 
 
+class RouteTable:
+    """Shortest routes (by length) in the wave propagation graph.
+    The shortest routes from a node to all other nodes are determined with Dijkstra's algorithm when they are first
+    needed. Only the `cache_size` most recently used of them are kept, so the memory does not grow with the square of
+    the number of nodes. The route between two vehicles is then found with a constant number of lookups, see
+    `route_between_vehs`.
+
+    Parameters
+    ----------
+    graph_streets_wave : networkx.MultiGraph
+        Wave propagation graph
+    cache_size : int, optional
+        Maximum number of nodes whose shortest routes are kept
+    """
+
+    def __init__(self, graph_streets_wave, cache_size=256):
+        self.nodes = graph_streets_wave.nodes()
+        self.node_idxs = {node: idx for idx, node in enumerate(self.nodes)}
+
+        # If there are parallel edges, select the shortest in length
+        self.edge_geometries = {}
+        edge_lengths = {}
+        for node_u, node_v, data in graph_streets_wave.edges(data=True):
+            idx_u, idx_v = self.node_idxs[node_u], self.node_idxs[node_v]
+            if idx_u == idx_v:
+                continue
+            key = (min(idx_u, idx_v), max(idx_u, idx_v))
+            if key not in edge_lengths or data['length'] < edge_lengths[key]:
+                edge_lengths[key] = data['length']
+                self.edge_geometries[key] = data['geometry']
+
+        count_nodes = len(self.nodes)
+        keys = np.array(list(edge_lengths.keys()), dtype=int).reshape(-1, 2)
+        lengths = np.array(list(edge_lengths.values()), dtype=float)
+        self.matrix = sp_sparse.csr_matrix((lengths, (keys[:, 0], keys[:, 1])), shape=(count_nodes, count_nodes))
+        self.cache_size = cache_size
+        self.routes_from = OrderedDict()
+
+    def __getstate__(self):
+        # The cached routes are not saved
+        state = self.__dict__.copy()
+        state['routes_from'] = OrderedDict()
+        return state
+
+    def shortest_routes_from(self, idx_from):
+        """Returns the distances and predecessors of the shortest routes from the node with the index `idx_from` to
+        all other nodes"""
+
+        if idx_from in self.routes_from:
+            self.routes_from.move_to_end(idx_from)
+            return self.routes_from[idx_from]
+
+        routes = sp_csgraph.dijkstra(self.matrix, directed=False, indices=idx_from, return_predecessors=True)
+        self.routes_from[idx_from] = routes
+        if len(self.routes_from) > self.cache_size:
+            self.routes_from.popitem(last=False)
+
+        return routes
+
+    def route_between_nodes(self, node_from, node_to):
+        """Determines the list of edge geometries along the shortest route between two nodes"""
+
+        idx_from, idx_to = self.node_idxs[node_from], self.node_idxs[node_to]
+        distances, predecessors = self.shortest_routes_from(idx_from)
+        if not np.isfinite(distances[idx_to]):
+            raise nx.NetworkXNoPath('No route between {} and {}'.format(node_from, node_to))
+
+        lines = []
+        idx_current = idx_to
+        while idx_current != idx_from:
+            idx_prev = predecessors[idx_current]
+            lines.append(self.edge_geometries[(min(idx_prev, idx_current), max(idx_prev, idx_current))])
+            idx_current = idx_prev
+        lines.reverse()
+
+        return lines
+
+    def route_between_vehs(self, graph_veh_u, graph_veh_v):
+        """Determines the line representing the shortest route between two vehicles. The route leaves and enters the
+        streets of the vehicles via one of their ends"""
+
+        length_min = np.inf
+        for node_u, length_u, line_u in veh_street_ends(graph_veh_u):
+            distances_u, _ = self.shortest_routes_from(self.node_idxs[node_u])
+            for node_v, length_v, line_v in veh_street_ends(graph_veh_v):
+                length = length_u + distances_u[self.node_idxs[node_v]] + length_v
+                if length < length_min:
+                    length_min = length
+                    ends = node_u, line_u, node_v, line_v
+
+        if not np.isfinite(length_min):
+            raise nx.NetworkXNoPath('No route between the vehicles')
+
+        node_u, line_u, node_v, line_v = ends
+        lines = [line_u] + self.route_between_nodes(node_u, node_v) + [line_v]
+        line = ops.linemerge(lines)
+
+        return line
+
+
+class TurnGraph:
+    """Line graph of the wave propagation graph that is weighted by the turning angles along the streets.
+    Every node of the line graph is a directed street and an edge connects two consecutive streets. Its weight is the
+    turning angle between the streets plus the turning angles inside of the second street. The line graph is
+    generated once per graph and allows to search the routes with the least turning, see `routes_between_vehs`.
+
+    Parameters
+    ----------
+    graph_streets_wave : networkx.MultiGraph
+        Wave propagation graph
+    """
+
+    def __init__(self, graph_streets_wave):
+        self.edges_coords = []
+        self.edges_out = {}
+        self.edges_in = {}
+        for node_u, node_v, data in graph_streets_wave.edges(data=True):
+            if node_u == node_v:
+                continue
+            coords = np.array(data['geometry'].coords)[:, 0:2]
+            coords_u = np.array((graph_streets_wave.node[node_u]['x'], graph_streets_wave.node[node_u]['y']))
+            coords_v = np.array((graph_streets_wave.node[node_v]['x'], graph_streets_wave.node[node_v]['y']))
+            if np.linalg.norm(coords[0] - coords_u) > np.linalg.norm(coords[0] - coords_v):
+                coords = coords[::-1]
+
+            # Waves do not respect driving directions, every street is added in both directions
+            for node_from, node_to, coords_dir in [(node_u, node_v, coords), (node_v, node_u, coords[::-1])]:
+                idx_edge = len(self.edges_coords)
+                self.edges_coords.append(coords_dir)
+                self.edges_out.setdefault(node_from, []).append(idx_edge)
+                self.edges_in.setdefault(node_to, []).append(idx_edge)
+
+        count_edges = len(self.edges_coords)
+        self.headings_start = np.zeros(count_edges)
+        self.headings_end = np.zeros(count_edges)
+        self.angles = np.zeros(count_edges)
+        for idx_edge, coords in enumerate(self.edges_coords):
+            self.headings_start[idx_edge], self.headings_end[idx_edge], self.angles[idx_edge] = \
+                line_turning(coords)
+
+        rows, cols = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        for node, edges_in in self.edges_in.items():
+            edges_out = self.edges_out[node]
+            rows.append(np.repeat(edges_in, len(edges_out)))
+            cols.append(np.tile(edges_out, len(edges_in)))
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        weights = turning_angle(self.headings_end[rows], self.headings_start[cols]) + self.angles[cols]
+        self.matrix = sp_sparse.csr_matrix((weights, (rows, cols)), shape=(count_edges, count_edges))
+
+    def routes_between_vehs(self, graphs_vehs_u, graphs_vehs_v, max_sources=256):
+        """Determines the lines representing the routes with the least turning between pairs of vehicles.
+        The pairs are processed in chunks whose routes are searched together in the line graph. A chunk starts from at
+        most `max_sources` streets (unless a single pair needs more), which bounds the memory of the search"""
+
+        ends_u = [[(node, coords) + line_turning(coords) for node, coords in veh_street_ends_coords(graph)]
+                  for graph in graphs_vehs_u]
+        ends_v = [[(node, coords[::-1]) + line_turning(coords[::-1]) for node, coords in veh_street_ends_coords(graph)]
+                  for graph in graphs_vehs_v]
+
+        routes = []
+        count_pairs = len(ends_u)
+        idx_start = 0
+        while idx_start < count_pairs:
+            # Search from all streets that leave the street ends of the first vehicles of the chunk
+            sources = set()
+            idx_end = idx_start
+            while idx_end < count_pairs:
+                sources_pair = {idx_edge for node, *_ in ends_u[idx_end] for idx_edge in self.edges_out.get(node, [])}
+                if idx_end > idx_start and len(sources | sources_pair) > max_sources:
+                    break
+                sources |= sources_pair
+                idx_end += 1
+
+            sources = np.array(sorted(sources), dtype=int)
+            rows_sources = {idx_edge: row for row, idx_edge in enumerate(sources)}
+            if sources.size > 0:
+                distances, predecessors = sp_csgraph.dijkstra(self.matrix, indices=sources, return_predecessors=True)
+            else:
+                distances, predecessors = None, None
+
+            for ends_pair_u, ends_pair_v in zip(ends_u[idx_start:idx_end], ends_v[idx_start:idx_end]):
+                routes.append(self.route_between_ends(ends_pair_u, ends_pair_v, rows_sources, distances,
+                                                      predecessors))
+            idx_start = idx_end
+
+        return routes
+
+    def route_between_ends(self, ends_pair_u, ends_pair_v, rows_sources, distances, predecessors):
+        """Determines the line representing the route with the least turning between the street ends of two vehicles
+        from the searched routes of a chunk, see `routes_between_vehs`"""
+
+        angle_min = np.inf
+        for node_a, coords_ua, _, heading_ua, angle_ua in ends_pair_u:
+            for node_c, coords_cv, heading_cv, _, angle_cv in ends_pair_v:
+                # Both vehicles are connected to the same street end
+                if node_a == node_c:
+                    angle = angle_ua + turning_angle(heading_ua, heading_cv) + angle_cv
+                    if angle < angle_min:
+                        angle_min = angle
+                        route_coords = [coords_ua, coords_cv]
+
+                edges_out = self.edges_out.get(node_a, [])
+                edges_in = self.edges_in.get(node_c, [])
+                if len(edges_out) == 0 or len(edges_in) == 0:
+                    continue
+                rows = [rows_sources[idx_edge] for idx_edge in edges_out]
+                angles = angle_ua + \
+                    (turning_angle(heading_ua, self.headings_start[edges_out]) +
+                     self.angles[edges_out])[:, np.newaxis] + \
+                    distances[np.ix_(rows, edges_in)] + \
+                    (turning_angle(self.headings_end[edges_in], heading_cv) + angle_cv)[np.newaxis, :]
+                idx_out, idx_in = np.unravel_index(np.argmin(angles), angles.shape)
+                if angles[idx_out, idx_in] < angle_min:
+                    angle_min = angles[idx_out, idx_in]
+                    idx_edge_out = edges_out[idx_out]
+                    idx_edge = edges_in[idx_in]
+                    row = rows[idx_out]
+                    route_edges = [idx_edge]
+                    while idx_edge != idx_edge_out:
+                        idx_edge = predecessors[row, idx_edge]
+                        route_edges.append(idx_edge)
+                    route_coords = [coords_ua] + [self.edges_coords[idx_edge] for idx_edge in
+                                                  reversed(route_edges)] + [coords_cv]
+
+        if not np.isfinite(angle_min):
+            raise nx.NetworkXNoPath('No route between the vehicles')
+
+        coords = np.concatenate([route_coords[0]] + [coords[1:] for coords in route_coords[1:]])
+        coords = coords[np.append(True, np.any(np.diff(coords, axis=0) != 0, axis=1))]
+
+        return geom.LineString(coords)
+
+
+def line_turning(coords):
+    """Determines the heading of the first and last segment of a line and the sum of the turning angles along it.
+    Segments of zero length are ignored, the headings of a line without length are NaN"""
+
+    deltas = np.diff(coords, axis=0)
+    deltas = deltas[np.any(deltas != 0, axis=1)]
+    if deltas.shape[0] == 0:
+        return np.nan, np.nan, 0
+
+    headings = np.arctan2(deltas[:, 0], deltas[:, 1])
+    angle = np.sum(turning_angle(headings[:-1], headings[1:]))
+
+    return headings[0], headings[-1], angle
+
+
+def turning_angle(heading_from, heading_to):
+    """Determines the absolute turning angle between two headings. Undefined (NaN) headings do not turn"""
+
+    angle = np.abs(geom_o.wrap_to_pi(np.asarray(heading_to) - np.asarray(heading_from)))
+
+    return np.where(np.isnan(angle), 0, angle)
+
+
+def veh_street_ends_coords(graph_veh):
+    """Determines the street ends of a vehicle together with the coordinates of the line from the vehicle to them"""
+
+    node_veh = graph_veh.graph['node_veh']
+    coords_veh = np.array((graph_veh.node[node_veh]['x'], graph_veh.node[node_veh]['y']))
+    ends_coords = []
+    for node_end, length, line in veh_street_ends(graph_veh):
+        coords = np.array(line.coords)[:, 0:2]
+        if np.linalg.norm(coords[0] - coords_veh) > np.linalg.norm(coords[-1] - coords_veh):
+            coords = coords[::-1]
+        ends_coords.append((node_end, coords))
+
+    return ends_coords
+
+
+def veh_street_ends(graph_veh):
+    """Determines the street ends of a vehicle together with the length and the line to reach them"""
+
+    node_veh = graph_veh.graph['node_veh']
+    ends = {}
+    for _, node_end, data in graph_veh.edges(node_veh, data=True):
+        # If there are parallel edges, select the shortest in length
+        if node_end not in ends or data['length'] < ends[node_end][1]:
+            ends[node_end] = (node_end, data['length'], data['geometry'])
+
+    return list(ends.values())
+
+
+def get_turn_graph(graph_streets_wave):
+    """Returns the turn graph of the wave propagation graph. If `graph_streets_wave` already is a turn graph it is
+    returned unchanged, otherwise a new one is generated. Callers analyzing multiple snapshots should generate the
+    turn graph once and pass it instead of the wave propagation graph"""
+
+    if isinstance(graph_streets_wave, TurnGraph):
+        return graph_streets_wave
+    elif isinstance(graph_streets_wave, RouteTable):
+        raise RuntimeError('Routing by angle needs the wave propagation graph or its turn graph')
+
+    return TurnGraph(graph_streets_wave)
+
+
+def get_route_table(graph_streets_wave):
+    """Returns the route table of the wave propagation graph. If `graph_streets_wave` already is a route table it is
+    returned unchanged"""
+
+    if isinstance(graph_streets_wave, RouteTable):
+        return graph_streets_wave
+    elif isinstance(graph_streets_wave, TurnGraph):
+        raise RuntimeError('Routing by length needs the wave propagation graph or its route table')
+
+    return RouteTable(graph_streets_wave)
+
+
 def gen_prop_cond_matrix(points_vehs,
                          buildings,
                          graph_streets_wave=None,
@@ -34,70 +352,209 @@ def gen_prop_cond_matrix(points_vehs,
                          fully_determine=True,
                          max_dist=None,
                          car_radius=2,
-                         max_angle=np.pi):
+                         max_angle=np.pi,
+                         route_weight='length',
+                         prop_cond_tracker=None,
+                         ids_vehs=None):
     """Determines the condensed connection matrix, i.e. the propagation conditions between all pairs
-    of vehicles"""
-
+    of vehicles. `buildings` can be a geodata frame or a spatial index of the buildings and `graph_streets_wave` can
+    be the wave propagation graph or its route table (`route_weight` 'length') or turn graph (`route_weight`
+    'angle'). Also returns the coordinates of the maximum angle of the route of every NLOS orthogonal pair as a
+    (pairs x 2) array, the rows of all other pairs are 0.
+    If a `prop_cond_tracker` and the IDs of the vehicles are given, NLOS and OLOS/LOS are updated incrementally from
+    the previous snapshot"""
+
+    index_buildings = geom_o.get_building_index(buildings)
     count_vehs = points_vehs.size
     count_cond = count_vehs * (count_vehs - 1) // 2
-    prop_cond_matrix = np.zeros(count_cond, dtype=Cond)
-    coords_max_angle_matrix = np.zeros(count_cond, dtype=object)
-    range_vehs = np.arange(count_vehs)
+    coords_max_angle_matrix = np.zeros((count_cond, 2))
 
-    index = 0
-    for idx1, point1 in enumerate(points_vehs):
-        for idx2, point2 in enumerate(points_vehs[idx1 + 1:]):
-            is_nlos = True
-            line = geom.LineString([point1, point2])
-            if (max_dist is None) or (line.length < max_dist):
-                is_nlos = geom_o.line_intersects_buildings(
-                    line, buildings)
-
-            if is_nlos:
-                if fully_determine:
-                    graph_veh1 = graphs_vehs[idx1]
-                    graph_veh2 = graphs_vehs[idx1 + idx2 + 1]
-
-                    is_orthogonal, coords_max_angle = check_if_con_is_orthogonal(
-                        graph_streets_wave,
-                        graph_veh1,
-                        graph_veh2,
-                        max_angle=max_angle)
-                    if is_orthogonal:
-                        prop_cond_matrix[index] = Cond.NLOS_ort
-                        coords_max_angle_matrix[index] = coords_max_angle
-                    else:
-                        prop_cond_matrix[index] = Cond.NLOS_par
-
-                else:
-                    prop_cond_matrix[index] = Cond.NLOS
-            else:
-                if fully_determine:
-                    idxs_other = np.setdiff1d(
-                        range_vehs, [idx1, idx1 + idx2 + 1])
-                    is_olos = geom_o.line_intersects_points(line, points_vehs[idxs_other],
-                                                            margin=car_radius)
-                    if is_olos:
-                        prop_cond_matrix[index] = Cond.OLOS
-                    else:
-                        prop_cond_matrix[index] = Cond.LOS
-                else:
-                    prop_cond_matrix[index] = Cond.OLOS_LOS
+    # Determine NLOS and OLOS/LOS for all pairs at once
+    coords_vehs = geom_o.extract_point_array(points_vehs)
+    if (prop_cond_tracker is not None) and (ids_vehs is not None):
+        # The tracker keeps the returned matrix for the next snapshot, it must not be refined in place
+        prop_cond_matrix = prop_cond_tracker.update(coords_vehs, ids_vehs, max_dist=max_dist).copy()
+    else:
+        prop_cond_matrix = gen_prop_cond_matrix_batch(coords_vehs, index_buildings, max_dist=max_dist)
+
+    if not fully_determine:
+        return prop_cond_matrix, coords_max_angle_matrix
+
+    idxs_veh1, idxs_veh2 = utils.triu_indices(count_vehs)
+
+    # Determine OLOS and LOS for all OLOS/LOS pairs at once, the vehicles of a pair do not block themselves
+    idxs_olos_los = np.flatnonzero(prop_cond_matrix == Cond.OLOS_LOS)
+    is_olos = geom_o.lines_intersect_points(coords_vehs[idxs_veh1[idxs_olos_los]],
+                                            coords_vehs[idxs_veh2[idxs_olos_los]],
+                                            coords_vehs,
+                                            margin=car_radius,
+                                            idxs_exclude=np.column_stack((idxs_veh1[idxs_olos_los],
+                                                                          idxs_veh2[idxs_olos_los])))
+    prop_cond_matrix[idxs_olos_los[is_olos]] = Cond.OLOS
+    prop_cond_matrix[idxs_olos_los[~is_olos]] = Cond.LOS
+
+    # Determine the routes between all NLOS pairs
+    idxs_nlos = np.flatnonzero(prop_cond_matrix == Cond.NLOS)
+    if idxs_nlos.size == 0:
+        routes = []
+    elif route_weight == 'length':
+        routes_wave = get_route_table(graph_streets_wave)
+        routes = [routes_wave.route_between_vehs(graphs_vehs[idxs_veh1[index]], graphs_vehs[idxs_veh2[index]])
+                  for index in idxs_nlos]
+    elif route_weight == 'angle':
+        turns_wave = get_turn_graph(graph_streets_wave)
+        routes = turns_wave.routes_between_vehs(graphs_vehs[idxs_veh1[idxs_nlos]], graphs_vehs[idxs_veh2[idxs_nlos]])
+    else:
+        raise NotImplementedError('Route weight not supported')
 
-            index += 1
+    is_orthogonal = np.zeros(idxs_nlos.size, dtype=bool)
+    for index, route in enumerate(routes):
+        is_orthogonal[index], coords_max_angle_matrix[idxs_nlos[index]] = \
+            route_is_orthogonal(route, max_angle=max_angle)
+
+    prop_cond_matrix[idxs_nlos[is_orthogonal]] = Cond.NLOS_ort
+    prop_cond_matrix[idxs_nlos[~is_orthogonal]] = Cond.NLOS_par
+    coords_max_angle_matrix[idxs_nlos[~is_orthogonal]] = 0
 
     return prop_cond_matrix, coords_max_angle_matrix
 
 
+def gen_prop_cond_matrix_batch(coords_vehs, buildings, max_dist=None):
+    """Determines the condensed propagation condition matrix that only distinguishes between NLOS and OLOS/LOS.
+    All pairs of vehicles are checked at once using array operations instead of a loop over the pairs.
+    If `max_dist` is given only pairs closer than it are enumerated (using a k-d tree) and checked, all other pairs
+    are NLOS"""
+
+    count_vehs = coords_vehs.shape[0]
+    count_cond = count_vehs * (count_vehs - 1) // 2
+
+    if max_dist is None:
+        idxs_veh1, idxs_veh2 = utils.triu_indices(count_vehs)
+        idxs_cond = np.arange(count_cond)
+    else:
+        idxs_veh1, idxs_veh2 = geom_o.pairs_in_range(coords_vehs, max_dist)
+        idxs_cond = utils.square_to_condensed(idxs_veh1, idxs_veh2, count_vehs)
+
+    is_nlos = geom_o.lines_intersect_buildings(
+        coords_vehs[idxs_veh1], coords_vehs[idxs_veh2], buildings)
+
+    prop_cond_matrix = np.zeros(count_cond, dtype=Cond)
+    prop_cond_matrix[:] = Cond.NLOS
+    prop_cond_matrix[idxs_cond[~is_nlos]] = Cond.OLOS_LOS
+
+    return prop_cond_matrix
+
+
+class PropCondTracker:
+    """Keeps the propagation condition matrix (NLOS and OLOS/LOS only, see `gen_prop_cond_matrix_batch`) of the
+    previous snapshot of a vehicle trace and only checks the pairs of vehicles that changed since then.
+    Vehicles are matched between snapshots by their IDs. A pair keeps its previous condition if both vehicles moved
+    at most `tolerance` and stayed in the same cell of the building grid. With the default tolerance of 0 only pairs
+    of vehicles that did not move at all (e.g. parked or waiting at a traffic light) are kept and the result equals a
+    full recomputation. A larger tolerance reuses more pairs but is an approximation"""
+
+    def __init__(self, buildings, tolerance=0):
+        self.index_buildings = geom_o.get_building_index(buildings)
+        self.tolerance = tolerance
+        self.reset()
+
+    def reset(self):
+        """Drops the state of the previous snapshot"""
+
+        self.ids = None
+        self.coords = None
+        self.cells = None
+        self.prop_cond_matrix = None
+        self.max_dist = None
+        self.count_checked = 0
+
+    def cells_of_points(self, coords):
+        """Returns the building grid cells of the points in `coords`"""
+
+        return np.floor((coords - self.index_buildings.grid_origin) / self.index_buildings.cell_size).astype(int)
+
+    def update(self, coords_vehs, ids_vehs, max_dist=None):
+        """Determines the condensed propagation condition matrix of the vehicles at `coords_vehs` with the IDs
+        `ids_vehs`, reusing the conditions of the previous snapshot where possible"""
+
+        coords_vehs = np.asarray(coords_vehs, dtype=float).reshape(-1, 2)
+        ids_vehs = np.asarray(ids_vehs)
+        count_vehs = coords_vehs.shape[0]
+        count_cond = count_vehs * (count_vehs - 1) // 2
+        cells = self.cells_of_points(coords_vehs)
+
+        if max_dist is None:
+            idxs_veh1, idxs_veh2 = utils.triu_indices(count_vehs)
+            idxs_cond = np.arange(count_cond)
+        else:
+            idxs_veh1, idxs_veh2 = geom_o.pairs_in_range(coords_vehs, max_dist)
+            idxs_cond = utils.square_to_condensed(idxs_veh1, idxs_veh2, count_vehs)
+
+        prop_cond_matrix = np.zeros(count_cond, dtype=Cond)
+        prop_cond_matrix[:] = Cond.NLOS
+        is_nlos = np.ones(idxs_veh1.size, dtype=bool)
+        to_check = np.ones(idxs_veh1.size, dtype=bool)
+
+        if (self.ids is not None) and (self.ids.size > 1) and (max_dist == self.max_dist):
+            # Match the vehicles to the previous snapshot
+            order_prev = np.argsort(self.ids, kind='mergesort')
+            positions = np.searchsorted(self.ids, ids_vehs, sorter=order_prev)
+            positions = np.minimum(positions, self.ids.size - 1)
+            idxs_prev = order_prev[positions]
+            is_known = self.ids[idxs_prev] == ids_vehs
+
+            moved = np.linalg.norm(coords_vehs - self.coords[idxs_prev], ord=2, axis=1)
+            is_unchanged = is_known & (moved <= self.tolerance) & \
+                np.all(cells == self.cells[idxs_prev], axis=1)
+
+            is_kept = is_unchanged[idxs_veh1] & is_unchanged[idxs_veh2]
+            idxs_prev1 = np.minimum(idxs_prev[idxs_veh1[is_kept]], idxs_prev[idxs_veh2[is_kept]])
+            idxs_prev2 = np.maximum(idxs_prev[idxs_veh1[is_kept]], idxs_prev[idxs_veh2[is_kept]])
+
+            # Pairs that were out of range before were not checked and can not be kept
+            if max_dist is not None:
+                distances_prev = np.linalg.norm(self.coords[idxs_prev1] - self.coords[idxs_prev2], ord=2, axis=1)
+                was_in_range = distances_prev < max_dist
+                idxs_kept = np.flatnonzero(is_kept)[was_in_range]
+                idxs_prev1, idxs_prev2 = idxs_prev1[was_in_range], idxs_prev2[was_in_range]
+            else:
+                idxs_kept = np.flatnonzero(is_kept)
+
+            count_prev = self.ids.size
+            idxs_cond_prev = utils.square_to_condensed(idxs_prev1, idxs_prev2, count_prev)
+            is_nlos[idxs_kept] = self.prop_cond_matrix[idxs_cond_prev] == Cond.NLOS
+            to_check[idxs_kept] = False
+
+        is_nlos[to_check] = geom_o.lines_intersect_buildings(
+            coords_vehs[idxs_veh1[to_check]], coords_vehs[idxs_veh2[to_check]], self.index_buildings)
+        prop_cond_matrix[idxs_cond[~is_nlos]] = Cond.OLOS_LOS
+
+        self.ids = ids_vehs.copy()
+        self.coords = coords_vehs.copy()
+        self.cells = cells
+        self.prop_cond_matrix = prop_cond_matrix
+        self.max_dist = max_dist
+        self.count_checked = int(np.sum(to_check))
+
+        return prop_cond_matrix
+
+
 def veh_cons_are_nlos(point_own, points_vehs, buildings, max_dist=None):
     """ Determines for each connection if it is NLOS or not (i.e. LOS and OLOS)"""
 
+    coords_own = np.array(point_own.coords)[0, 0:2]
+    coords_vehs = geom_o.extract_point_array(points_vehs)
     is_nlos = np.ones(np.size(points_vehs), dtype=bool)
 
-    for index, point in enumerate(points_vehs):
-        line = geom.LineString([point_own, point])
-        if (max_dist is None) or (line.length < max_dist):
-            is_nlos[index] = geom_o.line_intersects_buildings(line, buildings)
+    if max_dist is None:
+        is_in_range = np.ones(np.size(points_vehs), dtype=bool)
+    else:
+        distances = np.linalg.norm(coords_vehs - coords_own, ord=2, axis=1)
+        is_in_range = distances < max_dist
+
+    coords_own_rep = np.tile(coords_own, (np.sum(is_in_range), 1))
+    is_nlos[is_in_range] = geom_o.lines_intersect_buildings(
+        coords_own_rep, coords_vehs[is_in_range], buildings)
 
     return is_nlos
 
@@ -106,6 +563,7 @@ def veh_cons_are_nlos_all(points_vehs, buildings, max_dist=None):
     """ Determines for each possible connection if it is NLOS or not (i.e. LOS and OLOS)"""
     # NOTE: This function is deprecated and is replaced by gen_prop_cond_matrix
 
+    index_buildings = geom_o.get_building_index(buildings)
     count_vehs = np.size(points_vehs)
     count_cond = count_vehs * (count_vehs - 1) // 2
     is_nlos = np.ones(count_cond, dtype=bool)
@@ -116,7 +574,7 @@ def veh_cons_are_nlos_all(points_vehs, buildings, max_dist=None):
             line = geom.LineString([point1, point2])
             if (max_dist is None) or (line.length < max_dist):
                 is_nlos[index] = geom_o.line_intersects_buildings(
-                    line, buildings)
+                    line, index_buildings)
             index += 1
 
     return is_nlos
@@ -125,14 +583,16 @@ def veh_cons_are_nlos_all(points_vehs, buildings, max_dist=None):
 def veh_cons_are_olos(point_own, points_vehs, margin=1):
     """Determines for each LOS/OLOS connection if it is OLOS"""
 
-    is_olos = np.zeros(np.size(points_vehs), dtype=bool)
+    count_vehs = np.size(points_vehs)
+    coords_own = np.array(point_own.coords)[0, 0:2]
+    coords_vehs = geom_o.extract_point_array(points_vehs)
 
-    for index, point in np.ndenumerate(points_vehs):
-        line = geom.LineString([point_own, point])
-        indices_other = np.ones(np.size(points_vehs), dtype=bool)
-        indices_other[index] = False
-        is_olos[index] = geom_o.line_intersects_points(line, points_vehs[indices_other],
-                                                       margin=margin)
+    # The other vehicle of a connection does not block it
+    is_olos = geom_o.lines_intersect_points(np.tile(coords_own, (count_vehs, 1)),
+                                            coords_vehs,
+                                            coords_vehs,
+                                            margin=margin,
+                                            idxs_exclude=np.arange(count_vehs))
 
     return is_olos
 
@@ -142,16 +602,29 @@ def check_if_con_is_orthogonal(streets_wave,
                                graph_veh_v,
                                max_angle=np.pi):
     """Determines if the propagation condition between two vehicles is NLOS on an orthogonal
-    street"""
+    street. `streets_wave` can be the wave propagation graph or its route table or turn graph"""
+
+    # NOTE: Unless a turn graph is given we suboptimally use the length of roads between nodes as weight for routing
+    # and not the angle
+    if isinstance(streets_wave, TurnGraph):
+        route = streets_wave.routes_between_vehs([graph_veh_u], [graph_veh_v])[0]
+    elif isinstance(streets_wave, RouteTable):
+        route = streets_wave.route_between_vehs(graph_veh_u, graph_veh_v)
+    else:
+        node_u = graph_veh_u.graph['node_veh']
+        node_v = graph_veh_v.graph['node_veh']
+        streets_wave_local = nx.compose(graph_veh_u, streets_wave)
+        streets_wave_local = nx.compose(graph_veh_v, streets_wave_local)
+        route = line_route_between_nodes(
+            node_u, node_v, streets_wave_local)
+
+    return route_is_orthogonal(route, max_angle=max_angle)
+
 
-    node_u = graph_veh_u.graph['node_veh']
-    node_v = graph_veh_v.graph['node_veh']
-    streets_wave_local = nx.compose(graph_veh_u, streets_wave)
-    streets_wave_local = nx.compose(graph_veh_v, streets_wave_local)
+def route_is_orthogonal(route, max_angle=np.pi):
+    """Determines if the sum of the angles along a route is small enough for NLOS on an orthogonal street and the
+    position of the max angle"""
 
-    # NOTE: We suboptimally use the length of roads between nodes as weight for routing and not the angle
-    route = line_route_between_nodes(
-        node_u, node_v, streets_wave_local)
     angles = geom_o.angles_along_line(route)
     angles_wrapped = np.pi - np.abs(geom_o.wrap_to_pi(angles))
 
@@ -174,16 +647,21 @@ def check_if_cons_are_orthogonal(streets_wave,
                                  graphs_veh_other,
                                  max_angle=np.pi):
     """Determines if the propagation condition is NLOS on an orthogonal street for every possible
-    connection to one node"""
+    connection to one node. `streets_wave` can be the wave propagation graph or its route table or turn graph"""
 
     count_veh_other = np.size(graphs_veh_other)
 
+    if isinstance(streets_wave, TurnGraph):
+        routes = streets_wave.routes_between_vehs([graph_veh_own] * count_veh_other, graphs_veh_other)
+    else:
+        routes_wave = get_route_table(streets_wave)
+        routes = [routes_wave.route_between_vehs(graph_veh_own, graph) for graph in graphs_veh_other]
+
     is_orthogonal = np.zeros(count_veh_other, dtype=bool)
     coords_max_angle = np.zeros((count_veh_other, 2))
-    for index, graph in enumerate(graphs_veh_other):
+    for index, route in enumerate(routes):
         is_orthogonal[index], coords_max_angle[index, :] = \
-            check_if_con_is_orthogonal(
-                streets_wave, graph_veh_own, graph, max_angle=max_angle)
+            route_is_orthogonal(route, max_angle=max_angle)
 
     return is_orthogonal, coords_max_angle
 
@@ -204,32 +682,57 @@ def line_route_between_nodes(node_from, node_to, graph):
     return line
 
 
-def add_edges_if_los(graph, buildings, max_distance=50):
-    """Adds edges to the streets graph if there is none between 2 nodes if there is none, the have
-    no buildings in between and are only a certain distance apart"""
+def init_los_worker(index_buildings):
+    """Initializes a worker process of add_edges_if_los. The spatial index of the buildings is stored once per worker
+    and used by all of its tasks"""
 
-    for index, node_u in enumerate(graph.nodes()):
-        coords_u = np.array((graph.node[node_u]['x'], graph.node[node_u]['y']))
-        for node_v in graph.nodes()[index + 1:]:
+    global worker_index_buildings
+    worker_index_buildings = index_buildings
 
-            # Check if nodes are already connected
-            if graph.has_edge(node_u, node_v):
-                continue
-            coords_v = np.array(
-                (graph.node[node_v]['x'], graph.node[node_v]['y']))
-            distance = np.linalg.norm(coords_u - coords_v, ord=2)
 
-            # Check if the nodes are further apart than the max distance
-            if distance > max_distance:
-                continue
+def lines_intersect_buildings_worker(coords_start, coords_end):
+    """Determines if lines intersect buildings using the spatial index of the buildings of the worker process.
+    See also: geometry.lines_intersect_buildings"""
 
-            # Check if there are buildings between the nodes
-            line = geom.LineString(
-                [(coords_u[0], coords_u[1]), (coords_v[0], coords_v[1])])
+    return geom_o.lines_intersect_buildings(coords_start, coords_end, worker_index_buildings)
 
-            if geom_o.line_intersects_buildings(line, buildings):
-                continue
 
-            # Add edge between nodes
-            edge_attr = {'length': distance, 'geometry': line}
-            graph.add_edge(node_u, node_v, attr_dict=edge_attr)
+def add_edges_if_los(graph, buildings, max_distance=50, processes=1, chunk_size=4096):
+    """Adds edges to the streets graph if there is none between 2 nodes if there is none, the have
+    no buildings in between and are only a certain distance apart. Candidate node pairs are found with a k-d tree
+    and the check for buildings can be split among multiple `processes`"""
+
+    index_buildings = geom_o.get_building_index(buildings)
+
+    nodes = graph.nodes()
+    coords_nodes = np.array([(graph.node[node]['x'], graph.node[node]['y']) for node in nodes], dtype=float)
+    coords_nodes = coords_nodes.reshape(-1, 2)
+
+    # Only nodes that are not further apart than the max distance
+    tree = cKDTree(coords_nodes)
+    pairs = np.array(sorted(tree.query_pairs(max_distance)), dtype=int).reshape(-1, 2)
+
+    # Check if nodes are already connected
+    is_unconnected = np.array([not graph.has_edge(nodes[idx_u], nodes[idx_v]) for idx_u, idx_v in pairs],
+                              dtype=bool)
+    pairs = pairs[is_unconnected]
+
+    # Check if there are buildings between the nodes
+    coords_u = coords_nodes[pairs[:, 0]]
+    coords_v = coords_nodes[pairs[:, 1]]
+    if processes == 1:
+        intersects = geom_o.lines_intersect_buildings(coords_u, coords_v, index_buildings)
+    else:
+        # The buildings are handed to every worker process once, the tasks only contain the coordinates
+        chunks = [(coords_u[idx:idx + chunk_size], coords_v[idx:idx + chunk_size])
+                  for idx in range(0, pairs.shape[0], chunk_size)]
+        with mp.Pool(processes=processes, initializer=init_los_worker, initargs=(index_buildings,)) as pool:
+            intersects = pool.starmap(lines_intersect_buildings_worker, chunks)
+        intersects = np.concatenate([np.zeros(0, dtype=bool)] + intersects)
+
+    # Add edges between nodes
+    for (idx_u, idx_v), coords_u_pair, coords_v_pair in zip(pairs[~intersects], coords_u[~intersects],
+                                                            coords_v[~intersects]):
+        line = geom.LineString([tuple(coords_u_pair), tuple(coords_v_pair)])
+        edge_attr = {'length': np.linalg.norm(coords_u_pair - coords_v_pair, ord=2), 'geometry': line}
+        graph.add_edge(nodes[idx_u], nodes[idx_v], attr_dict=edge_attr)
@@ -4,8 +4,10 @@ import logging
 import multiprocessing as mp
 import os
 import signal
+import threading
 import time
-from itertools import repeat
+from contextlib import closing
+from itertools import count, repeat
 from optparse import OptionParser
 
 import numpy as np
@@ -18,6 +20,7 @@ from .. import geometry as geom_o
 from .. import network_parser as nw_p
 from .. import osmnx_addons as ox_a
 from .. import plot
+from .. import propagation as prop
 from .. import sumo
 from .. import utils
 from .. import vehicles
@@ -28,6 +31,9 @@ rte_count_con_total = 0
 rte_time_start = 0
 rte_time_checkpoint = 0
 
+# Network of a worker process of the simulation pool, see init_worker
+worker_net = None
+
 
 def parse_cmd_args():
     """Parses command line options"""
@@ -77,9 +83,19 @@ def sim_single_sumo(snapshot,
                     gdf_buildings,
                     max_metric,
                     metric='distance',
-                    graph_streets_wave=None):
+                    graph_streets_wave=None,
+                    metric_config=None,
+                    prop_cond_tracker=None,
+                    random_seed=None):
     """Runs a single snapshot analysis of a SUMO simulation result.
-    Can be run in parallel"""
+    `graph_streets` can be the streets graph or its spatial index and `graph_streets_wave` the route table or turn
+    graph of the wave propagation graph matching `metric_config['route_weight']`. Can be run in parallel.
+    A `prop_cond_tracker` carries the propagation conditions over from the previous snapshot. If a `random_seed` is
+    given the shadow fading is drawn from a random number generator seeded with it"""
+
+    if random_seed is not None:
+        metric_config = {} if metric_config is None else dict(metric_config)
+        metric_config['rng'] = np.random.default_rng(random_seed)
 
     # TODO: too much distance between SUMO vehicle positions and
     # OSMnx streets?
@@ -93,7 +109,9 @@ def sim_single_sumo(snapshot,
         gdf_buildings,
         max_metric,
         metric=metric,
-        graph_streets_wave=graph_streets_wave)
+        graph_streets_wave=graph_streets_wave,
+        metric_config=metric_config,
+        prop_cond_tracker=prop_cond_tracker)
 
     return matrix_cons, vehs
 
@@ -104,20 +122,26 @@ def sim_single_uniform(random_seed,
                        gdf_buildings,
                        max_metric,
                        metric='distance',
-                       graph_streets_wave=None):
+                       graph_streets_wave=None,
+                       metric_config=None):
     """Runs a single iteration of a simulation with uniform vehicle distribution.
-    Can be run in parallel"""
+    `graph_streets` can be the streets graph or its spatial index and `graph_streets_wave` the route table or turn
+    graph of the wave propagation graph matching `metric_config['route_weight']`. `random_seed` seeds the random
+    number generator of the vehicle placement and the shadow fading. Can be run in parallel"""
 
     # Seed random number generator
-    np.random.seed(random_seed)
+    rng = np.random.default_rng(random_seed)
+    metric_config = {} if metric_config is None else dict(metric_config)
+    metric_config['rng'] = rng
 
     # Choose street indexes
-    street_lengths = geom_o.get_street_lengths(graph_streets)
+    index_streets = geom_o.get_street_index(graph_streets)
+    street_lengths = index_streets.lengths
     rand_street_idxs = vehicles.choose_random_streets(
-        street_lengths, count_veh)
+        street_lengths, count_veh, rng=rng)
 
     # Vehicle generation
-    vehs = vehicles.generate_vehs(graph_streets, street_idxs=rand_street_idxs)
+    vehs = vehicles.generate_vehs(index_streets, street_idxs=rand_street_idxs, rng=rng)
 
     # Generate connection matrix
     matrix_cons = con_ana.gen_connection_matrix(
@@ -125,11 +149,99 @@ def sim_single_uniform(random_seed,
         gdf_buildings,
         max_metric,
         metric=metric,
-        graph_streets_wave=graph_streets_wave)
+        graph_streets_wave=graph_streets_wave,
+        metric_config=metric_config)
 
     return matrix_cons, vehs
 
 
+def gen_random_seed(count_veh, idx):
+    """Returns the seed of the random number generator of the snapshot or iteration `idx`. The vehicle count is part
+    of the seed so that the simulations of different vehicle densities do not draw the same random numbers"""
+
+    return np.random.SeedSequence((int(count_veh), int(idx)))
+
+
+def run_indexed_task(task):
+    """Runs a task of `imap_bounded` and returns its result together with its index"""
+
+    idx_task, function, args = task
+    return idx_task, function(*args)
+
+
+def imap_bounded(pool, function, iterable, max_in_flight, chunk_size=1):
+    """Applies `function` to every argument tuple of `iterable` using the `pool` and yields the results in order.
+    Tasks are submitted lazily and at most `max_in_flight` tasks are submitted but not yet yielded, so neither the
+    arguments nor the results have to be kept in memory at once.
+    If a task fails its exception is raised. The generator has to be closed (e.g. with `contextlib.closing`) before
+    the pool is terminated if it is not exhausted, otherwise the task handler of the pool can not exit"""
+
+    # Every chunk has to fit into the in flight tasks
+    max_in_flight = max(max_in_flight, chunk_size)
+    semaphore = threading.BoundedSemaphore(max_in_flight)
+    is_stopped = threading.Event()
+
+    def tasks():
+        # Runs in the task handler thread of the pool and stops submitting once the consumer is gone
+        for idx_task, args in enumerate(iterable):
+            while not semaphore.acquire(timeout=0.1):
+                if is_stopped.is_set():
+                    return
+            if is_stopped.is_set():
+                return
+            yield idx_task, function, args
+
+    results_pending = {}
+    idx_next = 0
+    try:
+        for idx_task, result in pool.imap_unordered(run_indexed_task, tasks(), chunksize=chunk_size):
+            results_pending[idx_task] = result
+
+            # Reassemble the order of the tasks
+            while idx_next in results_pending:
+                yield results_pending.pop(idx_next)
+                idx_next += 1
+                semaphore.release()
+    finally:
+        is_stopped.set()
+
+
+def init_worker(net_worker):
+    """Initializes a worker process of the simulation pool. The network (streets and buildings index and wave
+    propagation routes) is stored once per worker and used by all of its tasks"""
+
+    global worker_net
+    worker_net = net_worker
+
+
+def sim_single_sumo_worker(snapshot, max_metric, metric='distance', metric_config=None, random_seed=None):
+    """Runs a single snapshot analysis of a SUMO simulation result with the network of the worker process.
+    See also: sim_single_sumo"""
+
+    return sim_single_sumo(snapshot,
+                           worker_net['index_streets'],
+                           worker_net['index_buildings'],
+                           max_metric,
+                           metric=metric,
+                           graph_streets_wave=worker_net['routes_wave'],
+                           metric_config=metric_config,
+                           random_seed=random_seed)
+
+
+def sim_single_uniform_worker(random_seed, count_veh, max_metric, metric='distance', metric_config=None):
+    """Runs a single iteration of a simulation with uniform vehicle distribution with the network of the worker
+    process. See also: sim_single_uniform"""
+
+    return sim_single_uniform(random_seed,
+                              count_veh,
+                              worker_net['index_streets'],
+                              worker_net['index_buildings'],
+                              max_metric,
+                              metric=metric,
+                              graph_streets_wave=worker_net['routes_wave'],
+                              metric_config=metric_config)
+
+
 def main_multi_scenario(conf_path=None, scenarios=None):
     """Simulates multiple scenarios"""
 
@@ -191,14 +303,33 @@ def main(conf_path=None, scenario=None):
     # We are logging to dev/null as a workaround to get nice log output and so that specified levels are respected
     ox_a.setup()
 
+    # The processes of the parallel mode also generate the network
+    if config['simulation_mode'] == 'parallel':
+        processes = config['processes'] if config['processes'] is not None else mp.cpu_count()
+    else:
+        processes = 1
+
     # Load street network
     time_start = utils.debug(None, 'Loading street network')
     net = ox_a.load_network(config['place'],
                             which_result=config['which_result'],
-                            tolerance=config['building_tolerance'])
+                            tolerance=config['building_tolerance'],
+                            processes=processes)
     graph_streets = net['graph_streets']
     utils.debug(time_start)
 
+    # The routes in the wave propagation graph are only needed for the pathloss metric. They are generated once
+    # and shared by all snapshots
+    if config['connection_metric'] != 'pathloss':
+        net['routes_wave'] = None
+    elif config['route_weight'] == 'length':
+        net['routes_wave'] = prop.RouteTable(net['graph_streets_wave'])
+    elif config['route_weight'] == 'angle':
+        time_start = utils.debug(None, 'Generating turn graph of the wave propagation graph')
+        net['routes_wave'] = prop.TurnGraph(net['graph_streets_wave'])
+        utils.debug(time_start)
+    metric_config = {'route_weight': config['route_weight']}
+
     # Convert vehicle densities to counts
     counts_veh = np.zeros(densities_veh.size, dtype=int)
 
@@ -263,6 +394,7 @@ def main(conf_path=None, scenario=None):
                 continue
 
         time_start_iter = time.time()
+        rte_count_con_start = rte_count_con_checkpoint
         logging.info('Simulating {:d} vehicles'.format(count_veh))
 
         if config['distribution_veh'] == 'SUMO':
@@ -281,12 +413,18 @@ def main(conf_path=None, scenario=None):
                     intermediate_points=config['sumo']['intermediate_points'],
                     coordinate_tls=config['sumo']['coordinate_tls'],
                     directory=config['sumo']['directory'],
-                    veh_rate_factor=config['sumo']['veh_rate_factor'])
+                    veh_rate_factor=config['sumo']['veh_rate_factor'],
+                    stream=config['sumo']['stream_traces'])
                 utils.debug(time_start)
             else:
                 # Load vehicle traces
                 time_start = utils.debug(None, 'Loading vehicle traces')
-                veh_traces = sumo.load_veh_traces(
+                if config['sumo']['stream_traces']:
+                    # Snapshots are parsed while they are analyzed
+                    load_traces = sumo.stream_veh_traces
+                else:
+                    load_traces = sumo.load_veh_traces
+                veh_traces = load_traces(
                     config['place'],
                     file_suffix=str(count_veh),
                     directory=config['sumo']['directory'],
@@ -298,176 +436,200 @@ def main(conf_path=None, scenario=None):
                 logger.warning('Aborting after SUMO completed')
                 continue
 
-        # Determine connected vehicles
-        if config['simulation_mode'] == 'parallel':
-            if config['distribution_veh'] == 'SUMO':
-                if config['connection_metric'] == 'distance':
-                    sim_param_list = \
-                        zip(veh_traces,
-                            repeat(net['graph_streets']),
-                            repeat(net['gdf_buildings']),
-                            repeat(config['max_connection_metric']),
-                            repeat(config['connection_metric']))
-                elif config['connection_metric'] == 'pathloss':
-                    sim_param_list = \
-                        zip(veh_traces,
-                            repeat(net['graph_streets']),
-                            repeat(net['gdf_buildings']),
-                            repeat(config['max_connection_metric']),
-                            repeat(config['connection_metric']),
-                            repeat(net['graph_streets_wave']))
-                else:
+        # Save in and outputs
+        config_save = config.copy()
+        config_save['count_veh'] = count_veh
+
+        # Results are appended to a temporary file as they are produced and it is renamed when complete
+        if config['simulation_mode'] != 'demo':
+            filepath_res_part = filepath_res + '.part'
+            writer_res = utils.RecordWriter(filepath_res_part, chunk_size=config['results_chunk_size'])
+            writer_res.append({'config': config_save})
+
+        try:
+            # Determine connected vehicles
+            if config['simulation_mode'] == 'parallel':
+                if config['connection_metric'] not in ['distance', 'pathloss']:
                     raise NotImplementedError(
                         'Connection metric not supported')
-                with mp.Pool(processes=config['processes']) as pool:
-                    mp_res = pool.starmap(
-                        sim_single_sumo,
-                        sim_param_list
-                    )
 
-            elif config['distribution_veh'] == 'uniform':
-                random_seeds = np.arange(config['iterations'])
+                # The network is handed to every worker process once instead of with every task
+                net_worker = {'index_streets': net['index_streets'],
+                              'index_buildings': net['index_buildings'],
+                              'routes_wave': net['routes_wave']}
 
-                if config['connection_metric'] == 'distance':
+                if config['distribution_veh'] == 'SUMO':
+                    sim_function = sim_single_sumo_worker
+                    # The vehicle count and the snapshot index seed the random number generator as in the sequential
+                    # mode
                     sim_param_list = \
-                        zip(random_seeds,
-                            repeat(count_veh),
-                            repeat(net['graph_streets']),
-                            repeat(net['gdf_buildings']),
+                        zip(veh_traces,
                             repeat(config['max_connection_metric']),
-                            repeat(config['connection_metric']))
-                elif config['connection_metric'] == 'pathloss':
+                            repeat(config['connection_metric']),
+                            repeat(metric_config),
+                            (gen_random_seed(count_veh, idx) for idx in count()))
+                    count_tasks = len(veh_traces) if hasattr(veh_traces, '__len__') else None
+
+                elif config['distribution_veh'] == 'uniform':
+                    random_seeds = [gen_random_seed(count_veh, iteration) for iteration in range(config['iterations'])]
+
+                    sim_function = sim_single_uniform_worker
                     sim_param_list = \
                         zip(random_seeds,
                             repeat(count_veh),
-                            repeat(net['graph_streets']),
-                            repeat(net['gdf_buildings']),
                             repeat(config['max_connection_metric']),
                             repeat(config['connection_metric']),
-                            repeat(net['graph_streets_wave']))
+                            repeat(metric_config))
+                    count_tasks = config['iterations']
+
                 else:
                     raise NotImplementedError(
-                        'Connection metric not supported')
-                with mp.Pool(processes=config['processes']) as pool:
-                    mp_res = pool.starmap(
-                        sim_single_uniform,
-                        sim_param_list)
-
-            else:
-                raise NotImplementedError(
-                    'Vehicle distribution type not supported')
-
-            # Check result
-            if len(mp_res) == 0:
-                matrices_cons, vehs = [], []
-            else:
-                matrices_cons, vehs = list(zip(*mp_res))
-
-            # Define which variables to save in a file
-            results = {'matrices_cons': matrices_cons, 'vehs': vehs}
-
-        elif config['simulation_mode'] == 'sequential':
-            if config['distribution_veh'] == 'SUMO':
-                matrices_cons = np.zeros(veh_traces.size, dtype=object)
-                vehs = np.zeros(veh_traces.size, dtype=object)
-                for idx, snapshot in enumerate(veh_traces):
-                    time_start = utils.debug(
-                        None, 'Analyzing snapshot {:d}'.format(idx))
-
-                    if config['connection_metric'] == 'distance':
-                        matrix_cons_snapshot, vehs_snapshot = \
-                            sim_single_sumo(
-                                snapshot,
-                                net['graph_streets'],
-                                net['gdf_buildings'],
-                                max_metric=config['max_connection_metric'],
-                                metric=config['connection_metric'])
-                    elif config['connection_metric'] == 'pathloss':
-                        matrix_cons_snapshot, vehs_snapshot = \
-                            sim_single_sumo(
-                                snapshot,
-                                net['graph_streets'],
-                                net['gdf_buildings'],
-                                max_metric=config['max_connection_metric'],
-                                metric=config['connection_metric'],
-                                graph_streets_wave=net['graph_streets_wave'])
-                    else:
-                        raise NotImplementedError(
-                            'Connection metric not supported')
-
-                    matrices_cons[idx] = matrix_cons_snapshot
-                    vehs[idx] = vehs_snapshot
-                    utils.debug(time_start)
-            elif config['distribution_veh'] == 'uniform':
-                matrices_cons = np.zeros(config['iterations'], dtype=object)
-                vehs = np.zeros(config['iterations'], dtype=object)
-                for iteration in np.arange(config['iterations']):
-                    time_start = utils.debug(
-                        None, 'Analyzing iteration {:d}'.format(iteration))
-
-                    if config['connection_metric'] == 'distance':
-                        matrix_cons_snapshot, vehs_snapshot = \
-                            sim_single_uniform(
-                                iteration,
-                                count_veh,
-                                net['graph_streets'],
-                                net['gdf_buildings'],
-                                max_metric=config['max_connection_metric'],
-                                metric=config['connection_metric'])
-                    elif config['connection_metric'] == 'pathloss':
-                        matrix_cons_snapshot, vehs_snapshot = \
-                            sim_single_uniform(
-                                iteration,
-                                count_veh,
-                                net['graph_streets'],
-                                net['gdf_buildings'],
-                                max_metric=config['max_connection_metric'],
-                                metric=config['connection_metric'],
-                                graph_streets_wave=net['graph_streets_wave'])
+                        'Vehicle distribution type not supported')
+
+                chunk_size = config['tasks_chunk_size']
+                if chunk_size is None:
+                    # Small chunks keep the in flight window (and memory) independent of the number of tasks
+                    chunk_size = 4 if count_tasks is None else min(4, max(1, count_tasks // (4 * processes)))
+                max_in_flight = config['max_tasks_in_flight']
+                if max_in_flight is None:
+                    max_in_flight = 2 * processes * chunk_size
+
+                # Results are written as soon as they arrive (in order), only a bounded number of tasks is in flight
+                count_con_snapshot = count_veh * (count_veh - 1) // 2
+                time_last_log = time.time()
+                with mp.Pool(processes=processes, initializer=init_worker, initargs=(net_worker,)) as pool:
+                    mp_res = imap_bounded(pool, sim_function, sim_param_list, max_in_flight, chunk_size=chunk_size)
+                    with closing(mp_res):
+                        for idx_task, (matrix_cons_snapshot, vehs_snapshot) in enumerate(mp_res):
+                            writer_res.append({'matrix_cons': con_ana.pack_connections(matrix_cons_snapshot),
+                                               'vehs': vehs_snapshot})
+
+                            # Progress report
+                            rte_count_con_checkpoint += count_con_snapshot
+                            rte_time_checkpoint = time.time() - rte_time_start
+                            if time.time() - time_last_log >= config['progress_interval']:
+                                time_last_log = time.time()
+                                if count_tasks is None:
+                                    logging.info('Completed {:d} tasks'.format(idx_task + 1))
+                                else:
+                                    logging.info('Completed {:d} of {:d} tasks'.format(idx_task + 1, count_tasks))
+                                log_progress(rte_count_con_checkpoint, rte_count_con_total,
+                                             rte_time_checkpoint, rte_time_start)
+
+            elif config['simulation_mode'] == 'sequential':
+                if config['distribution_veh'] == 'SUMO':
+                    # Consecutive snapshots only differ slightly, propagation conditions are updated incrementally
+                    if config['sumo']['prop_cond_tolerance'] is None:
+                        prop_cond_tracker = None
                     else:
-                        raise NotImplementedError(
-                            'Connection metric not supported')
-
-                    matrices_cons[iteration] = matrix_cons_snapshot
-                    vehs[iteration] = vehs_snapshot
-                    utils.debug(time_start)
-            else:
-                raise NotImplementedError(
-                    'Vehicle distribution type not supported')
-
-            # Define which variables to save in a file
-            results = {'matrices_cons': matrices_cons, 'vehs': vehs}
-
-        elif config['simulation_mode'] == 'demo':
-            vehicles.place_vehicles_in_network(net,
-                                               density_veh=config['densities_veh'],
-                                               density_type=config['density_type'])
-            demo.simulate(net, max_pl=config['max_connection_metric'])
-
-            # Define which variables to save in a file
-            results = {'vehs': net['vehs']}
-
-        else:
-            raise NotImplementedError('Simulation mode not supported')
-
-        # Progress report
-        rte_time_checkpoint = time.time() - rte_time_start
-        rte_count_con_checkpoint += rte_counts_con[idx_count_veh]
-        log_progress(rte_count_con_checkpoint, rte_count_con_total,
-                     rte_time_checkpoint, rte_time_start)
+                        prop_cond_tracker = prop.PropCondTracker(
+                            net['index_buildings'], tolerance=config['sumo']['prop_cond_tolerance'])
+
+                    for idx, snapshot in enumerate(veh_traces):
+                        time_start = utils.debug(
+                            None, 'Analyzing snapshot {:d}'.format(idx))
+
+                        if config['connection_metric'] == 'distance':
+                            matrix_cons_snapshot, vehs_snapshot = \
+                                sim_single_sumo(
+                                    snapshot,
+                                    net['index_streets'],
+                                    net['index_buildings'],
+                                    max_metric=config['max_connection_metric'],
+                                    metric=config['connection_metric'],
+                                    prop_cond_tracker=prop_cond_tracker,
+                                    random_seed=gen_random_seed(count_veh, idx))
+                        elif config['connection_metric'] == 'pathloss':
+                            matrix_cons_snapshot, vehs_snapshot = \
+                                sim_single_sumo(
+                                    snapshot,
+                                    net['index_streets'],
+                                    net['index_buildings'],
+                                    max_metric=config['max_connection_metric'],
+                                    metric=config['connection_metric'],
+                                    graph_streets_wave=net['routes_wave'],
+                                    metric_config=metric_config,
+                                    prop_cond_tracker=prop_cond_tracker,
+                                    random_seed=gen_random_seed(count_veh, idx))
+                        else:
+                            raise NotImplementedError(
+                                'Connection metric not supported')
+
+                        writer_res.append({'matrix_cons': con_ana.pack_connections(matrix_cons_snapshot),
+                                           'vehs': vehs_snapshot})
+                        utils.debug(time_start)
+                elif config['distribution_veh'] == 'uniform':
+                    for iteration in np.arange(config['iterations']):
+                        time_start = utils.debug(
+                            None, 'Analyzing iteration {:d}'.format(iteration))
+
+                        if config['connection_metric'] == 'distance':
+                            matrix_cons_snapshot, vehs_snapshot = \
+                                sim_single_uniform(
+                                    gen_random_seed(count_veh, iteration),
+                                    count_veh,
+                                    net['index_streets'],
+                                    net['index_buildings'],
+                                    max_metric=config['max_connection_metric'],
+                                    metric=config['connection_metric'])
+                        elif config['connection_metric'] == 'pathloss':
+                            matrix_cons_snapshot, vehs_snapshot = \
+                                sim_single_uniform(
+                                    gen_random_seed(count_veh, iteration),
+                                    count_veh,
+                                    net['index_streets'],
+                                    net['index_buildings'],
+                                    max_metric=config['max_connection_metric'],
+                                    metric=config['connection_metric'],
+                                    graph_streets_wave=net['routes_wave'],
+                                    metric_config=metric_config)
+                        else:
+                            raise NotImplementedError(
+                                'Connection metric not supported')
+
+                        writer_res.append({'matrix_cons': con_ana.pack_connections(matrix_cons_snapshot),
+                                           'vehs': vehs_snapshot})
+                        utils.debug(time_start)
+                else:
+                    raise NotImplementedError(
+                        'Vehicle distribution type not supported')
 
-        # Save in and outputs
-        config_save = config.copy()
-        config_save['count_veh'] = count_veh
+            elif config['simulation_mode'] == 'demo':
+                vehicles.place_vehicles_in_network(net,
+                                                   density_veh=config['densities_veh'],
+                                                   density_type=config['density_type'])
+                demo.simulate(net, max_pl=config['max_connection_metric'])
 
-        time_finish_iter = time.time()
-        info_vars = {'time_start': time_start_iter,
-                     'time_finish': time_finish_iter}
-        save_vars = {'config': config_save,
-                     'results': results,
-                     'info': info_vars}
+                # Define which variables to save in a file
+                results = {'vehs': net['vehs']}
 
-        utils.save(save_vars, filepath_res)
+            else:
+                raise NotImplementedError('Simulation mode not supported')
+
+            # Progress report
+            rte_time_checkpoint = time.time() - rte_time_start
+            rte_count_con_checkpoint = rte_count_con_start + rte_counts_con[idx_count_veh]
+            log_progress(rte_count_con_checkpoint, rte_count_con_total,
+                         rte_time_checkpoint, rte_time_start)
+
+            time_finish_iter = time.time()
+            info_vars = {'time_start': time_start_iter,
+                         'time_finish': time_finish_iter}
+
+            if config['simulation_mode'] == 'demo':
+                save_vars = {'config': config_save,
+                             'results': results,
+                             'info': info_vars}
+                utils.save(save_vars, filepath_res)
+            else:
+                writer_res.append({'info': info_vars})
+                writer_res.close()
+                os.replace(filepath_res_part, filepath_res)
+        except BaseException:
+            # Do not leave an incomplete results file behind, e.g. when a task failed or the run was interrupted
+            if config['simulation_mode'] != 'demo' and os.path.isfile(filepath_res_part):
+                os.remove(filepath_res_part)
+            raise
 
     time_finish_total = time.time()
     runtime_total = time_finish_total - time_start_total
@@ -3,6 +3,7 @@
 import logging
 import multiprocessing as mp
 import os
+import time
 
 import networkx as nx
 import numpy as np
@@ -135,7 +136,8 @@ def main(conf_path=None, scenario=None):
     for filepath_res, filepath_ana in zip(filepaths_res, filepaths_ana):
         # Analyze results
         analyze_single(filepath_res, filepath_ana, config['analyze_results'], multiprocess=multiprocess,
-                       processes=processes)
+                       processes=processes, backend=config['analysis_backend'],
+                       min_node_cut=config['min_node_cut'], min_node_cut_interval=config['min_node_cut_interval'])
 
     logging.info('Merging all analysis results')
     analysis_results = {}
@@ -156,36 +158,93 @@ def main(conf_path=None, scenario=None):
 
     return analysis_results
 
-def load_results(filepath_res, multiprocess=False, processes=None):
-    "Loads the results file, converts the connection matrices to graphs and returns the connection graphs and vehicles"
+def iter_results(filepath_res):
+    """Yields the connection matrix and the vehicles of every snapshot (or iteration) of a results file one by one.
+    Supports results files of appended records and single pickles of all results"""
+
+    for record in utils.load_records(filepath_res):
+        if 'results' in record:
+            # All results are stored in a single pickle
+            for matrix_cons, vehs in zip(record['results']['matrices_cons'], record['results']['vehs']):
+                yield matrix_cons, vehs
+        elif 'matrix_cons' in record:
+            yield record['matrix_cons'], record['vehs']
+
+
+def read_results(filepath_res):
+    """Loads a results file completely. Returns a dictionary with the configuration, the results and the run time
+    info"""
+
+    results = {'config': None, 'results': {'matrices_cons': [], 'vehs': []}, 'info': None}
+    for record in utils.load_records(filepath_res):
+        if 'results' in record:
+            return record
+        elif 'matrix_cons' in record:
+            results['results']['matrices_cons'].append(record['matrix_cons'])
+            results['results']['vehs'].append(record['vehs'])
+        elif 'config' in record:
+            results['config'] = record['config']
+        elif 'info' in record:
+            results['info'] = record['info']
+
+    return results
+
+
+def matrix_to_graph(matrix_cons):
+    """Converts a connection matrix (dense or packed) to a graph"""
+
+    if isinstance(matrix_cons, con_ana.PackedConnections):
+        return con_ana.packed_to_graph(matrix_cons)
+
+    return nx.from_numpy_matrix(matrix_cons)
+
+
+def load_results(filepath_res, multiprocess=False, processes=None, backend='sparse'):
+    """Loads the results file, converts the connection matrices to sparse matrices (`backend` 'sparse') or graphs
+    (`backend` 'networkx') and returns them together with the vehicles"""
+
+    if backend == 'sparse':
+        convert_function = con_ana.to_sparse_matrix
+    elif backend == 'networkx':
+        convert_function = matrix_to_graph
+    else:
+        raise NotImplementedError('Analysis backend not supported')
 
     # Load the connection results
     logging.info('Loading results file')
-    results_loaded = utils.load(filepath_res)
-    matrices_cons = results_loaded['results']['matrices_cons']
-    vehs = results_loaded['results']['vehs']
-
-    # Check if given connection results are not empty
-    if len(matrices_cons) == 0 or vehs[0].count == 1:
-        return
 
-    # Transform connection matrices to graphs
+    # Transform connection matrices while streaming the results
+    vehs = []
     if multiprocess:
+        def iter_matrices_cons():
+            for matrix_cons, vehs_snapshot in iter_results(filepath_res):
+                vehs.append(vehs_snapshot)
+                yield matrix_cons
+
         with mp.Pool(processes=processes) as pool:
-            graphs_cons = pool.map(nx.from_numpy_matrix, matrices_cons)
+            graphs_cons = list(pool.imap(convert_function, iter_matrices_cons()))
     else:
         graphs_cons = []
-        for matrix_cons in matrices_cons:
-            graphs_cons.append(nx.from_numpy_matrix(matrix_cons))
+        for matrix_cons, vehs_snapshot in iter_results(filepath_res):
+            graphs_cons.append(convert_function(matrix_cons))
+            vehs.append(vehs_snapshot)
+
+    # Check if given connection results are not empty
+    if len(graphs_cons) == 0 or vehs[0].count == 1:
+        return
 
     results_processed = {'graphs_cons': graphs_cons,
                          'vehs': vehs}
 
     return results_processed
 
-def analyze_single(filepath_res, filepath_ana, config_analysis, multiprocess=False, processes=None):
+
+def analyze_single(filepath_res, filepath_ana, config_analysis, multiprocess=False, processes=None,
+                   backend='sparse', min_node_cut='exact', min_node_cut_interval=1):
     """Runs a single vehicle count analysis of a simulation result.
-    Can be run in parallel"""
+    Can be run in parallel. With the 'sparse' `backend` the snapshots are kept as sparse matrices and NetworkX graphs
+    are only built for the minimum node cuts and the path redundancies. The minimum node cut of the network
+    connectivity is determined with the method `min_node_cut` for every `min_node_cut_interval`-th snapshot"""
 
     # Check if analysis to be performed is set
     if config_analysis is None:
@@ -193,6 +252,7 @@ def analyze_single(filepath_res, filepath_ana, config_analysis, multiprocess=Fal
         return
 
     all_analysis = ['net_connectivities',
+                    'degree_stats',
                     'path_redundancies_all',
                     'link_durations',
                     'connection_durations']
@@ -204,7 +264,7 @@ def analyze_single(filepath_res, filepath_ana, config_analysis, multiprocess=Fal
         raise RuntimeError('Analysis not supported')
 
 
-    loaded_results = load_results(filepath_res, multiprocess=multiprocess, processes=processes)
+    loaded_results = load_results(filepath_res, multiprocess=multiprocess, processes=processes, backend=backend)
     if loaded_results is None:
         logging.warning('Nothing to analyze. Exiting')
         utils.save(None, filepath_ana)
@@ -220,15 +280,27 @@ def analyze_single(filepath_res, filepath_ana, config_analysis, multiprocess=Fal
     # Determine network connectivities
     if 'net_connectivities' in config_analysis:
         logging.info('Determining network connectivities')
+        time_start_net = time.time()
 
         if multiprocess:
-            with mp.Pool(processes=processes) as pool:
-                net_connectivities = pool.map(con_ana.calc_net_connectivity, graphs_cons)
+            net_connectivities = con_ana.calc_net_connectivities_multiprocess(
+                graphs_cons, processes=processes, min_node_cut=min_node_cut,
+                min_node_cut_interval=min_node_cut_interval)
         else:
-            net_connectivities = con_ana.calc_net_connectivities(graphs_cons)
+            net_connectivities = con_ana.calc_net_connectivities(
+                graphs_cons, min_node_cut=min_node_cut, min_node_cut_interval=min_node_cut_interval)
+
+        logging.info('Determined network connectivities of {:d} snapshots in {:.2f} s (minimum node cut: {}, every '
+                     '{:d} snapshots)'.format(len(graphs_cons), time.time() - time_start_net, min_node_cut,
+                                              min_node_cut_interval))
 
         analysis_result['net_connectivities'] = net_connectivities
 
+    # Determine node degree statistics
+    if 'degree_stats' in config_analysis:
+        logging.info('Determining node degree statistics')
+        analysis_result['degree_stats'] = [con_ana.calc_degree_stats(graph_cons) for graph_cons in graphs_cons]
+
     # Determine path redundancies for center vehicle (node disjoint and path disjoint)
     if 'path_redundancies_center' in config_analysis:
         logging.info('Determining center path redundancies')
@@ -278,7 +350,7 @@ def analyze_single(filepath_res, filepath_ana, config_analysis, multiprocess=Fal
         analysis_result['connection_durations'] = connection_durations[0]
         analysis_result['rehealing_times'] = connection_durations[1]
         connection_stats = con_ana.calc_connection_stats(
-            connection_durations[0], graphs_cons[0].number_of_nodes())
+            connection_durations[0], con_ana.count_nodes_of(graphs_cons[0]))
         analysis_result['connection_duration_mean'] = connection_stats[0]
         analysis_result['connection_periods_mean'] = connection_stats[1]
 
@@ -6,6 +6,8 @@ import signal
 import numpy as np
 
 from . import main as main_sim
+from . import result_analysis
+from .. import connection_analysis as con_ana
 from .. import network_parser as nw_p
 from .. import utils
 
@@ -35,8 +37,10 @@ def analyze_tolerance(conf_path):
         result_dir = config['results_file_dir']
 
         for count_vehs in counts_vehs:
-            res_wo = utils.load(os.path.join(result_dir, 'tolerance_0_{}.{:d}.pickle.xz'.format(suffix, count_vehs)))
-            res_w = utils.load(os.path.join(result_dir, 'tolerance_1_{}.{:d}.pickle.xz'.format(suffix, count_vehs)))
+            res_wo = result_analysis.read_results(
+                os.path.join(result_dir, 'tolerance_0_{}.{:d}.pickle.xz'.format(suffix, count_vehs)))
+            res_w = result_analysis.read_results(
+                os.path.join(result_dir, 'tolerance_1_{}.{:d}.pickle.xz'.format(suffix, count_vehs)))
             run_time_wo = res_wo['info']['time_finish'] - res_wo['info']['time_start']
             run_time_w = res_w['info']['time_finish'] - res_w['info']['time_start']
             matrices_cons_wo = res_wo['results']['matrices_cons']
@@ -46,8 +50,13 @@ def analyze_tolerance(conf_path):
             count_tot = 0
 
             for matrix_cons_wo, matrix_cons_w in zip(matrices_cons_wo, matrices_cons_w):
-                count_diff += np.nonzero(matrix_cons_wo != matrix_cons_w)[0].size
-                count_tot += matrix_cons_w.size
+                if isinstance(matrix_cons_w, con_ana.PackedConnections):
+                    # Count in terms of the square matrices
+                    count_diff += 2 * con_ana.count_connection_differences(matrix_cons_wo, matrix_cons_w)
+                    count_tot += matrix_cons_w.count_veh ** 2
+                else:
+                    count_diff += np.nonzero(matrix_cons_wo != matrix_cons_w)[0].size
+                    count_tot += matrix_cons_w.size
 
             ratio_diff = count_diff / count_tot
             result = {'count_vehs': count_vehs,
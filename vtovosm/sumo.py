@@ -2,19 +2,165 @@
 
 import logging
 import os
+import shutil
+import struct
 import subprocess as sproc
 import sys
 import xml.etree.cElementTree as ET
 
 import numpy as np
 import osmnx as ox
-import shapely.geometry as geom
 
 from . import osm_xml
 from . import osmnx_addons as ox_a
 from . import utils
 from . import vehicles
 
+# Fields of a snapshot of the vehicle traces
+TRACES_DTYPE = [('time', 'float'),
+                ('id', 'uint'),
+                ('x', 'float'),
+                ('y', 'float')]
+
+# Size of the headers of the column files, fixed so that they can be rewritten once the number of entries is known
+NPY_HEADER_SIZE = 128
+
+
+class VehTraces:
+    """Columnar store of vehicle traces.
+    The fields of all snapshots are stored as flat arrays, the vehicles of snapshot k are the entries
+    `offsets[k]:offsets[k + 1]`. The arrays are saved as separate `.npy` files in a directory and loaded memory
+    mapped, only the accessed snapshots are read from disk. Indexing with an integer returns a snapshot as a
+    structured array, indexing with a slice or an index array returns a view that shares the flat arrays."""
+
+    def __init__(self, columns, offsets, idxs_snapshots=None):
+        self.columns = columns
+        self.offsets = offsets
+        if idxs_snapshots is None:
+            idxs_snapshots = np.arange(offsets.size - 1)
+        self.idxs_snapshots = idxs_snapshots
+
+    @classmethod
+    def from_snapshots(cls, snapshots, directory=None):
+        """Builds the store from an iterable of snapshots. If a `directory` is given the snapshots are written to it
+        one by one and the saved store is loaded memory mapped, otherwise the store is built in memory"""
+
+        if directory is not None:
+            save_snapshots(snapshots, directory)
+            return cls.load(directory)
+
+        columns = {name: [np.zeros(0, dtype=dtype)] for name, dtype in TRACES_DTYPE}
+        sizes = [0]
+        for snapshot in snapshots:
+            for name, _ in TRACES_DTYPE:
+                columns[name].append(np.asarray(snapshot[name]))
+            sizes.append(snapshot.size)
+
+        columns = {name: np.concatenate(column) for name, column in columns.items()}
+        offsets = np.cumsum(sizes)
+
+        return cls(columns, offsets)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Loads the store from the `directory`"""
+
+        columns = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+                   for name, _ in TRACES_DTYPE}
+        offsets = np.load(os.path.join(directory, 'offsets.npy'))
+
+        return cls(columns, offsets)
+
+    def save(self, directory):
+        """Saves the selected snapshots to the `directory`. An existing store in the `directory` is replaced"""
+
+        columns_snapshots = ({name: self.columns[name][self.offsets[idx]:self.offsets[idx + 1]]
+                              for name, _ in TRACES_DTYPE}
+                             for idx in self.idxs_snapshots)
+        save_snapshots(columns_snapshots, directory)
+
+    @property
+    def size(self):
+        """Number of snapshots"""
+
+        return self.idxs_snapshots.size
+
+    @property
+    def sizes(self):
+        """Number of vehicles in every snapshot"""
+
+        return self.offsets[self.idxs_snapshots + 1] - self.offsets[self.idxs_snapshots]
+
+    def snapshot(self, idx):
+        """Returns snapshot `idx` of the underlying store as a structured array"""
+
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        snapshot = np.zeros(end - start, dtype=TRACES_DTYPE)
+        for name, _ in TRACES_DTYPE:
+            snapshot[name] = self.columns[name][start:end]
+
+        return snapshot
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.snapshot(self.idxs_snapshots[key])
+        return VehTraces(self.columns, self.offsets, self.idxs_snapshots[key])
+
+    def __iter__(self):
+        for idx in self.idxs_snapshots:
+            yield self.snapshot(idx)
+
+
+def npy_header(dtype, count):
+    """Returns the header of a 1D array with `count` entries in the .npy format (version 1.0). The header is padded to
+    `NPY_HEADER_SIZE` bytes independent of `count`"""
+
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({:d},), }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), count)
+    header = header.ljust(NPY_HEADER_SIZE - len(np.lib.format.MAGIC_PREFIX) - 4 - 1) + '\n'
+
+    return np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def save_snapshots(snapshots, directory):
+    """Saves an iterable of snapshots as a trace store to the `directory`. The columns of every snapshot are appended
+    to the column files, only one snapshot is held in memory at once. An existing store in the `directory` is replaced.
+    The files are written to a temporary directory that is renamed when complete, an interrupted save does not
+    leave an incomplete store behind"""
+
+    directory = os.path.normpath(directory)
+    directory_part = directory + '.part'
+    if os.path.isdir(directory_part):
+        shutil.rmtree(directory_part)
+    os.makedirs(directory_part)
+
+    files = {name: open(os.path.join(directory_part, name + '.npy'), 'wb') for name, _ in TRACES_DTYPE}
+    try:
+        for name, dtype in TRACES_DTYPE:
+            files[name].write(npy_header(dtype, 0))
+
+        sizes = [0]
+        for snapshot in snapshots:
+            for name, dtype in TRACES_DTYPE:
+                files[name].write(np.ascontiguousarray(snapshot[name], dtype=dtype).tobytes())
+            sizes.append(len(snapshot[TRACES_DTYPE[0][0]]))
+
+        count_entries = sum(sizes)
+        for name, dtype in TRACES_DTYPE:
+            files[name].seek(0)
+            files[name].write(npy_header(dtype, count_entries))
+    finally:
+        for file in files.values():
+            file.close()
+    np.save(os.path.join(directory_part, 'offsets.npy'), np.cumsum(sizes))
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(directory_part, directory)
+
 
 def simple_wrapper(place,
                    which_result=1,
@@ -30,9 +176,10 @@ def simple_wrapper(place,
                    directory='sumo_data/',
                    skip_if_exists=True,
                    veh_class='passenger',
-                   veh_rate_factor=None):
+                   veh_rate_factor=None,
+                   stream=False):
     """Generates and downloads all necessary files, runs a generic SUMO simulation
-    and returns the vehicle traces."""
+    and returns the vehicle traces. If `stream` is set a generator of the snapshots is returned instead."""
 
     filename_place = utils.string_to_filename(place)
     if count_veh is not None:
@@ -131,6 +278,14 @@ def simple_wrapper(place,
     else:
         logging.info('Skipping SUMO simulation run')
 
+    if stream:
+        logging.info('Streaming vehicle traces')
+        return stream_veh_traces(place,
+                                 file_suffix=str(count_veh),
+                                 directory=directory,
+                                 delete_first_n=warmup_duration,
+                                 count_veh=count_veh)
+
     logging.info('Loading parsing and cleaning vehicle traces')
     traces = load_veh_traces(place,
                              file_suffix=str(count_veh),
@@ -582,8 +737,55 @@ def download_streets_from_name(place,
 
 
 def load_veh_traces(place, directory='', file_suffix=None, delete_first_n=0, count_veh=None):
-    """Load parsed traces if they are available otherwise parse,
-    clean up (if requested) and save them. Return the traces"""
+    """Load parsed traces if they are available otherwise parse and save them. Return the traces cleaned up
+    (if requested)"""
+
+    filename_traces_dir, filename_traces_cleaned_dir, filename_traces_pickle, filename_traces_xml, \
+        filename_network = traces_filenames(place, directory=directory, file_suffix=file_suffix)
+
+    if os.path.isdir(filename_traces_dir):
+        traces = VehTraces.load(filename_traces_dir)
+    elif os.path.isdir(filename_traces_cleaned_dir):
+        return VehTraces.load(filename_traces_cleaned_dir)
+    elif os.path.isfile(filename_traces_pickle):
+        # Traces saved before the columnar store was introduced are already cleaned up. They are converted once to a
+        # separate store that is not cleaned up again when it is loaded
+        return VehTraces.from_snapshots(utils.load(filename_traces_pickle), directory=filename_traces_cleaned_dir)
+    else:
+        coord_offsets = get_coordinates_offset(filename_network)
+        traces = VehTraces.from_snapshots(iter_veh_traces(filename_traces_xml, coord_offsets),
+                                          directory=filename_traces_dir)
+
+    traces = clean_veh_traces(
+        traces, delete_first_n=delete_first_n, count_veh=count_veh)
+
+    return traces
+
+
+def stream_veh_traces(place, directory='', file_suffix=None, delete_first_n=0, count_veh=None):
+    """Yields the snapshots of the vehicle traces one by one. Loads the parsed traces if they are available,
+    otherwise parses and cleans up (if requested) the traces XML file while iterating. The streamed traces are not
+    saved"""
+
+    filename_traces_dir, filename_traces_cleaned_dir, filename_traces_pickle, filename_traces_xml, \
+        filename_network = traces_filenames(place, directory=directory, file_suffix=file_suffix)
+
+    if os.path.isdir(filename_traces_dir) or os.path.isdir(filename_traces_cleaned_dir) or \
+            os.path.isfile(filename_traces_pickle):
+        traces = load_veh_traces(place, directory=directory, file_suffix=file_suffix,
+                                 delete_first_n=delete_first_n, count_veh=count_veh)
+        for snapshot in traces:
+            yield snapshot
+    else:
+        coord_offsets = get_coordinates_offset(filename_network)
+        traces = iter_veh_traces(filename_traces_xml, coord_offsets)
+        for snapshot in iter_clean_veh_traces(traces, delete_first_n=delete_first_n, count_veh=count_veh):
+            yield snapshot
+
+
+def traces_filenames(place, directory='', file_suffix=None):
+    """Returns the paths of the trace store directory, the store directory of converted legacy traces, the legacy
+    traces pickle, the traces XML and the SUMO network files"""
 
     filename_place = utils.string_to_filename(place)
 
@@ -595,66 +797,99 @@ def load_veh_traces(place, directory='', file_suffix=None, delete_first_n=0, cou
     path_and_prefix = os.path.join(directory, filename_place)
     path_and_prefix_suffix = os.path.join(directory, filename_place_suffix)
 
-    filename_traces_npy = path_and_prefix_suffix + '.traces.pickle.xz'
+    filename_traces_dir = path_and_prefix_suffix + '.traces'
+    filename_traces_cleaned_dir = path_and_prefix_suffix + '.traces.cleaned'
+    filename_traces_pickle = path_and_prefix_suffix + '.traces.pickle.xz'
     filename_traces_xml = path_and_prefix_suffix + '.traces.xml'
     filename_network = path_and_prefix + '.net.xml'
 
-    if os.path.isfile(filename_traces_npy):
-        traces = utils.load(filename_traces_npy)
-    else:
-        coord_offsets = get_coordinates_offset(filename_network)
-        traces = parse_veh_traces(filename_traces_xml, coord_offsets)
-        traces = clean_veh_traces(
-            traces, delete_first_n=delete_first_n, count_veh=count_veh)
-        utils.save(traces, filename_traces_npy)
-    return traces
+    return filename_traces_dir, filename_traces_cleaned_dir, filename_traces_pickle, filename_traces_xml, \
+        filename_network
 
 
 def clean_veh_traces(veh_traces, delete_first_n=0, count_veh=None):
-    """Cleans up vehicle traces according to the given parameters"""
+    """Cleans up vehicle traces according to the given parameters. A trace store is cleaned up by selecting
+    snapshots in its index without copying them"""
 
-    # delete first n snapshots
-    veh_traces = veh_traces[delete_first_n:]
+    delete_first_n = delete_first_n or 0
 
-    # Delete snapshots with wrong number of vehicles
-    if count_veh is not None:
-        retain_mask = np.ones(veh_traces.size, dtype=bool)
-        for idx, snapshot in enumerate(veh_traces):
-            if snapshot.size != count_veh:
-                retain_mask[idx] = False
+    if isinstance(veh_traces, VehTraces):
+        idxs_retain = np.arange(delete_first_n, veh_traces.size)
+
+        if count_veh is not None:
+            sizes = veh_traces.sizes[idxs_retain]
+            for idx in np.flatnonzero(sizes != count_veh):
                 logging.warning(
-                    'Vehicle traces snapshot {:d} has wrong size ({:d} instead of {:d}), discarding'.format(idx,
-                                                                                                            snapshot.size,
-                                                                                                            count_veh))
-        veh_traces = veh_traces[retain_mask]
-        count_discarded = veh_traces.size - np.sum(retain_mask)
-        if count_discarded > 0:
-            logging.warning('Discarded {:d} out of {:d} snapshots'.format(count_discarded, veh_traces.size))
+                    'Vehicle traces snapshot {:d} has wrong size ({:d} instead of {:d}), discarding'.format(
+                        idx, sizes[idx], count_veh))
+            count_discarded = np.sum(sizes != count_veh)
+            if count_discarded > 0:
+                logging.warning('Discarded {:d} out of {:d} snapshots'.format(count_discarded, idxs_retain.size))
+            idxs_retain = idxs_retain[sizes == count_veh]
+
+        return veh_traces[idxs_retain]
 
-    return veh_traces
+    return snapshots_to_array(
+        iter_clean_veh_traces(veh_traces, delete_first_n=delete_first_n, count_veh=count_veh))
+
+
+def iter_clean_veh_traces(veh_traces, delete_first_n=0, count_veh=None):
+    """Cleans up vehicle traces according to the given parameters. `veh_traces` can be any iterable of snapshots,
+    the retained snapshots are yielded one by one"""
+
+    delete_first_n = delete_first_n or 0
+
+    count_total = 0
+    count_discarded = 0
+    for idx, snapshot in enumerate(veh_traces):
+        # delete first n snapshots
+        if idx < delete_first_n:
+            continue
+
+        count_total += 1
+
+        # Delete snapshots with wrong number of vehicles
+        if (count_veh is not None) and (snapshot.size != count_veh):
+            count_discarded += 1
+            logging.warning(
+                'Vehicle traces snapshot {:d} has wrong size ({:d} instead of {:d}), discarding'.format(
+                    idx - delete_first_n, snapshot.size, count_veh))
+            continue
+
+        yield snapshot
+
+    if count_discarded > 0:
+        logging.warning('Discarded {:d} out of {:d} snapshots'.format(count_discarded, count_total))
 
 
 def parse_veh_traces(filename, offsets=(0, 0), sort=True):
     """Parses a SUMO traces XML file and returns a numpy array"""
 
-    tree = ET.parse(filename)
-    root = tree.getroot()
+    return snapshots_to_array(iter_veh_traces(filename, offsets=offsets, sort=sort))
 
-    traces = np.zeros(len(root), dtype=object)
-    for idx_timestep, timestep in enumerate(root):
-        traces_snapshot = np.zeros(
-            len(timestep),
-            dtype=[('time', 'float'),
-                   ('id', 'uint'),
-                   ('x', 'float'),
-                   ('y', 'float')])
-        for idx_veh_node, veh_node in enumerate(timestep):
-            veh = veh_node.attrib
-            veh_id = int(veh['id'][3:])
-            traces_snapshot[idx_veh_node]['time'] = timestep.attrib['time']
-            traces_snapshot[idx_veh_node]['id'] = veh_id
-            traces_snapshot[idx_veh_node]['x'] = float(veh['x'])
-            traces_snapshot[idx_veh_node]['y'] = float(veh['y'])
+
+def iter_veh_traces(filename, offsets=(0, 0), sort=True):
+    """Parses a SUMO traces XML file incrementally and yields the snapshots of the timesteps one by one.
+    Parsed elements are cleared, the memory usage is therefore bounded by the size of a single timestep"""
+
+    root = None
+    for event, element in ET.iterparse(filename, events=('start', 'end')):
+        if root is None:
+            root = element
+            continue
+
+        if event != 'end' or element.tag != 'timestep':
+            continue
+
+        veh_nodes = list(element)
+        traces_snapshot = np.zeros(len(veh_nodes), dtype=TRACES_DTYPE)
+        traces_snapshot['time'] = float(element.attrib['time'])
+        traces_snapshot['id'] = [int(veh_node.attrib['id'][3:]) for veh_node in veh_nodes]
+        traces_snapshot['x'] = [float(veh_node.attrib['x']) for veh_node in veh_nodes]
+        traces_snapshot['y'] = [float(veh_node.attrib['y']) for veh_node in veh_nodes]
+
+        # Free the parsed timesteps
+        root.clear()
 
         traces_snapshot['x'] -= offsets[0]
         traces_snapshot['y'] -= offsets[1]
@@ -662,23 +897,29 @@ def parse_veh_traces(filename, offsets=(0, 0), sort=True):
         if sort:
             traces_snapshot.sort(order='id')
 
-        traces[idx_timestep] = traces_snapshot
+        yield traces_snapshot
+
+
+def snapshots_to_array(snapshots):
+    """Collects snapshots of vehicle traces into a numpy object array"""
+
+    snapshots = list(snapshots)
+    traces = np.zeros(len(snapshots), dtype=object)
+    for idx, snapshot in enumerate(snapshots):
+        traces[idx] = snapshot
 
     return traces
 
 
 def vehicles_from_traces(graph_streets, snapshot):
-    """ Builds a vehicles objects from the street graph
+    """ Builds a vehicles objects from the street graph (or its spatial index)
     and a snapshot of the SUMO vehicle traces"""
 
-    count_veh = snapshot.size
-    points_vehs = np.zeros(count_veh, dtype=object)
-
-    for veh_idx, vehicle in enumerate(snapshot):
-        points_vehs[veh_idx] = geom.Point(vehicle['x'], vehicle['y'])
+    coords_vehs = np.column_stack((snapshot['x'], snapshot['y']))
 
     vehs = vehicles.generate_vehs(
-        graph_streets, street_idxs=None, points_vehs_in=points_vehs)
+        graph_streets, street_idxs=None, coords_vehs_in=coords_vehs)
+    vehs.ids = np.array(snapshot['id'])
 
     return vehs
 
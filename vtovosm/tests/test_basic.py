@@ -258,6 +258,40 @@ class TestPathloss(unittest.TestCase):
             pathloss_expected = Pathloss.get_pathloss_nlos_urban(dist_rx[idx], dist_tx[idx])
             self.assertAlmostEqual(pathloss_expected, pathlosses_generated[idx])
 
+    def test_pathloss_nlos_pairs(self):
+        """Tests the function pathloss_nlos_pairs"""
+
+        iterations = 100
+        pl = pathloss.Pathloss()
+        pl.disable_shadowfading()
+
+        dist_1 = np.random.rand(iterations) * 200
+        dist_2 = np.random.rand(iterations) * 200
+        pathlosses_generated = pl.pathloss_nlos_pairs(dist_1, dist_2)
+        for idx in range(iterations):
+            pathloss_expected = max(Pathloss.get_pathloss_nlos_urban(dist_1[idx], dist_2[idx]),
+                                    Pathloss.get_pathloss_nlos_urban(dist_2[idx], dist_1[idx]))
+            self.assertAlmostEqual(pathloss_expected, pathlosses_generated[idx])
+
+    def test_shadowfading_seed(self):
+        """Tests that seeding makes the shadow fading reproducible"""
+
+        dist = np.random.rand(100) * 500 + 10
+
+        pathlosses_1 = pathloss.Pathloss(rng=0).pathloss_los(dist)
+        pathlosses_2 = pathloss.Pathloss(rng=0).pathloss_los(dist)
+        pathlosses_3 = pathloss.Pathloss(rng=1).pathloss_los(dist)
+        pathlosses_4 = pathloss.Pathloss(rng=np.random.default_rng(1)).pathloss_los(dist)
+
+        self.assertTrue(np.array_equal(pathlosses_1, pathlosses_2))
+        self.assertTrue(np.array_equal(pathlosses_3, pathlosses_4))
+        self.assertFalse(np.array_equal(pathlosses_1, pathlosses_3))
+
+        # The global random state is neither used nor changed
+        state_before = np.random.get_state()
+        pathloss.Pathloss().pathloss_los(dist)
+        self.assertTrue(np.array_equal(np.random.get_state()[1], state_before[1]))
+
 
 class TestVehicles(unittest.TestCase):
     """Provides unit tests for the vehicles module"""
@@ -282,6 +316,65 @@ class TestVehicles(unittest.TestCase):
             count_correct = vehs.count == count_vehs_expected
             self.assertTrue(count_correct)
 
+    def test_get_vehicles_from_streets(self):
+        """Tests the function get_vehicles_from_streets"""
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        streets = graph_streets.edges(data=True)
+        street_idxs = np.random.randint(0, len(streets), 100)
+
+        points_vehs = vehicles.get_vehicles_from_streets(graph_streets, street_idxs)
+
+        for street_idx, point_veh in zip(street_idxs, points_vehs):
+            self.assertLess(streets[street_idx][2]['geometry'].distance(point_veh), 1e-9)
+
+    def test_generate_vehs(self):
+        """Tests the function generate_vehs and the lazy generation of points and graphs"""
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        vehs = network.build_vehs(graph_streets=graph_streets)
+        vehs_coords = network.build_vehs(only_coords=True)
+
+        self.assertEqual(vehs.count, vehs_coords.shape[0])
+        self.assertTrue(np.array_equal(vehs.get(), vehs_coords))
+        self.assertEqual(vehs.street_idxs.shape, (vehs.count,))
+        self.assertEqual(vehs.offsets.shape, (vehs.count,))
+
+        streets = graph_streets.edges(data=True)
+        vehs.add_key('center', 2)
+        graph_veh = vehs.get_graph('center')
+        street = streets[vehs.street_idxs[2]]
+        self.assertEqual(graph_veh.graph['node_veh'], 'v2')
+        self.assertEqual(sorted(graph_veh.nodes(), key=str), sorted(['v2', street[0], street[1]], key=str))
+        lengths = sorted(data['length'] for _, _, data in graph_veh.edges(data=True))
+        self.assertAlmostEqual(sum(lengths), street[2]['length'])
+
+        # Points and graphs are not pickled, graphs need the streets graph to be generated again
+        vehs_loaded = pickle.loads(pickle.dumps(vehs))
+        self.assertTrue(np.array_equal(vehs_loaded.get(), vehs_coords))
+        self.assertTrue(vehs_loaded.get_points()[2].equals(geom.Point(vehs_coords[2])))
+        with self.assertRaises(RuntimeError):
+            vehs_loaded.get_graph()
+        vehs_loaded.set_graph_streets(graph_streets)
+        self.assertEqual(len(vehs_loaded.get_graph()), vehs.count)
+
+        # Vehicles given by coordinates are snapped to their streets
+        index_streets = geom_o.StreetIndex(graph_streets)
+        vehs_snapped = vehicles.generate_vehs(index_streets, coords_vehs_in=vehs_coords + 0.5)
+        self.assertTrue(np.array_equal(vehs_snapped.street_idxs, vehs.street_idxs))
+        self.assertTrue(np.allclose(vehs_snapped.offsets, vehs.offsets, atol=0.5))
+        self.assertIs(vehs_snapped.graph_streets, index_streets)
+
+        # The spatial index of the streets is enough to generate the same graphs
+        vehs_loaded.set_graph_streets(index_streets)
+        for graph_index, graph_streets_veh in zip(vehs_loaded.get_graph(), vehs.get_graph()):
+            self.assertEqual(sorted(graph_index.nodes(), key=str), sorted(graph_streets_veh.nodes(), key=str))
+            for (_, _, data_index), (_, _, data_streets) in zip(sorted(graph_index.edges(data=True), key=str),
+                                                                sorted(graph_streets_veh.edges(data=True), key=str)):
+                self.assertTrue(data_index['geometry'].equals(data_streets['geometry']))
+
 
 class TestGeometry(unittest.TestCase):
     """Provides unit tests for the geometry module"""
@@ -304,6 +397,106 @@ class TestGeometry(unittest.TestCase):
             result_correct = intersects == intersect_flag
             self.assertTrue(result_correct)
 
+        # Test with a spatial index of the buildings
+        index_buildings = geom_o.BuildingIndex(gdf_buildings)
+        for line_coords, intersect_flag in zip(lines_coords, intersect_flags):
+            line = geom.LineString(line_coords)
+            intersects = geom_o.line_intersects_buildings(line, index_buildings)
+            self.assertEqual(intersects, intersect_flag)
+
+    def test_lines_intersect_buildings(self):
+        """Tests the function lines_intersect_buildings"""
+
+        network = DemoNetwork()
+        gdf_buildings = network.build_gdf_buildings()
+
+        coords_start = np.array([[0, 0], [0, 0], [0, 40], [0, 40 - 1e-10], [30, 30], [80, 80], [60, 20]])
+        coords_end = np.array([[160, 200], [0, 80], [40, 0], [40, 0], [40, 40], [240, 80], [60, 60]])
+        intersect_flags = np.array([True, False, True, False, True, False, True])
+
+        for chunk_size in [1, 3, 4096]:
+            intersects = geom_o.lines_intersect_buildings(coords_start, coords_end, gdf_buildings,
+                                                          chunk_size=chunk_size)
+            self.assertTrue(np.array_equal(intersects, intersect_flags))
+
+    def test_building_index(self):
+        """Tests the class BuildingIndex"""
+
+        network = DemoNetwork()
+        gdf_buildings = network.build_gdf_buildings()
+        index_buildings = geom_o.BuildingIndex(gdf_buildings)
+
+        self.assertEqual(len(index_buildings), len(gdf_buildings))
+        self.assertIs(geom_o.get_building_index(index_buildings), index_buildings)
+
+        # Only buildings with overlapping bounding boxes are candidates
+        line = geom.LineString([(0, 80), (160, 80)])
+        self.assertEqual(len(index_buildings.query(line)), 0)
+        self.assertFalse(index_buildings.intersects(line))
+
+        line = geom.LineString([(0, 40), (40, 0)])
+        candidates = index_buildings.query(line)
+        self.assertEqual(len(candidates), 1)
+        self.assertIsInstance(candidates[0], geom.base.BaseGeometry)
+        self.assertTrue(index_buildings.intersects(line))
+
+        # The index has to survive pickling, e.g. for caching and multiprocessing
+        index_loaded = pickle.loads(pickle.dumps(index_buildings))
+        self.assertTrue(index_loaded.intersects(line))
+
+    def test_street_index(self):
+        """Tests the class StreetIndex"""
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        index_streets = geom_o.StreetIndex(graph_streets)
+
+        self.assertEqual(len(index_streets), graph_streets.number_of_edges())
+        self.assertIs(geom_o.get_street_index(index_streets), index_streets)
+
+        # The index does not keep the streets graph, but gives the same streets
+        self.assertFalse(hasattr(index_streets, 'graph_streets'))
+        for street_index, street_graph in zip(index_streets, graph_streets.edges(data=True)):
+            self.assertEqual(street_index[0:2], street_graph[0:2])
+            self.assertTrue(street_index[2]['geometry'].equals(street_graph[2]['geometry']))
+            self.assertEqual(street_index[2]['length'], street_graph[2]['length'])
+
+        # Equally close streets are resolved to the smallest street index, far away points are snapped as well
+        coords = np.array([[40, 5], [80, 80], [-100, -100], [120, -3], [150, 170], [100, 140.5]])
+        street_idxs_expected = np.array([0, 2, 0, 1, 9, 9])
+        offsets_expected = np.array([40, 80, 0, 40, 10, 60])
+        coords_snapped_expected = np.array([[40, 0], [80, 80], [0, 0], [120, 0], [150, 140], [100, 140]])
+
+        for cell_size in [1, 25, 1000]:
+            index_streets = geom_o.StreetIndex(graph_streets, cell_size=cell_size)
+            for max_combinations in [1, 7, 2 ** 20]:
+                street_idxs, offsets, coords_snapped = index_streets.snap(coords, max_rings=2,
+                                                                          max_combinations=max_combinations)
+                self.assertTrue(np.array_equal(street_idxs, street_idxs_expected))
+                self.assertTrue(np.allclose(offsets, offsets_expected))
+                self.assertTrue(np.allclose(coords_snapped, coords_snapped_expected))
+
+        # Interpolating at the offsets gives the snapped coordinates
+        coords_generated = index_streets.interpolate(street_idxs_expected, offsets_expected)
+        self.assertTrue(np.allclose(coords_generated, coords_snapped_expected))
+        self.assertEqual(index_streets.interpolate([], []).shape, (0, 2))
+
+    def test_pairs_in_range(self):
+        """Tests the function pairs_in_range"""
+
+        coords = np.array([[0, 0], [0, 10], [0, 20], [30, 0], [0, 0]])
+
+        idxs_1, idxs_2 = geom_o.pairs_in_range(coords, 20)
+        pairs = sorted(zip(idxs_1.tolist(), idxs_2.tolist()))
+        self.assertEqual(pairs, [(0, 1), (0, 4), (1, 2), (1, 4)])
+
+        idxs_1, idxs_2 = geom_o.pairs_in_range(coords, 1)
+        self.assertEqual(sorted(zip(idxs_1.tolist(), idxs_2.tolist())), [(0, 4)])
+
+        idxs_1, idxs_2 = geom_o.pairs_in_range(coords, 0)
+        self.assertEqual(idxs_1.size, 0)
+        self.assertEqual(idxs_2.size, 0)
+
     def test_line_intersects_points(self):
         """Tests the function line_intersects_points"""
 
@@ -328,6 +521,27 @@ class TestGeometry(unittest.TestCase):
             result_correct = intersects == intersect_flag
             self.assertTrue(result_correct)
 
+    def test_lines_intersect_points(self):
+        """Tests the function lines_intersect_points"""
+
+        coords_points = np.array([[0, 0], [2, 0], [0, 2], [2, 2]])
+        coords_start = np.array([[-1, -1], [0, 1], [0, 0], [0, 0.5], [0, 0.5 + 1e10]])
+        coords_end = np.array([[1, 1], [2, 1], [2, 0], [2, 0.5], [2, 0.5 + 1e10]])
+        intersect_flags = np.array([True, False, True, True, False])
+        margin = 0.5
+
+        for cell_size in [0.3, 1, 25]:
+            intersects = geom_o.lines_intersect_points(coords_start, coords_end, coords_points, margin=margin,
+                                                       cell_size=cell_size)
+            self.assertTrue(np.array_equal(intersects, intersect_flags))
+
+        # Lines are not blocked by the points they connect
+        idxs_exclude = np.array([[0, 3], [0, 3], [0, 1], [2, 3], [0, 1]])
+        intersect_flags = np.array([False, False, False, True, False])
+        intersects = geom_o.lines_intersect_points(coords_start, coords_end, coords_points, margin=margin,
+                                                   idxs_exclude=idxs_exclude)
+        self.assertTrue(np.array_equal(intersects, intersect_flags))
+
     def test_get_street_lengths(self):
         """Tests the function get_street_lengths"""
 
@@ -377,6 +591,26 @@ class TestGeometry(unittest.TestCase):
         with self.assertRaises(ValueError):
             geom_o.split_line_at_point(line, point_fail)
 
+    def test_split_line_at_distance(self):
+        """Tests the function split_line_at_distance"""
+
+        line = geom.LineString([(0, 0), (0, 1), (1, 1)])
+        distances = [0.5, 1, 1.5, 0]
+        lines_before_expected = [[(0, 0), (0, 0.5)],
+                                 [(0, 0), (0, 1)],
+                                 [(0, 0), (0, 1), (0.5, 1)],
+                                 [(0, 0), (0, 0)]]
+        lines_after_expected = [[(0, 0.5), (0, 1), (1, 1)],
+                                [(0, 1), (1, 1)],
+                                [(0.5, 1), (1, 1)],
+                                [(0, 0), (0, 1), (1, 1)]]
+
+        for distance, line_before_expected, line_after_expected in \
+                zip(distances, lines_before_expected, lines_after_expected):
+            line_before_generated, line_after_generated = geom_o.split_line_at_distance(line, distance)
+            self.assertTrue(np.allclose(np.array(line_before_generated), line_before_expected))
+            self.assertTrue(np.allclose(np.array(line_after_generated), line_after_expected))
+
 
 class TestUtils(unittest.TestCase):
     """Provides unit tests for the utils module"""
@@ -396,6 +630,29 @@ class TestUtils(unittest.TestCase):
 
         os.remove(file_path)
 
+    def test_record_writer_load_records(self):
+        """Tests the class RecordWriter and the function load_records"""
+
+        file_path = 'results/TEMP_test_record_writer.pickle.xz'
+
+        save_data = [np.random.rand(idx) for idx in range(10)]
+        with utils.RecordWriter(file_path, chunk_size=3) as writer:
+            for record in save_data:
+                writer.append(record)
+
+        load_data = list(utils.load_records(file_path))
+        self.assertEqual(len(load_data), len(save_data))
+        for record_loaded, record_saved in zip(load_data, save_data):
+            self.assertTrue(numpy.array_equal(record_loaded, record_saved))
+
+        # Files written with save are a single record
+        utils.save(save_data[5], file_path)
+        load_data = list(utils.load_records(file_path))
+        self.assertEqual(len(load_data), 1)
+        self.assertTrue(numpy.array_equal(load_data[0], save_data[5]))
+
+        os.remove(file_path)
+
     def test_compress_file(self):
         """Tests the function compress_file"""
 
@@ -440,6 +697,25 @@ class TestUtils(unittest.TestCase):
                                             idx_j] == condensed[idx_cond]
                     self.assertTrue(result_correct)
 
+        idxs_i_expected, idxs_j_expected = np.triu_indices(size_n, k=1)
+        idxs_i_generated, idxs_j_generated = utils.condensed_to_square(np.arange(size_cond), size_n)
+        self.assertTrue(np.array_equal(idxs_i_generated, idxs_i_expected))
+        self.assertTrue(np.array_equal(idxs_j_generated, idxs_j_expected))
+        self.assertTrue(np.array_equal(utils.square_to_condensed(idxs_j_expected, idxs_i_expected, size_n),
+                                       np.arange(size_cond)))
+        with self.assertRaises(ValueError):
+            utils.square_to_condensed(idxs_i_expected, idxs_i_expected, size_n)
+
+        idxs_i_cached, idxs_j_cached = utils.triu_indices(size_n)
+        self.assertTrue(np.array_equal(idxs_i_cached, idxs_i_expected))
+        self.assertTrue(np.array_equal(idxs_j_cached, idxs_j_expected))
+
+        # Exact for sizes where the floating point square root is not
+        size_n = 10 ** 9
+        for idx_cond in [0, size_n - 2, size_n - 1, size_n * (size_n - 1) // 2 - 1, 123456789012345678]:
+            idx_i, idx_j = utils.condensed_to_square(idx_cond, size_n)
+            self.assertEqual(utils.square_to_condensed(idx_i, idx_j, size_n), idx_cond)
+
 
 class TestConnectionAnalysis(unittest.TestCase):
     """Provides unit tests for the connection_analysis module"""
@@ -458,6 +734,20 @@ class TestConnectionAnalysis(unittest.TestCase):
         self.assertAlmostEqual(mean_duration_generated, mean_duration_expected)
         self.assertAlmostEqual(mean_connected_periods_generated, mean_connected_periods_expected)
 
+    def test_to_has_path_matrix(self):
+        """Tests the function to_has_path_matrix"""
+
+        graph = nx.Graph()
+        graph.add_nodes_from(range(6))
+        graph.add_edges_from([(0, 2), (2, 4), (1, 5)])
+
+        has_path_expected = np.zeros(15, dtype=bool)
+        for node_u, node_v in [(0, 2), (0, 4), (2, 4), (1, 5)]:
+            has_path_expected[utils.square_to_condensed(node_u, node_v, 6)] = True
+
+        has_path_generated = con_ana.to_has_path_matrix(graph)
+        self.assertTrue(np.array_equal(has_path_generated, has_path_expected))
+
     def test_calc_connection_durations(self):
         """Tests the function calc_connection_durations"""
 
@@ -527,6 +817,89 @@ class TestConnectionAnalysis(unittest.TestCase):
         self.assertEqual(durations_generated[0], durations_con_expected)
         self.assertEqual(durations_generated[1], durations_discon_expected)
 
+    def test_calc_link_durations_packed(self):
+        """Tests the function calc_link_durations_packed"""
+
+        con_matrices_cond = [
+            [1, 0, 0, 1, 0, 1],
+            [1, 0, 0, 1, 0, 1],
+            [1, 0, 1, 1, 0, 0],
+            [1, 0, 0, 1, 0, 1],
+            [0, 0, 1, 1, 0, 1]
+        ]
+        durations_con_expected = [4, 1, 1, 5, 2, 2]
+        durations_discon_expected = [1, 5, 2, 1, 5, 1]
+
+        packed_cons = [con_ana.pack_connections(con_matrix_cond) for con_matrix_cond in con_matrices_cond]
+
+        durations_generated = con_ana.calc_link_durations_packed(packed_cons)
+
+        self.assertEqual(durations_generated[0], durations_con_expected)
+        self.assertEqual(durations_generated[1], durations_discon_expected)
+
+    def test_pack_connections(self):
+        """Tests the functions pack_connections, unpack_connections, packed_to_graph and
+        count_connection_differences"""
+
+        count_veh = 13
+        matrix_cons_cond = np.random.rand(count_veh * (count_veh - 1) // 2) < 0.3
+        matrix_cons = sp_dist.squareform(matrix_cons_cond)
+
+        packed_cons = con_ana.pack_connections(matrix_cons)
+        self.assertEqual(packed_cons.count_veh, count_veh)
+        self.assertEqual(packed_cons.bits.size, int(np.ceil(matrix_cons_cond.size / 8)))
+        self.assertTrue(np.array_equal(con_ana.unpack_connections(packed_cons), matrix_cons_cond))
+        self.assertTrue(np.array_equal(con_ana.unpack_connections(packed_cons, condensed=False), matrix_cons))
+        self.assertTrue(np.array_equal(con_ana.pack_connections(matrix_cons_cond).bits, packed_cons.bits))
+
+        graph_expected = nx.from_numpy_matrix(matrix_cons)
+        graph_generated = con_ana.packed_to_graph(packed_cons)
+        self.assertEqual(sorted(graph_generated.nodes()), sorted(graph_expected.nodes()))
+        self.assertEqual(sorted(graph_generated.edges()), sorted(graph_expected.edges()))
+
+        matrix_cons_cond_2 = matrix_cons_cond.copy()
+        matrix_cons_cond_2[[0, 5, 7]] = ~matrix_cons_cond_2[[0, 5, 7]]
+        packed_cons_2 = con_ana.pack_connections(matrix_cons_cond_2)
+        self.assertEqual(con_ana.count_connection_differences(packed_cons, packed_cons_2), 3)
+
+    def test_to_sparse_matrix(self):
+        """Tests the function to_sparse_matrix and the analysis of sparse connection matrices"""
+
+        count_veh = 15
+        matrices_cons = [sp_dist.squareform(np.random.rand(count_veh * (count_veh - 1) // 2) < 0.15)
+                         for _ in range(6)]
+        graphs_cons = [nx.from_numpy_matrix(matrix_cons) for matrix_cons in matrices_cons]
+        sparse_cons = [con_ana.to_sparse_matrix(matrix_cons) for matrix_cons in matrices_cons]
+
+        for matrix_cons, graph_cons, sparse_con in zip(matrices_cons, graphs_cons, sparse_cons):
+            self.assertTrue(np.array_equal(sparse_con.toarray(), matrix_cons))
+            self.assertTrue(np.array_equal(
+                con_ana.to_sparse_matrix(con_ana.pack_connections(matrix_cons)).toarray(), matrix_cons))
+            self.assertTrue(np.array_equal(con_ana.to_sparse_matrix(graph_cons).toarray(), matrix_cons))
+            self.assertEqual(sorted(con_ana.to_graph(sparse_con).edges()), sorted(graph_cons.edges()))
+
+            degrees_expected = [graph_cons.degree(node) for node in range(count_veh)]
+            self.assertTrue(np.array_equal(con_ana.calc_degrees(sparse_con), degrees_expected))
+            self.assertEqual(con_ana.calc_degree_stats(sparse_con).max, max(degrees_expected))
+
+            net_connectivity_expected = con_ana.calc_net_connectivity(graph_cons, cut_only_fully_connected=False)
+            net_connectivity_generated = con_ana.calc_net_connectivity(sparse_con, cut_only_fully_connected=False)
+            self.assertAlmostEqual(net_connectivity_generated.net_connectivity,
+                                   net_connectivity_expected.net_connectivity)
+            self.assertEqual(net_connectivity_generated.count_cluster, net_connectivity_expected.count_cluster)
+            self.assertEqual(len(net_connectivity_generated.min_node_cut),
+                             len(net_connectivity_expected.min_node_cut))
+
+        durations_expected = con_ana.calc_connection_durations(graphs_cons)
+        durations_generated = con_ana.calc_connection_durations(sparse_cons)
+        self.assertEqual(durations_generated.durations_con, durations_expected.durations_con)
+        self.assertEqual(durations_generated.durations_discon, durations_expected.durations_discon)
+
+        durations_expected = con_ana.calc_link_durations(graphs_cons)
+        durations_generated = con_ana.calc_link_durations(sparse_cons)
+        self.assertEqual(durations_generated.durations_con, durations_expected.durations_con)
+        self.assertEqual(durations_generated.durations_discon, durations_expected.durations_discon)
+
     def test_calc_link_durations_multiprocess(self):
         """Tests the function calc_link_durations_multiprocess"""
 
@@ -622,6 +995,38 @@ class TestConnectionAnalysis(unittest.TestCase):
         self.assertEqual(net_connectivity_generated.min_node_cut, node_cut_expected)
         self.assertEqual(net_connectivity_generated.count_cluster, count_cluster_expected)
 
+    def test_calc_net_connectivity_min_node_cut(self):
+        """Tests the minimum node cut methods of the functions calc_net_connectivity and calc_net_connectivities"""
+
+        # Two complete clusters joined by node 4 and a pendant node 9 attached to node 8
+        edges = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3), (3, 4),
+                 (4, 5), (5, 6), (5, 7), (5, 8), (6, 7), (6, 8), (7, 8), (8, 9)]
+        graph = nx.Graph()
+        graph.add_edges_from(edges)
+        sparse_cons = con_ana.to_sparse_matrix(graph)
+
+        for graph_cons in [graph, sparse_cons]:
+            net_connectivity_exact = con_ana.calc_net_connectivity(graph_cons, min_node_cut='exact')
+            net_connectivity_approx = con_ana.calc_net_connectivity(graph_cons, min_node_cut='approx')
+            net_connectivity_skip = con_ana.calc_net_connectivity(graph_cons, min_node_cut='skip')
+
+            self.assertEqual(net_connectivity_exact.net_connectivity, 1)
+            self.assertEqual(len(net_connectivity_exact.min_node_cut), 1)
+            graph_cut = graph.copy()
+            graph_cut.remove_nodes_from(net_connectivity_exact.min_node_cut)
+            self.assertFalse(nx.is_connected(graph_cut))
+            self.assertEqual(net_connectivity_approx.min_node_cut, {8})
+            self.assertIsNone(net_connectivity_skip.min_node_cut)
+            self.assertEqual(net_connectivity_skip.count_cluster, 1)
+
+        with self.assertRaises(NotImplementedError):
+            con_ana.calc_net_connectivity(graph, min_node_cut='unknown')
+
+        net_connectivities = con_ana.calc_net_connectivities([graph] * 5, min_node_cut='approx',
+                                                             min_node_cut_interval=2)
+        is_cut = [net_connectivity.min_node_cut is not None for net_connectivity in net_connectivities]
+        self.assertEqual(is_cut, [True, False, True, False, True])
+
     def test_gen_connection_graph(self):
         """Tests the function gen_connection_graph"""
 
@@ -975,6 +1380,93 @@ class TestPropagation(unittest.TestCase):
 
         self.assertTrue(result_correct)
 
+    def test_route_table(self):
+        """Tests the class RouteTable"""
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        gdf_buildings = network.build_gdf_buildings()
+        graph_streets_wave = graph_streets.to_undirected()
+        prop.add_edges_if_los(graph_streets_wave,
+                              gdf_buildings,
+                              max_distance=70)
+        routes_wave = prop.RouteTable(graph_streets_wave, cache_size=2)
+        self.assertIs(prop.get_route_table(routes_wave), routes_wave)
+
+        # The route table has to survive pickling, e.g. for caching
+        routes_wave = pickle.loads(pickle.dumps(routes_wave))
+
+        vehs = network.build_vehs(
+            graph_streets=graph_streets, only_coords=False)
+        graphs_vehs = vehs.get_graph()
+
+        # The table has to give the same results as routing in the graph
+        for idx_u in range(vehs.count):
+            for idx_v in range(idx_u + 1, vehs.count):
+                route_expected = prop.line_route_between_nodes(
+                    graphs_vehs[idx_u].graph['node_veh'],
+                    graphs_vehs[idx_v].graph['node_veh'],
+                    nx.compose(graphs_vehs[idx_v], nx.compose(graphs_vehs[idx_u], graph_streets_wave)))
+                route_generated = routes_wave.route_between_vehs(graphs_vehs[idx_u], graphs_vehs[idx_v])
+                self.assertAlmostEqual(route_generated.length, route_expected.length)
+                self.assertTrue(route_generated.equals(route_expected))
+
+        # Only the most recently used routes are kept and they are not pickled
+        self.assertLessEqual(len(routes_wave.routes_from), 2)
+        self.assertEqual(len(pickle.loads(pickle.dumps(routes_wave)).routes_from), 0)
+
+    def test_turn_graph(self):
+        """Tests the class TurnGraph"""
+
+        idx_own = 0
+        is_orthogonal_expected = np.array([1, 1, 0, 0, 1, 0, 1, 0], dtype=bool)
+        coords_max_angle_expected = np.matlib.repmat([80, 0], 8, 1)
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        gdf_buildings = network.build_gdf_buildings()
+        graph_streets_wave = graph_streets.to_undirected()
+        prop.add_edges_if_los(graph_streets_wave,
+                              gdf_buildings,
+                              max_distance=70)
+        turns_wave = prop.TurnGraph(graph_streets_wave)
+        self.assertIs(prop.get_turn_graph(turns_wave), turns_wave)
+        self.assertRaises(RuntimeError, prop.get_route_table, turns_wave)
+
+        # The turn graph has to survive pickling, e.g. for caching
+        turns_wave = pickle.loads(pickle.dumps(turns_wave))
+
+        vehs = network.build_vehs(
+            graph_streets=graph_streets, only_coords=False)
+        idxs_other = np.setdiff1d(np.arange(vehs.count), idx_own)
+        vehs.add_key('center', idx_own)
+        vehs.add_key('other', idxs_other)
+
+        is_orthogonal_generated, coords_max_angle_generated = \
+            prop.check_if_cons_are_orthogonal(
+                turns_wave,
+                vehs.get_graph('center'),
+                vehs.get_graph('other'),
+                max_angle=np.pi / 2)
+
+        self.assertTrue(np.array_equal(is_orthogonal_generated, is_orthogonal_expected))
+        self.assertTrue(np.array_equal(coords_max_angle_generated, coords_max_angle_expected))
+
+        # Routes by angle never turn more than routes by length
+        routes_wave = prop.RouteTable(graph_streets_wave)
+        graphs_vehs = vehs.get_graph()
+        idxs_veh1, idxs_veh2 = np.triu_indices(vehs.count, k=1)
+        routes_angle = turns_wave.routes_between_vehs(graphs_vehs[idxs_veh1], graphs_vehs[idxs_veh2])
+        routes_angle_chunked = turns_wave.routes_between_vehs(graphs_vehs[idxs_veh1], graphs_vehs[idxs_veh2],
+                                                              max_sources=1)
+        for route_angle, route_angle_chunked in zip(routes_angle, routes_angle_chunked):
+            self.assertTrue(route_angle.equals(route_angle_chunked))
+        for idx_veh1, idx_veh2, route_angle in zip(idxs_veh1, idxs_veh2, routes_angle):
+            route_length = routes_wave.route_between_vehs(graphs_vehs[idx_veh1], graphs_vehs[idx_veh2])
+            angles_angle = np.pi - np.abs(geom_o.wrap_to_pi(geom_o.angles_along_line(route_angle)))
+            angles_length = np.pi - np.abs(geom_o.wrap_to_pi(geom_o.angles_along_line(route_length)))
+            self.assertLessEqual(np.sum(angles_angle), np.sum(angles_length) + 1e-9)
+
     def test_add_edges_if_los(self):
         """Tests the function add_edges_if_los"""
 
@@ -990,6 +1482,63 @@ class TestPropagation(unittest.TestCase):
         self.assertFalse(graph_streets_wave.has_edge(0, 3))
         self.assertFalse(graph_streets_wave.has_edge(7, 9))
 
+        # Splitting the building check among processes has to give the same graph
+        graph_streets_wave_mp = graph_streets.to_undirected()
+        prop.add_edges_if_los(graph_streets_wave_mp,
+                              gdf_buildings,
+                              max_distance=70,
+                              processes=2,
+                              chunk_size=2)
+
+        edges_expected = sorted(graph_streets_wave.edges())
+        edges_generated = sorted(graph_streets_wave_mp.edges())
+        self.assertEqual(edges_generated, edges_expected)
+
+    def test_prop_cond_tracker(self):
+        """Tests the class PropCondTracker"""
+
+        network = DemoNetwork()
+        gdf_buildings = network.build_gdf_buildings()
+        coords_vehs = geom_o.extract_point_array(network.build_vehs())
+        ids_vehs = np.arange(coords_vehs.shape[0]) + 100
+        tracker = prop.PropCondTracker(gdf_buildings)
+
+        for max_dist in [None, 70]:
+            tracker.reset()
+            coords_snapshot = coords_vehs.copy()
+            ids_snapshot = ids_vehs.copy()
+            for idx_snapshot in range(4):
+                prop_cond_expected = prop.gen_prop_cond_matrix_batch(
+                    coords_snapshot, gdf_buildings, max_dist=max_dist)
+                prop_cond_generated = tracker.update(
+                    coords_snapshot, ids_snapshot, max_dist=max_dist)
+                self.assertTrue(np.array_equal(prop_cond_generated, prop_cond_expected))
+
+                if idx_snapshot > 0:
+                    # Only pairs including one of the 2 moved vehicles have to be checked
+                    count_vehs = ids_snapshot.size
+                    self.assertTrue(tracker.count_checked <= 2 * (count_vehs - 1))
+
+                # Move 2 vehicles, drop the first one and reverse the order
+                coords_snapshot[[1, 3]] += 15
+                coords_snapshot = coords_snapshot[:0:-1]
+                ids_snapshot = ids_snapshot[:0:-1]
+
+        # The fully determined conditions do not change the state of the tracker
+        graph_streets = network.build_graph_streets()
+        graph_streets_wave = graph_streets.to_undirected()
+        prop.add_edges_if_los(graph_streets_wave, gdf_buildings, max_distance=70)
+        vehs = network.build_vehs(graph_streets=graph_streets)
+        tracker.reset()
+        prop_cond_expected, _ = prop.gen_prop_cond_matrix(
+            vehs.get_points(), gdf_buildings, graph_streets_wave=graph_streets_wave, graphs_vehs=vehs.get_graph())
+        for _ in range(2):
+            prop_cond_generated, _ = prop.gen_prop_cond_matrix(
+                vehs.get_points(), gdf_buildings, graph_streets_wave=graph_streets_wave, graphs_vehs=vehs.get_graph(),
+                prop_cond_tracker=tracker, ids_vehs=ids_vehs)
+            self.assertTrue(np.array_equal(prop_cond_generated, prop_cond_expected))
+        self.assertEqual(tracker.count_checked, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,25 @@
 """Unit tests for the module simulations.main which execute slow"""
 
 import json
+import multiprocessing as mp
 import os
 import unittest
+from contextlib import closing
 
+import numpy as np
+
+import vtovosm.connection_analysis as con_ana
+import vtovosm.propagation as prop
 import vtovosm.simulations.main as main_sim
+from vtovosm.tests.test_basic import DemoNetwork
+
+
+def pow_fail_at_3(base, exp):
+    """Raises for the base 3, used to test the failure of a task"""
+
+    if base == 3:
+        raise ValueError('Task failed')
+    return pow(base, exp)
 
 
 class TestSimulationsMain(unittest.TestCase):
@@ -21,6 +36,161 @@ class TestSimulationsMain(unittest.TestCase):
 
         main_sim.main_multi_scenario(conf_path=self.conf_file_path)
 
+    def test_imap_bounded(self):
+        """Tests the function imap_bounded"""
+
+        args = [(idx, 3) for idx in range(50)]
+        results_expected = [pow(*arg) for arg in args]
+
+        with mp.Pool(processes=3) as pool:
+            for chunk_size, max_in_flight in [(1, 1), (1, 4), (4, 2), (5, 20)]:
+                results_generated = list(main_sim.imap_bounded(
+                    pool, pow, iter(args), max_in_flight, chunk_size=chunk_size))
+                self.assertEqual(results_generated, results_expected)
+
+    def test_imap_bounded_failure(self):
+        """Tests that imap_bounded raises the exception of a failed task and that the pool can exit afterwards"""
+
+        args = [(idx, 3) for idx in range(50)]
+
+        with mp.Pool(processes=3) as pool:
+            with self.assertRaises(ValueError):
+                list(main_sim.imap_bounded(pool, pow_fail_at_3, iter(args), 4, chunk_size=1))
+
+        # The consumer stops early, e.g. because writing a result failed
+        with mp.Pool(processes=3) as pool:
+            with closing(main_sim.imap_bounded(pool, pow, iter(args), 4, chunk_size=1)) as results:
+                self.assertEqual(next(results), 0)
+
+    def test_sim_single_route_weight(self):
+        """Tests the functions sim_single_sumo and sim_single_uniform with routes weighted by angle"""
+
+        max_pl = 120
+        metric_config = {'shadowfading_enabled': False, 'route_weight': 'angle'}
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        gdf_buildings = network.build_gdf_buildings()
+        graph_streets_wave = graph_streets.to_undirected()
+        prop.add_edges_if_los(graph_streets_wave,
+                              gdf_buildings,
+                              max_distance=70)
+        turns_wave = prop.TurnGraph(graph_streets_wave)
+        coords_vehs = network.build_vehs(only_coords=True)
+        snapshot = {'id': np.arange(coords_vehs.shape[0]), 'x': coords_vehs[:, 0], 'y': coords_vehs[:, 1]}
+
+        # The precomputed turn graph yields the same connections as routing in the wave propagation graph
+        vehs = network.build_vehs(graph_streets=graph_streets, only_coords=False)
+        con_matrix_expected = con_ana.gen_connection_matrix(
+            vehs,
+            gdf_buildings,
+            max_pl,
+            metric='pathloss',
+            graph_streets_wave=graph_streets_wave,
+            metric_config=metric_config)
+
+        con_matrix_generated, vehs_generated = main_sim.sim_single_sumo(
+            snapshot,
+            graph_streets,
+            gdf_buildings,
+            max_pl,
+            metric='pathloss',
+            graph_streets_wave=turns_wave,
+            metric_config=metric_config,
+            random_seed=0)
+        self.assertTrue(np.array_equal(con_matrix_generated, con_matrix_expected))
+        self.assertTrue(np.array_equal(vehs_generated.ids, snapshot['id']))
+
+        # The configuration of the caller is left unchanged
+        self.assertEqual(metric_config, {'shadowfading_enabled': False, 'route_weight': 'angle'})
+
+        # The route table can not route by angle
+        with self.assertRaises(RuntimeError):
+            main_sim.sim_single_sumo(
+                snapshot,
+                graph_streets,
+                gdf_buildings,
+                max_pl,
+                metric='pathloss',
+                graph_streets_wave=prop.RouteTable(graph_streets_wave),
+                metric_config=metric_config,
+                random_seed=0)
+
+        con_matrix_expected, _ = main_sim.sim_single_uniform(
+            0,
+            20,
+            graph_streets,
+            gdf_buildings,
+            max_pl,
+            metric='pathloss',
+            graph_streets_wave=graph_streets_wave,
+            metric_config=metric_config)
+        con_matrix_generated, vehs_generated = main_sim.sim_single_uniform(
+            0,
+            20,
+            graph_streets,
+            gdf_buildings,
+            max_pl,
+            metric='pathloss',
+            graph_streets_wave=turns_wave,
+            metric_config=metric_config)
+        self.assertEqual(vehs_generated.count, 20)
+        self.assertTrue(np.array_equal(con_matrix_generated, con_matrix_expected))
+
+    def test_sim_single_random_seed(self):
+        """Tests that the functions sim_single_sumo and sim_single_uniform are reproducible with a random seed and
+        that the seeds of different vehicle counts differ"""
+
+        max_pl = 120
+
+        network = DemoNetwork()
+        graph_streets = network.build_graph_streets()
+        gdf_buildings = network.build_gdf_buildings()
+        graph_streets_wave = graph_streets.to_undirected()
+        prop.add_edges_if_los(graph_streets_wave,
+                              gdf_buildings,
+                              max_distance=70)
+        routes_wave = prop.RouteTable(graph_streets_wave)
+        coords_vehs = network.build_vehs(only_coords=True)
+        snapshot = {'id': np.arange(coords_vehs.shape[0]), 'x': coords_vehs[:, 0], 'y': coords_vehs[:, 1]}
+
+        # The seeds of the same index but different vehicle counts differ
+        numbers_1 = np.random.default_rng(main_sim.gen_random_seed(9, 0)).random(10)
+        numbers_2 = np.random.default_rng(main_sim.gen_random_seed(10, 0)).random(10)
+        self.assertFalse(np.array_equal(numbers_1, numbers_2))
+
+        # The shadow fading only depends on the seed and not on the global random state
+        results_sumo = []
+        for seed_global in [0, 1]:
+            np.random.seed(seed_global)
+            matrix_cons, _ = main_sim.sim_single_sumo(
+                snapshot,
+                graph_streets,
+                gdf_buildings,
+                max_pl,
+                metric='pathloss',
+                graph_streets_wave=routes_wave,
+                random_seed=main_sim.gen_random_seed(9, 0))
+            results_sumo.append(matrix_cons)
+
+        self.assertTrue(np.array_equal(results_sumo[0], results_sumo[1]))
+
+        # The vehicle placement depends on the seed too
+        results_uniform = []
+        for count_veh, idx in [(20, 0), (20, 0), (20, 1)]:
+            _, vehs = main_sim.sim_single_uniform(
+                main_sim.gen_random_seed(count_veh, idx),
+                count_veh,
+                graph_streets,
+                gdf_buildings,
+                max_pl,
+                metric='pathloss',
+                graph_streets_wave=routes_wave)
+            results_uniform.append(vehs.coordinates)
+
+        self.assertTrue(np.array_equal(results_uniform[0], results_uniform[1]))
+        self.assertFalse(np.array_equal(results_uniform[0], results_uniform[2]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,13 @@
 """Unit tests for all modules that interact with SUMO and therefore execute slower and need SUMO installed"""
 
 import os
+import tempfile
 import unittest
 
 import numpy as np
 
 import vtovosm.sumo as sumo
+import vtovosm.utils as utils
 
 
 class TestSumo(unittest.TestCase):
@@ -54,7 +56,7 @@ class TestSumo(unittest.TestCase):
             veh_class='passenger'
         )
 
-        self.assertIsInstance(traces, np.ndarray)
+        self.assertIsInstance(traces, sumo.VehTraces)
 
         # Run simulation without overwrite
         traces = sumo.simple_wrapper(
@@ -74,7 +76,181 @@ class TestSumo(unittest.TestCase):
             veh_class='passenger'
         )
 
+        self.assertIsInstance(traces, sumo.VehTraces)
+
+    def test_iter_veh_traces(self):
+        """Tests the functions iter_veh_traces and parse_veh_traces"""
+
+        traces_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<fcd-export>
+    <timestep time="0.00">
+        <vehicle id="veh2" x="12.0" y="21.0" angle="0.00" type="passenger" speed="0.00" pos="5.10" lane="1_0"/>
+        <vehicle id="veh1" x="11.0" y="22.0" angle="0.00" type="passenger" speed="0.00" pos="5.10" lane="1_0"/>
+    </timestep>
+    <timestep time="1.00">
+        <vehicle id="veh1" x="13.0" y="24.0" angle="0.00" type="passenger" speed="2.00" pos="7.10" lane="1_0"/>
+    </timestep>
+</fcd-export>
+"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.traces.xml')
+            with open(path, 'w') as file:
+                file.write(traces_xml)
+
+            snapshots = list(sumo.iter_veh_traces(path, offsets=(10, 20)))
+            traces = sumo.parse_veh_traces(path, offsets=(10, 20))
+
+        self.assertEqual(len(snapshots), 2)
+        np.testing.assert_array_equal(snapshots[0]['id'], [1, 2])
+        np.testing.assert_array_equal(snapshots[0]['x'], [1, 2])
+        np.testing.assert_array_equal(snapshots[0]['y'], [2, 1])
+        np.testing.assert_array_equal(snapshots[1]['time'], [1])
+        np.testing.assert_array_equal(snapshots[1]['x'], [3])
+
         self.assertIsInstance(traces, np.ndarray)
+        self.assertEqual(traces.size, 2)
+        np.testing.assert_array_equal(traces[0], snapshots[0])
+
+        # Discard the first snapshot and snapshots with a wrong number of vehicles
+        traces_cleaned = sumo.clean_veh_traces(traces, delete_first_n=1)
+        self.assertEqual(traces_cleaned.size, 1)
+        traces_cleaned = sumo.clean_veh_traces(traces, count_veh=2)
+        self.assertEqual(traces_cleaned.size, 1)
+        np.testing.assert_array_equal(traces_cleaned[0], snapshots[0])
+        traces_cleaned = sumo.clean_veh_traces(traces, delete_first_n=None)
+        self.assertEqual(traces_cleaned.size, 2)
+
+    def test_stream_veh_traces(self):
+        """Tests the function stream_veh_traces"""
+
+        network_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<net>
+    <location netOffset="10.00,20.00" convBoundary="0.00,0.00,10.00,10.00"/>
+</net>
+"""
+        traces_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<fcd-export>
+    <timestep time="0.00">
+        <vehicle id="veh1" x="11.0" y="22.0" angle="0.00" type="passenger" speed="0.00" pos="5.10" lane="1_0"/>
+    </timestep>
+    <timestep time="1.00">
+        <vehicle id="veh1" x="13.0" y="24.0" angle="0.00" type="passenger" speed="2.00" pos="7.10" lane="1_0"/>
+    </timestep>
+</fcd-export>
+"""
+
+        place = 'test_stream_veh_traces'
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, place + '.net.xml'), 'w') as file:
+                file.write(network_xml)
+            with open(os.path.join(directory, place + '.1.traces.xml'), 'w') as file:
+                file.write(traces_xml)
+
+            # No warmup duration is configured by default
+            snapshots = list(sumo.stream_veh_traces(place, directory=directory, file_suffix='1',
+                                                    delete_first_n=None, count_veh=1))
+
+        self.assertEqual(len(snapshots), 2)
+        np.testing.assert_array_equal(snapshots[0]['x'], [1])
+        np.testing.assert_array_equal(snapshots[1]['y'], [4])
+
+    def test_load_veh_traces_legacy(self):
+        """Tests the conversion of legacy traces pickles by the function load_veh_traces"""
+
+        snapshots = []
+        for idx_snapshot in range(3):
+            snapshot = np.zeros(2, dtype=sumo.TRACES_DTYPE)
+            snapshot['time'] = idx_snapshot
+            snapshot['id'] = [1, 2]
+            snapshot['x'] = idx_snapshot
+            snapshots.append(snapshot)
+
+        place = 'test_load_veh_traces_legacy'
+        with tempfile.TemporaryDirectory() as directory:
+            path_pickle = os.path.join(directory, place + '.2.traces.pickle.xz')
+            utils.save(sumo.snapshots_to_array(snapshots), path_pickle)
+
+            # Legacy traces are already cleaned up and converted to a memory mapped store once
+            traces = sumo.load_veh_traces(place, directory=directory, file_suffix='2', delete_first_n=1)
+            self.assertEqual(len(traces), 3)
+            self.assertIsInstance(traces.columns['x'], np.memmap)
+            self.assertTrue(os.path.isdir(os.path.join(directory, place + '.2.traces.cleaned')))
+
+            # Later loads use the converted store
+            os.remove(path_pickle)
+            traces = sumo.load_veh_traces(place, directory=directory, file_suffix='2', delete_first_n=1)
+            self.assertEqual(len(traces), 3)
+            for snapshot_loaded, snapshot in zip(traces, snapshots):
+                np.testing.assert_array_equal(snapshot_loaded, snapshot)
+            del traces
+
+    def test_veh_traces(self):
+        """Tests the class VehTraces"""
+
+        snapshots = []
+        for idx_snapshot, count_veh in enumerate([3, 2, 3, 3]):
+            snapshot = np.zeros(count_veh, dtype=sumo.TRACES_DTYPE)
+            snapshot['time'] = idx_snapshot
+            snapshot['id'] = np.arange(count_veh)
+            snapshot['x'] = np.arange(count_veh) + 10 * idx_snapshot
+            snapshot['y'] = -snapshot['x']
+            snapshots.append(snapshot)
+
+        with tempfile.TemporaryDirectory() as directory_tmp:
+            # A leftover of an interrupted save is discarded
+            directory = os.path.join(directory_tmp, 'traces')
+            os.makedirs(directory + '.part')
+            np.save(os.path.join(directory + '.part', 'x.npy'), np.zeros(1))
+
+            sumo.VehTraces.from_snapshots(snapshots).save(directory)
+            self.assertFalse(os.path.exists(directory + '.part'))
+            traces = sumo.VehTraces.load(directory)
+
+            self.assertEqual(len(traces), 4)
+            np.testing.assert_array_equal(traces.sizes, [3, 2, 3, 3])
+            for snapshot_loaded, snapshot in zip(traces, snapshots):
+                np.testing.assert_array_equal(snapshot_loaded, snapshot)
+            np.testing.assert_array_equal(traces[-1], snapshots[-1])
+
+            # Slices are views of the same store
+            traces_slice = traces[1:3]
+            self.assertIs(traces_slice.columns, traces.columns)
+            np.testing.assert_array_equal(traces_slice[0], snapshots[1])
+
+            # Cleaning up only selects snapshots
+            traces_cleaned = sumo.clean_veh_traces(traces, delete_first_n=1, count_veh=3)
+            self.assertIs(traces_cleaned.columns, traces.columns)
+            self.assertEqual(traces_cleaned.size, 2)
+            np.testing.assert_array_equal(traces_cleaned[0], snapshots[2])
+            np.testing.assert_array_equal(traces_cleaned[1], snapshots[3])
+
+            # No snapshots are deleted by default (`warmup_duration` is None)
+            traces_default = sumo.clean_veh_traces(traces, delete_first_n=None)
+            self.assertEqual(traces_default.size, 4)
+
+            # Saving a selection only writes the selected snapshots
+            directory_cleaned = os.path.join(directory_tmp, 'cleaned')
+            traces_cleaned.save(directory_cleaned)
+            traces_cleaned_loaded = sumo.VehTraces.load(directory_cleaned)
+            np.testing.assert_array_equal(traces_cleaned_loaded[1], snapshots[3])
+
+            # An existing store is replaced
+            traces_slice.save(directory_cleaned)
+            traces_cleaned_loaded = sumo.VehTraces.load(directory_cleaned)
+            np.testing.assert_array_equal(traces_cleaned_loaded.sizes, [2, 3])
+
+            # Snapshots are written to a directory one by one and loaded memory mapped
+            directory_streamed = os.path.join(directory_tmp, 'streamed')
+            traces_streamed = sumo.VehTraces.from_snapshots((snapshot for snapshot in snapshots),
+                                                            directory=directory_streamed)
+            self.assertIsInstance(traces_streamed.columns['x'], np.memmap)
+            np.testing.assert_array_equal(traces_streamed.sizes, [3, 2, 3, 3])
+            for snapshot_loaded, snapshot in zip(traces_streamed, snapshots):
+                np.testing.assert_array_equal(snapshot_loaded, snapshot)
+            traces_empty = sumo.VehTraces.from_snapshots([], directory=os.path.join(directory_tmp, 'empty'))
+            self.assertEqual(len(traces_empty), 0)
+            del traces, traces_slice, traces_cleaned, traces_cleaned_loaded, traces_default, traces_streamed
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 """Various functionality that does not fit in any other module."""
 
 import datetime
+import functools
 import getpass
 import logging
 import lzma
@@ -102,22 +103,52 @@ def debug(time_start=None, text=None):
         return time_diff
 
 
+@functools.lru_cache(maxsize=2)
+def triu_indices(size_n):
+    """Returns the row and column indices of the condensed vector of a square matrix with size `size_n` x `size_n`.
+    The index arrays of the 2 most recently used sizes are cached (they grow with the square of the size and the
+    number of vehicles changes between snapshots) and are read-only.
+
+    Parameters
+    ----------
+    size_n : int
+        Size of the square matrix
+
+    Returns
+    -------
+    idxs_i : np.ndarray
+        Row indices of all condensed entries
+    idxs_j : np.ndarray
+        Column indices of all condensed entries
+
+    See Also
+    --------
+    numpy.triu_indices
+    """
+
+    idxs_i, idxs_j = np.triu_indices(size_n, k=1)
+    idxs_i.setflags(write=False)
+    idxs_j.setflags(write=False)
+
+    return idxs_i, idxs_j
+
+
 def square_to_condensed(idx_i, idx_j, size_n):
     """Converts the squareform indices i and j of the square matrix with with size `size_n` x `size_n` to the
-    condensed index k.
+    condensed index k. Accepts scalars or arrays of indices and uses exact integer arithmetic.
 
     Parameters
     ----------
-    idx_i : int
+    idx_i : int or array_like
         Row index of the square matrix
-    idx_j : int
+    idx_j : int or array_like
         Column index of the square matrix
     size_n :
         Size of the square matrix
 
     Returns
     -------
-    k : int
+    k : int or np.ndarray
         Index of the condensed vector
 
     See Also
@@ -125,30 +156,39 @@ def square_to_condensed(idx_i, idx_j, size_n):
     scipy.spatial.distance.squareform
     """
 
-    if idx_i == idx_j:
+    is_scalar = np.isscalar(idx_i) and np.isscalar(idx_j)
+    idx_i = np.asarray(idx_i, dtype=np.int64)
+    idx_j = np.asarray(idx_j, dtype=np.int64)
+
+    if np.any(idx_i == idx_j):
         raise ValueError('Diagonal entries are not defined')
-    if idx_i < idx_j:
-        idx_i, idx_j = idx_j, idx_i
-    k = size_n * idx_j - idx_j * (idx_j + 1) / 2 + idx_i - 1 - idx_j
-    return int(k)
+    idx_row = np.minimum(idx_i, idx_j)
+    idx_col = np.maximum(idx_i, idx_j)
+    k = size_n * idx_row - idx_row * (idx_row + 1) // 2 + idx_col - idx_row - 1
+
+    if is_scalar:
+        return int(k)
+
+    return k
 
 
 def condensed_to_square(index_k, size_n):
     """Converts the condensed index k of the condensed vector to the indicies i and j of the square matrix with
-    size `size_n` x `size_n`.
+    size `size_n` x `size_n`. Accepts a scalar or an array of indices. The row index is estimated with floating point
+    arithmetic and then corrected with exact integer arithmetic.
 
     Parameters
     ----------
-    index_k : int
+    index_k : int or array_like
         Index of the condensed vector
     size_n : int
         Size of the square matrix
 
     Returns
     -------
-    i : int
+    i : int or np.ndarray
         Row index of the square matrix
-    j : int
+    j : int or np.ndarray
         Column index of the square matrix
 
     See Also
@@ -156,23 +196,21 @@ def condensed_to_square(index_k, size_n):
     scipy.spatial.distance.squareform
     """
 
-    def calc_row_idx(index_k, size_n):
-        """Determines the row index"""
-        return int(
-            np.ceil((1 / 2.) *
-                    (- (-8 * index_k + 4 * size_n ** 2 - 4 * size_n - 7) ** 0.5
-                     + 2 * size_n - 1) - 1))
+    def row_start(index_i):
+        """Determines the condensed index of the first element of the i-th row"""
+        return index_i * (2 * size_n - index_i - 1) // 2
 
-    def elem_in_i_rows(index_i, size_n):
-        """Determines the number of elements in the i-th row"""
-        return index_i * (size_n - 1 - index_i) + (index_i * (index_i + 1)) / 2
+    is_scalar = np.isscalar(index_k)
+    index_k = np.asarray(index_k, dtype=np.int64)
 
-    def calc_col_idx(index_k, index_i, size_n):
-        """Determines the column index"""
-        return int(size_n - elem_in_i_rows(index_i + 1, size_n) + index_k)
+    i = np.floor(((2 * size_n - 1) - np.sqrt((2 * size_n - 1) ** 2 - 8 * index_k)) / 2).astype(np.int64)
+    i = np.clip(i, 0, max(size_n - 2, 0))
+    i -= row_start(i) > index_k
+    i += row_start(i + 1) <= index_k
+    j = index_k - row_start(i) + i + 1
 
-    i = calc_row_idx(index_k, size_n)
-    j = calc_col_idx(index_k, i, size_n)
+    if is_scalar:
+        return int(i), int(j)
 
     return i, j
 
@@ -323,3 +361,106 @@ def compress_file(file_in_path, protocol=4, compression_level=1, delete_uncompre
 
     if delete_uncompressed:
         os.remove(file_in_path)
+
+
+class RecordWriter:
+    """Appends objects (records) to an LZMA compressed file of consecutive pickles.
+    Records are buffered and written in chunks. Every chunk is a separate LZMA stream that is completely written
+    when the chunk is flushed, so all flushed records can be read back even if the writing process crashes later.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the file the records will be appended to
+    chunk_size : int, optional
+        Number of records that are buffered before they are written
+    protocol : int, optional
+        Pickle protocol
+    compression_level : int, optional
+        LZMA compression level
+    overwrite : bool, optional
+        When true an already existing file will be overwritten, otherwise records are appended to it.
+    create_dir : bool, optional
+        When true any non existing intermediary directories in `file_path` will be created.
+    """
+
+    def __init__(self, file_path, chunk_size=100, protocol=4, compression_level=1, overwrite=True,
+                 create_dir=True):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.protocol = protocol
+        self.compression_level = compression_level
+        self.buffer = []
+        self.count = 0
+
+        # Create the output directory if it does not exist
+        if create_dir:
+            directory = os.path.dirname(file_path)
+            if directory != '' and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        if overwrite and os.path.isfile(file_path):
+            os.remove(file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, obj):
+        """Appends the record `obj`, writes the buffered records if the chunk is full"""
+
+        self.buffer.append(obj)
+        self.count += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered records as a new chunk"""
+
+        if len(self.buffer) == 0:
+            return
+
+        with lzma.open(self.file_path, 'ab', preset=self.compression_level) as file:
+            for obj in self.buffer:
+                pickle.dump(obj, file, protocol=self.protocol)
+        self.buffer = []
+
+    def close(self):
+        """Writes the remaining buffered records"""
+
+        self.flush()
+
+
+def load_records(file_path):
+    """Loads the records of a file written by `RecordWriter` (or `save`) one by one.
+
+    Parameters
+    ----------
+    file_path : str
+        Path of the compressed file
+
+    Yields
+    ------
+    object
+        Records in the order they were appended
+
+    Notes
+    -----
+    A truncated last chunk (e.g. because the writing process crashed) ends the iteration with a warning.
+    """
+
+    with lzma.open(file_path, 'rb') as file:
+        while True:
+            try:
+                obj = pickle.load(file)
+            except EOFError as error:
+                # An empty read marks the regular end of the file
+                if len(error.args) > 0 and error.args[0] != 'Ran out of input':
+                    logging.warning('Records file {} is truncated: {}'.format(file_path, error))
+                return
+            except lzma.LZMAError as error:
+                logging.warning('Records file {} is corrupted: {}'.format(file_path, error))
+                return
+            yield obj
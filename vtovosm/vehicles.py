@@ -2,6 +2,7 @@
 
 import networkx as nx
 import numpy as np
+import shapely.geometry as geom
 
 from . import geometry as geom_o
 from . import utils
@@ -9,20 +10,81 @@ from . import utils
 
 class Vehicles:
     """Class representing vehicles with their properties and relations
-     to each other."""
-
-    # TODO: only points as attributes and get coordinates from points when requested?
-
-    def __init__(self, points, graphs=None, size=0):
-        self.count = np.size(points)
-        self.points = points
-        self.coordinates = geom_o.extract_point_array(points)
-        self.graphs = graphs
+     to each other.
+     The vehicles are stored as arrays of their coordinates and, if known, the indices of their streets and their
+     offsets along the streets. Geometry points and graphs of the vehicles are only generated when requested.
+     The streets graph (or its spatial index) is not pickled, graphs can only be generated again after calling
+     `set_graph_streets`.
+     Vehicles generated from SUMO traces additionally store their SUMO IDs in `ids`."""
+
+    def __init__(self, points=None, graphs=None, size=0, coordinates=None, street_idxs=None, offsets=None,
+                 graph_streets=None, ids=None):
+        if coordinates is None:
+            coordinates = geom_o.extract_point_array(points)
+        self.coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        self.count = self.coordinates.shape[0]
+        self.street_idxs = street_idxs
+        self.offsets = offsets
+        self.graph_streets = graph_streets
+        self.ids = ids
+        self._points = points
+        if graphs is None:
+            self._graphs = np.zeros(self.count, dtype=object)
+            self._graphs[:] = None
+        else:
+            self._graphs = graphs
         self.pathlosses = np.zeros(size)
         self.distances = np.zeros(size)
         self.nlos = np.zeros(size, dtype=bool)
         self.idxs = {}
 
+    def __getstate__(self):
+        # Points, graphs and the streets graph are not pickled to keep the size small
+        state = self.__dict__.copy()
+        state['graph_streets'] = None
+        state['_points'] = None
+        if self.street_idxs is not None:
+            state['_graphs'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Vehicles saved before the array representation was introduced
+        if 'points' in state:
+            state['_points'] = state.pop('points')
+            state['_graphs'] = state.pop('graphs')
+            state['street_idxs'] = None
+            state['offsets'] = None
+            state['graph_streets'] = None
+        if 'ids' not in state:
+            state['ids'] = None
+
+        self.__dict__.update(state)
+        if self._graphs is None:
+            self._graphs = np.zeros(self.count, dtype=object)
+            self._graphs[:] = None
+
+    @property
+    def points(self):
+        """Geometry points of all vehicles"""
+
+        if self._points is None:
+            self._points = np.zeros(self.count, dtype=object)
+            for idx, coords in enumerate(self.coordinates):
+                self._points[idx] = geom.Point(coords)
+
+        return self._points
+
+    @property
+    def graphs(self):
+        """Graphs of all vehicles"""
+
+        return self.get_graph()
+
+    def set_graph_streets(self, graph_streets):
+        """Set the streets graph (or its spatial index) that is needed to generate the graphs of the vehicles"""
+
+        self.graph_streets = graph_streets
+
     def allocate(self, size):
         """Allocate memory for relational properties"""
 
@@ -56,9 +118,23 @@ class Vehicles:
         """"Get the graphs of a set of vehicles specified by a key"""
 
         if key is None:
-            return self.graphs
+            idxs = np.arange(self.count)
         else:
-            return self.graphs[self.idxs[key]]
+            idxs = self.idxs[key]
+
+        # Generate missing graphs
+        idxs_missing = [idx for idx in np.atleast_1d(idxs) if self._graphs[idx] is None]
+        if len(idxs_missing) > 0:
+            if self.street_idxs is None or self.graph_streets is None:
+                raise RuntimeError('Streets graph needed to generate the vehicle graphs')
+            streets = get_streets(self.graph_streets)
+            for idx in idxs_missing:
+                self._graphs[idx] = generate_veh_graph(streets[self.street_idxs[idx]],
+                                                       'v' + str(idx),
+                                                       self.points[idx],
+                                                       self.offsets[idx])
+
+        return self._graphs[idxs]
 
     def get_idxs(self, key):
         """Get the indices defined by a key"""
@@ -101,12 +177,15 @@ class Vehicles:
 def place_vehicles_in_network(network, density_veh=100, density_type='absolute'):
     """Generates vehicles in the network"""
 
-    graph_streets = network['graph_streets']
+    if 'index_streets' in network:
+        index_streets = network['index_streets']
+    else:
+        index_streets = geom_o.StreetIndex(network['graph_streets'])
 
     # Streets and positions selection
     time_start = utils.debug(None, 'Choosing random vehicle positions')
 
-    street_lengths = geom_o.get_street_lengths(graph_streets)
+    street_lengths = index_streets.lengths
 
     if density_type == 'absolute':
         count_veh = int(density_veh)
@@ -124,20 +203,24 @@ def place_vehicles_in_network(network, density_veh=100, density_type='absolute')
 
     # Vehicle generation
     time_start = utils.debug(None, 'Generating vehicles')
-    vehs = generate_vehs(graph_streets, rand_street_idxs)
+    vehs = generate_vehs(index_streets, rand_street_idxs)
     utils.debug(time_start)
 
     network['vehs'] = vehs
     return vehs
 
 
-def choose_random_streets(lengths, count=1):
-    """ Chooses random streets with probabilities relative to their length"""
+def choose_random_streets(lengths, count=1, rng=None):
+    """ Chooses random streets with probabilities relative to their length. Random numbers are drawn from the
+    generator `rng` if given and from the global numpy random state otherwise"""
+
+    if rng is None:
+        rng = np.random
 
     total_length = sum(lengths)
     probs = lengths / total_length
     count_streets = np.size(lengths)
-    indices = np.random.choice(count_streets, size=count, p=probs)
+    indices = rng.choice(count_streets, size=count, p=probs)
     return indices
 
 
@@ -152,80 +235,120 @@ def choose_random_point(street, count=1):
     return points
 
 
-def generate_vehs(graph_streets, street_idxs=None, points_vehs_in=None):
-    """Generates vehicles on specific streets """
+def choose_random_positions(index_streets, street_idxs, rng=None):
+    """Chooses a random position along every street. Returns the offsets along the streets and the coordinates.
+    Random numbers are drawn from the generator `rng` if given and from the global numpy random state otherwise"""
+
+    if rng is None:
+        rng = np.random
 
-    if points_vehs_in is None:
-        points_vehs_in = get_vehicles_from_streets(
-            graph_streets, street_idxs)
+    street_idxs = np.asarray(street_idxs, dtype=int).reshape(-1)
+    offsets = rng.random(street_idxs.size) * index_streets.geometry_lengths[street_idxs]
+    coords = index_streets.interpolate(street_idxs, offsets)
+
+    return offsets, coords
+
+
+def generate_vehs(graph_streets, street_idxs=None, points_vehs_in=None, coords_vehs_in=None, rng=None):
+    """Generates vehicles on specific streets. Vehicles without given points or coordinates are placed randomly
+    along their streets (using the random number generator `rng`), vehicles without given streets are snapped to
+    their closest streets.
+    `graph_streets` can be the streets graph or its spatial index"""
+
+    index_streets = geom_o.get_street_index(graph_streets)
+
+    if points_vehs_in is None and coords_vehs_in is None:
+        street_idxs = np.array(street_idxs, dtype=int).reshape(-1)
+        offsets, coords_vehs = choose_random_positions(index_streets, street_idxs, rng=rng)
+        vehs = Vehicles(coordinates=coords_vehs,
+                        street_idxs=street_idxs,
+                        offsets=offsets,
+                        graph_streets=graph_streets)
+        return vehs
     elif street_idxs is None:
-        street_idxs = get_streets_from_vehicles(graph_streets, points_vehs_in)
+        if coords_vehs_in is None:
+            coords_vehs_in = geom_o.extract_point_array(points_vehs_in)
+        street_idxs, offsets, coords_vehs = index_streets.snap(coords_vehs_in)
+        vehs = Vehicles(coordinates=coords_vehs,
+                        street_idxs=street_idxs,
+                        offsets=offsets,
+                        graph_streets=graph_streets)
+        return vehs
 
     count_veh = np.size(street_idxs)
-    graphs_vehs = np.zeros(count_veh, dtype=object)
+    street_idxs = np.array(street_idxs, dtype=int).reshape(count_veh)
     points_vehs = np.zeros(count_veh, dtype=object)
+    offsets = np.zeros(count_veh)
+    streets = get_streets(graph_streets)
 
     for iteration, index in enumerate(street_idxs):
-        street = graph_streets.edges(data=True)[index]
         point_veh = points_vehs_in[iteration]
         points_vehs[iteration] = point_veh
-        street_geom = street[2]['geometry']
-        # NOTE: All vehicle nodes get the prefix 'v'
-        node = 'v' + str(iteration)
-        # Add vehicle, needed intersections and edges to graph
-        graph_iter = nx.MultiGraph(node_veh=node)
-        node_attr = {'geometry': point_veh, 'x': point_veh.x, 'y': point_veh.y}
-        graph_iter.add_node(node, attr_dict=node_attr)
-        graph_iter.add_nodes_from(street[0: 2])
-
-        # Determine street parts that connect vehicle to intersections
-        street_before, street_after = geom_o.split_line_at_point(
-            street_geom, point_veh)
-        edge_attr = {'geometry': street_before,
-                     'length': street_before.length, 'is_veh_edge': True}
-        graph_iter.add_edge(node, street[0], attr_dict=edge_attr)
-        edge_attr = {'geometry': street_after,
-                     'length': street_after.length, 'is_veh_edge': True}
-        graph_iter.add_edge(node, street[1], attr_dict=edge_attr)
-
-        # Copy the created graph
-        graphs_vehs[iteration] = graph_iter.copy()
-
-    vehs = Vehicles(points_vehs, graphs_vehs)
+        offsets[iteration] = streets[index][2]['geometry'].project(point_veh)
+
+    vehs = Vehicles(points_vehs,
+                    street_idxs=street_idxs,
+                    offsets=offsets,
+                    graph_streets=graph_streets)
     return vehs
 
 
+def get_streets(graph_streets):
+    """Returns the streets (edges with data) of the streets graph or of its spatial index. The streets of both can be
+    accessed by the street index"""
+
+    if isinstance(graph_streets, geom_o.StreetIndex):
+        return graph_streets
+
+    return graph_streets.edges(data=True)
+
+
+def generate_veh_graph(street, node, point_veh, offset):
+    """Generates the graph of a vehicle that connects it to the ends of its street"""
+
+    street_geom = street[2]['geometry']
+    # Add vehicle, needed intersections and edges to graph
+    graph_veh = nx.MultiGraph(node_veh=node)
+    node_attr = {'geometry': point_veh, 'x': point_veh.x, 'y': point_veh.y}
+    graph_veh.add_node(node, attr_dict=node_attr)
+    graph_veh.add_nodes_from(street[0: 2])
+
+    # Determine street parts that connect vehicle to intersections
+    street_before, street_after = geom_o.split_line_at_distance(
+        street_geom, offset)
+    edge_attr = {'geometry': street_before,
+                 'length': street_before.length, 'is_veh_edge': True}
+    graph_veh.add_edge(node, street[0], attr_dict=edge_attr)
+    edge_attr = {'geometry': street_after,
+                 'length': street_after.length, 'is_veh_edge': True}
+    graph_veh.add_edge(node, street[1], attr_dict=edge_attr)
+
+    return graph_veh
+
+
 def get_vehicles_from_streets(graph_streets, street_idxs):
-    """Generate random vehicle points according to the street_idxs."""
+    """Generate random vehicle points according to the street_idxs.
+    `graph_streets` can be the streets graph or its spatial index"""
 
-    count_veh = np.size(street_idxs)
-    points_vehs = np.zeros(count_veh, dtype=object)
-    for iteration, index in enumerate(street_idxs):
-        street = graph_streets.edges(data=True)[index]
-        street_geom = street[2]['geometry']
-        points_vehs[iteration] = choose_random_point(street_geom)[0]
+    index_streets = geom_o.get_street_index(graph_streets)
+    _, coords_vehs = choose_random_positions(index_streets, street_idxs)
+
+    points_vehs = np.zeros(coords_vehs.shape[0], dtype=object)
+    for iteration, coords in enumerate(coords_vehs):
+        points_vehs[iteration] = geom.Point(coords)
     return points_vehs
 
 
 def get_streets_from_vehicles(graph_streets, points_vehs):
-    """Generate appropriate streets for given vehicular point coordinates."""
-
-    street_idxs = np.zeros(len(points_vehs), dtype=object)
-    edge_set = graph_streets.edges(data=True)
-
-    for iteration, point_veh in enumerate(points_vehs):
-        # Generate distances for vehicle to all edges (minimum distance)
-        # Result is a tuple with (distance, index). Min can use this to return
-        # the tuple with minimum 1st entry, so we have the index of the minimum
-        distance_list = [(point_veh.distance(x[2]['geometry']), ind)
-                         for (ind, x) in enumerate(edge_set)]
+    """Generate appropriate streets for given vehicular point coordinates.
+    The points are moved onto their closest streets. `graph_streets` can be the streets graph or its spatial index"""
 
-        _, street_idxs[iteration] = min(distance_list)
-        current_street = edge_set[street_idxs[iteration]][2]['geometry']
+    index_streets = geom_o.get_street_index(graph_streets)
+    coords_vehs = geom_o.extract_point_array(points_vehs)
+    street_idxs, _, coords_snapped = index_streets.snap(coords_vehs)
 
-        # Find the closest point to point_veh that lies ON the street
-        correction = current_street.project(point_veh)
+    # Reset the points so that they lie on the streets
+    for iteration, coords in enumerate(coords_snapped):
+        points_vehs[iteration] = geom.Point(coords)
 
-        # Reset the point so that it lies on the street
-        points_vehs[iteration] = current_street.interpolate(correction)
     return street_idxs